@@ -9,6 +9,7 @@
 
 var loaded_header = null;	// temporary variable for the header information before connected with data
 var loaded_data = [];		// temporary structure for data before they are connected with the header information
+var loaded_spectra = null;	// spectra from a packed spectra.f32 file (see spectramosaic_prep/spectrumbin.py), by patient and voxel ID
 
 // callback function when the data is loaded
 function csvDataFileLoaded(evt, patient_name, voxel_id, png_file, resolve) {
@@ -37,7 +38,11 @@ function csvDataFileLoaded(evt, patient_name, voxel_id, png_file, resolve) {
 	// preprocessing -- stretch to 1024 samples (interpolate)	
 	data_table = preprocessLoadedData(data_table);
 	
-	// load the png image 	
+	loadVoxelImage(patient_name, voxel_id, png_file, data_table, resolve);
+}
+
+// load the png image of a voxel whose data are ready
+function loadVoxelImage(patient_name, voxel_id, png_file, data_table, resolve) {
 	png_file.data.file(function(image_file){
 		var fileReader_img = new FileReader();
 		fileReader_img.onloadend = function(evt){
@@ -48,6 +53,78 @@ function csvDataFileLoaded(evt, patient_name, voxel_id, png_file, resolve) {
 	});
 }
 
+/**
+ * Read a spectra.json manifest and the packed spectra it describes into loaded_spectra.
+ * 
+ * The packed file holds each voxel's columns one after another, as little-endian float32, already baseline-subtracted
+ * and resized to spectrum_length samples (i.e. as preprocessLoadedData would leave them), so no parsing or resampling is needed.
+ * Returns a Promise, resolved once the spectra are loaded (or straight away if there is no packed file, or once
+ * either file turns out to be unreadable, leaving loaded_spectra null).
+ */
+function readPackedSpectra(manifest_file, packed_file) {
+	return new Promise(function(resolve, reject) {
+		if (!manifest_file || !packed_file) {
+			resolve();
+			return;
+		}
+		
+		// whatever goes wrong, the voxels are still read, from their CSV files
+		var fallBack = function(error){
+			console.error("Packed spectra: " + error + "; falling back to CSV files.");
+			loaded_spectra = null;
+			resolve();
+		};
+		
+		manifest_file.data.file(function(manifest_data){
+			var fileReader_manifest = new FileReader();
+			fileReader_manifest.onload = function(evt){
+				try {
+					var manifest = JSON.parse(evt.target.result);
+				} catch (error) {
+					fallBack(error);
+					return;
+				}
+				
+				packed_file.data.file(function(packed_data){
+					var fileReader_packed = new FileReader();
+					fileReader_packed.onload = function(evt){
+						try {
+							packedSpectraLoaded(manifest, evt.target.result);
+						} catch (error) {
+							fallBack(error);
+							return;
+						}
+						resolve();
+					};
+					fileReader_packed.onerror = function(evt){ fallBack(evt.target.error); };
+					fileReader_packed.readAsArrayBuffer(packed_data); // the whole study in one read
+				}, fallBack);
+			};
+			fileReader_manifest.onerror = function(evt){ fallBack(evt.target.error); };
+			fileReader_manifest.readAsText(manifest_data);
+		}, fallBack);
+	});
+}
+
+function packedSpectraLoaded(manifest, buffer) {
+	if (manifest.length != spectrum_length) {
+		console.error("Packed spectra: " + manifest.length + " samples per spectrum, expected " + spectrum_length + "; falling back to CSV files.");
+		return;
+	}
+	
+	var values = new Float32Array(buffer);	// little-endian, like practically every platform a browser runs on
+	
+	loaded_spectra = {};
+	manifest.voxels.forEach(function(vox){
+		var data_table = [];
+		for (var col=0; col < vox.columns; col++) {
+			var start = vox.offset + col * manifest.length;
+			data_table.push(Array.from(values.subarray(start, start + manifest.length)));
+		}
+		loaded_spectra[vox.patient + "/" + vox.voxel] = data_table;
+	});
+}
+
 function csvHeaderFileLoaded(evt) {
 	var data_text = evt.target.result;
 	
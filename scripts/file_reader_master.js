@@ -27,6 +27,7 @@ function handleFileSelect(evt) {
 	var foundFiles = [];
 	loaded_data = [];
 	loaded_header = null;
+	loaded_spectra = null;
 	loadingData = true;
 	p5_view_L.updateScene();
 	updateProgressBar(0, "Loading data");
@@ -105,23 +106,32 @@ function ReadEntries(dirReader, tree, parentname) {
  */
 function readData(foundFiles) {
 	var headerFile;
+	var topLevel = [];
 	
 	if (foundFiles.length == 1) {
-		headerFile = foundFiles[0].contents.find(function(elem){
-			return (elem.isFile && elem.name.includes("header") && elem.name.endsWith(".csv"));
-		});
+		topLevel = foundFiles[0].contents;
 	} else if (foundFiles.length > 1) {		
-		headerFile = foundFiles.find(function(elem){
-			return (elem.isFile && elem.name.includes("header") && elem.name.endsWith(".csv"));
-		});
+		topLevel = foundFiles;
 	}
 	
+	headerFile = topLevel.find(function(elem){
+		return (elem.isFile && elem.name.includes("header") && elem.name.endsWith(".csv"));
+	});
+	
+	// packed spectra of the whole study, if the data were prepared with spectramosaic_prep.py --binary
+	var manifestFile = topLevel.find(function(elem){
+		return (elem.isFile && elem.name == "spectra.json");
+	});
+	var packedFile = topLevel.find(function(elem){
+		return (elem.isFile && elem.name == "spectra.f32");
+	});
+	
 	if (headerFile) {
 		headerFile = headerFile.data.file(function(header){
 			var fileReader_header = new FileReader();
 			fileReader_header.onloadend = (function(evt) { 
 				csvHeaderFileLoaded(evt); 
-				readVoxels(foundFiles); 
+				readPackedSpectra(manifestFile, packedFile).then(function(){ readVoxels(foundFiles); });
 			});		
 			fileReader_header.readAsText(header);
 		});		
@@ -207,7 +217,9 @@ function readVoxel(patient_name, voxel_id, data_files) {
 			return (elem.isFile && elem.name.startsWith(voxel_id) && elem.name.endsWith("ax.png"));
 		});
 		
-		if (!csv_file) {
+		var packed_data = loaded_spectra ? loaded_spectra[patient_name + "/" + voxel_id] : undefined;
+		
+		if (!csv_file && !packed_data) {
 			alert("Voxel " + voxel_id + ": CSV file not found.");
 			loadingData = false;
 			p5_view_L.updateScene();
@@ -221,6 +233,11 @@ function readVoxel(patient_name, voxel_id, data_files) {
 			return;		
 		}
 		
+		if (packed_data) {	// already loaded and preprocessed -- only the image is needed
+			loadVoxelImage(patient_name, voxel_id, png_file, packed_data, resolve);
+			return;
+		}
+		
 		csv_file.data.file(function(data_file){
 			
 			var fileReader_data = new FileReader();
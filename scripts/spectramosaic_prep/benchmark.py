@@ -0,0 +1,376 @@
+#!/usr/bin/python
+"""
+Benchmarks of the prep pipeline, on synthetic data, with the results kept as json so that runs on different
+commits may be compared.
+
+Synthetic data are made from scratch, reproducibly (everything is seeded):
+
+  - P-files of versions 11, 15, 16 and 24, laid out as pfile.read_header expects (see pfile.header_layout),
+    holding a few receivers' worth of a simple PRESS spectrum (NAA, Cr, Cho, lipid) with noise
+  - a structural volume, with c1-c3 tissue class volumes and single-voxel masks, as niftis
+  - a structural DICOM series (if pydicom is installed), for the end-to-end runs
+
+Timed are:
+
+  read_header/v<N>         : reading the headers of 100 P-files of each version
+  merge_masks/<mode>       : rendering a mask over the structural, in each mode
+  update_header_info/<N>   : writing the header info of N voxels afresh, and /<N>/add1 adding one more to them
+  prep/<N>                 : spectramosaic_prep_sessions on N voxels, from scratch (python masks, native fit),
+                             and /<N>/uptodate running it again, with nothing to do
+
+Usage
+-----
+
+    benchmark.py [-o results.json] [-j N] [--sizes 10,100,1000] [--scratch foldername] [--compare baseline.json]
+
+  -o        : write the results here (default benchmark-<commit>.json)
+  -j        : worker processes for the end-to-end runs (default 1)
+  --sizes   : voxel counts for the end-to-end runs (default 10,100,1000)
+  --scratch : where to make the synthetic data and outputs (default: a temporary folder, removed afterwards)
+  --compare : print each result against those of an earlier run
+"""
+
+import os;
+import sys;
+import json;
+import time;
+import shutil;
+import struct;
+import platform;
+import tempfile;
+import subprocess;
+from collections import OrderedDict;
+
+import numpy as np;
+
+from pfile import *;
+
+where_am_i=os.path.dirname(os.path.realpath(__file__));
+
+versions=[11,15,16,24];
+
+# a few metabolites, as (ppm, amplitude, linewidth in Hz)
+peaks=[(2.008,9.0,6.0),(3.027,6.0,6.0),(3.208,7.2,6.0),(1.28,6.0,30.0)];
+
+# synthetic data {{{
+
+def synthetic_header(i, npoints=2048, nframes=2, nreceivers=2): # {{{
+  """ Header values for the i'th synthetic P-file (of some 20 patients): everything read_header reads, for any version """
+  return {
+    'npasses':1, 'nslices':1, 'nechoes':1, 'navs':1, 'nframes':nframes, 'point_size':4,
+    'MRS_struct.p.npoints':npoints, 'MRS_struct.p.nrows':nframes+1, 'rc_xres':npoints, 'rc_yres':nframes+1,
+    'start_recv':0, 'stop_recv':nreceivers-1,
+    'spectral_width':5000.0, 'ps_mps_freq':1277000000,
+    'ras_size':(20.0,20.0,20.0),
+    'ras_center':(30.0-5*(i%5),5.0,-20.0+3*(i%7)), # off the midline, or merge_masks moves its slice off the voxel
+    'ras_normal':(0.0,0.0,1.0),
+    'ras_topleft':(-120.0,120.0,-20.0+3*(i%7)),
+    'ras_topright':(120.0,120.0,-20.0+3*(i%7)),
+    'ras_bottomright':(120.0,-120.0,-20.0+3*(i%7)),
+    'patient_name':'Patient %02d' % (i%20,),
+    'series_description':['PRESS pcc','PRESS acc','PRESS thal'][i%3],
+    'series_protocol':['resting','task'][i%2],
+    'te':[35000,30000,68000][i%3],
+    'patient_age':20+i%50,
+    'patient_sex':1+i%2,
+    'exam_datetime':1500000000+86400*(i%20),
+    };
+# }}}
+
+def write_pfile(fn, version, values, seed=0): # {{{
+  """ Write a little-endian P-file of the given version, with the given header values (see synthetic_header) and a synthetic spectrum """
+  if version>11:
+    sections={'exam':8192,'series':12288,'image':16384,'data':20480}; # rev 14.0 and later: found through the section table
+  else:
+    sections={}; # fixed-size header, and only its fixed-position fields are read
+  hdr_size=sections.get('data',66072);
+
+  buf=bytearray(hdr_size);
+  layout,names=header_layout(version,'<',sections);
+  flat=[];
+  for name,count in names:
+    if count==1:
+      flat.append(values[name]);
+    else:
+      flat+=list(values[name]);
+  layout.pack_into(buf,0,*flat); # this zeroes all the gaps, so goes first
+  struct.pack_into('<f',buf,0,float(version));
+  if version>11:
+    struct.pack_into('<10i',buf,section_table_offset,*[sections.get(k,0) for k in section_table_names]);
+
+  nreceivers=1+values['stop_recv']-values['start_recv'];
+  npoints=values['MRS_struct.p.npoints'];
+  nframes=values['nframes'];
+  t=np.arange(npoints)/values['spectral_width'];
+  f0=values['ps_mps_freq']/1e7;
+  fid=np.zeros(npoints,dtype=complex);
+  for ppm,amplitude,lw in peaks:
+    fid+=amplitude*np.exp(2j*np.pi*(ppm-4.68)*f0*t)*np.exp(-np.pi*lw*t);
+
+  rng=np.random.RandomState(seed);
+  data=np.zeros((nreceivers,values['nechoes'],nframes+1,npoints),dtype=complex); # frame 0 is the baseline frame
+  for r in range(nreceivers):
+    data[r,:,1:]=1e4*np.exp(1j*rng.rand()*6)*fid+200*(rng.randn(nframes,npoints)+1j*rng.randn(nframes,npoints));
+  raw=np.zeros(data.shape+(2,),dtype='<i4');
+  raw[...,0]=data.real;
+  raw[...,1]=data.imag;
+
+  with open(fn,'wb') as f:
+    f.write(buf);
+    f.write(raw.tostring());
+  return fn;
+# }}}
+
+def write_pfiles(folder, n, version=24, first=0): # {{{
+  """ n synthetic P-files, P<i>.7, in folder; returns their filenames """
+  if not os.path.isdir(folder):
+    os.makedirs(folder);
+  return [write_pfile(os.path.join(folder,'P%05d.7' % (i,)),version,synthetic_header(i),seed=i) for i in range(first,first+n)];
+# }}}
+
+def synthetic_head(shape=(64,64,40)): # {{{
+  """ (structural, [c1, c2, c3]) arrays of an ellipsoidal 'head': a shell of CSF around white matter inside grey matter """
+  x,y,z=np.meshgrid(*[np.linspace(-1,1,n) for n in shape],indexing='ij');
+  r=np.sqrt(x**2+y**2+z**2);
+  rng=np.random.RandomState(1);
+  csf=np.clip(1-abs(r-0.85)/0.1,0,1);
+  gm=np.clip(1-abs(r-0.65)/0.15,0,1);
+  wm=np.clip((0.55-r)/0.1,0,1);
+  structural=(300*csf+600*gm+900*wm+50*rng.rand(*shape)).astype('int16');
+  return structural,[gm,wm,csf];
+# }}}
+
+def write_volumes(folder, nmasks=4, shape=(64,64,40)): # {{{
+  """ volume.nii, c1-c3volume.nii and nmasks single-voxel P<i>_mask.nii in folder; returns (structural, masks, tissuemask) filenames as merge_masks takes them """
+  import nibabel as nib;
+  if not os.path.isdir(folder):
+    os.makedirs(folder);
+  affine=np.diag([2.0,2.0,2.5,1.0]);
+  affine[:3,3]=[-64.0,-64.0,-50.0];
+
+  structural,tissues=synthetic_head(shape);
+  volume=os.path.join(folder,'volume.nii');
+  nib.Nifti1Image(structural,affine).to_filename(volume);
+  tissuemask={};
+  for c,tissue in zip(['c1','c2','c3'],tissues):
+    tissuemask['%svolume.nii' % (c,)]=os.path.join(folder,'%svolume.nii' % (c,));
+    nib.Nifti1Image(tissue.astype('float32'),affine).to_filename(tissuemask['%svolume.nii' % (c,)]);
+
+  masks=[];
+  for i in range(nmasks):
+    mask=np.zeros(shape,dtype='uint8');
+    x,y,z=[int(n*f) for n,f in zip(shape,[0.3+0.1*(i%4),0.4+0.05*(i%3),0.5])];
+    mask[x:x+8,y:y+8,z:z+6]=255;
+    mask[x-1,y:y+8,z:z+6]=128; # partial volume along one edge
+    masks.append(os.path.join(folder,'P%05d_mask.nii' % (i,)));
+    nib.Nifti1Image(mask,affine).to_filename(masks[-1]);
+  return volume,masks,tissuemask;
+# }}}
+
+def write_dicom_series(folder, shape=(64,64,40)): # {{{
+  """ The synthetic structural, as an axial DICOM series (needs pydicom) """
+  try:
+    import dicom as pydicom; # pydicom < 1.0
+  except ImportError:
+    import pydicom;
+  Dataset,FileDataset=pydicom.dataset.Dataset,pydicom.dataset.FileDataset;
+
+  if not os.path.isdir(folder):
+    os.makedirs(folder);
+  structural,tissues=synthetic_head(shape);
+  uid='1.2.826.0.1.3680043.2.1125.1';
+  for k in range(shape[2]):
+    meta=Dataset();
+    meta.MediaStorageSOPClassUID='1.2.840.10008.5.1.4.1.1.4';
+    meta.MediaStorageSOPInstanceUID='%s.%d' % (uid,k+1);
+    meta.TransferSyntaxUID='1.2.840.10008.1.2.1'; # explicit VR little endian
+    ds=FileDataset(str(k),{},file_meta=meta,preamble='\0'*128);
+    ds.is_little_endian=True;
+    ds.is_implicit_VR=False;
+    ds.SeriesInstanceUID=uid;
+    ds.SOPInstanceUID=meta.MediaStorageSOPInstanceUID;
+    ds.ImageOrientationPatient=[1,0,0,0,1,0];
+    ds.ImagePositionPatient=[-64.0,-64.0,-50.0+2.5*k];
+    ds.PixelSpacing=[2.0,2.0];
+    ds.SliceThickness=2.5;
+    ds.Rows=shape[1];
+    ds.Columns=shape[0];
+    ds.BitsAllocated=16;
+    ds.BitsStored=16;
+    ds.HighBit=15;
+    ds.PixelRepresentation=0;
+    ds.SamplesPerPixel=1;
+    ds.PhotometricInterpretation='MONOCHROME2';
+    ds.PixelData=np.clip(structural[:,:,k],0,None).astype('<u2').T.tostring();
+    ds.save_as(os.path.join(folder,'IM%04d' % (k,)));
+  return folder;
+# }}}
+
+# }}}
+
+def timed(func, repeat=3): # {{{
+  """ Run func repeat times; returns its timings, in seconds """
+  runs=[];
+  for i in range(repeat):
+    start=time.time();
+    func();
+    runs.append(time.time()-start);
+  return OrderedDict([('best',min(runs)),('mean',sum(runs)/len(runs)),('runs',runs)]);
+# }}}
+
+class quiet(object):
+  """ Send stdout to a log file for the duration, so the pipeline's chatter isn't timed along with it """
+
+  def __init__(self, log_file):
+    self.log_file=log_file;
+
+  def __enter__(self):
+    sys.stdout.flush();
+    self.saved=os.dup(1);
+    self.log=open(self.log_file,'a');
+    os.dup2(self.log.fileno(),1);
+
+  def __exit__(self, *exc):
+    sys.stdout.flush();
+    os.dup2(self.saved,1);
+    os.close(self.saved);
+    self.log.close();
+
+def bench_read_header(scratch, results, n=100): # {{{
+  for version in versions:
+    pfiles=write_pfiles(os.path.join(scratch,'v%d' % (version,)),n,version);
+    with quiet(os.path.join(scratch,'read_header.log')):
+      header=pfile.read_header(pfiles[0]);
+    if version>11:
+      assert header['patient_name']==synthetic_header(0)['patient_name'],'v%d: patient name read back as %r' % (version,header['patient_name']);
+    with quiet(os.path.join(scratch,'read_header.log')):
+      results['read_header/v%d' % (version,)]=timed(lambda: [pfile.read_header(fn) for fn in pfiles]);
+# }}}
+
+def bench_merge_masks(scratch, results): # {{{
+  from mergemasks import merge_masks, all_modes, _slice_cache;
+  structural,masks,tissuemask=write_volumes(os.path.join(scratch,'volumes'));
+  def run(mode):
+    _slice_cache.clear(); # (the on-disk slice cache is kept; it is there on any second run for real)
+    merge_masks(structural,masks[:1],tissuemask=tissuemask,mode=mode);
+  with quiet(os.path.join(scratch,'merge_masks.log')):
+    for mode in all_modes:
+      results['merge_masks/%s' % (mode,)]=timed(lambda: run(mode));
+# }}}
+
+def bench_update_header_info(scratch, results, sizes=(10,100,1000,10000)): # {{{
+  import spectramosaic_prep;
+  for n in sizes:
+    pfiles=[];
+    for i in range(n+1):
+      header=synthetic_header(i);
+      header.update({'shortname':'P%05d' % (i,),'patient_sex':'MF'[i%2],'exam_datetime':time.strftime('%Y-%m-%d %H:%M:%S',time.gmtime(header['exam_datetime']))});
+      pfiles.append(pfile(header));
+    output_root=os.path.join(scratch,'headers%d' % (n,));
+    def afresh():
+      for f in [output_root,output_root+'.working']:
+        shutil.rmtree(f,True);
+      os.makedirs(output_root);
+      spectramosaic_prep.update_header_info(output_root,pfiles[:n]);
+    with quiet(os.path.join(scratch,'update_header_info.log')):
+      results['update_header_info/%d' % (n,)]=timed(afresh);
+      results['update_header_info/%d/add1' % (n,)]=timed(lambda: spectramosaic_prep.update_header_info(output_root,pfiles[n:]));
+# }}}
+
+def bench_prep(scratch, results, sizes=(10,100,1000), njobs=1): # {{{
+  import spectramosaic_prep;
+  dicom=write_dicom_series(os.path.join(scratch,'dicom'));
+  pfiles=[];
+  for n in sizes:
+    if len(pfiles)<n:
+      pfiles+=write_pfiles(os.path.join(scratch,'pfiles'),n-len(pfiles),first=len(pfiles));
+    output_root=os.path.join(scratch,'prep%d' % (n,));
+    run=lambda force: spectramosaic_prep.spectramosaic_prep_sessions(output_root,{dicom:pfiles[:n]},njobs=njobs,mask_engine='python',quantifier='native',force=force);
+    with quiet(os.path.join(scratch,'prep%d.log' % (n,))):
+      results['prep/%d' % (n,)]=timed(lambda: run(True),repeat=1 if n>=100 else 3);
+      results['prep/%d/uptodate' % (n,)]=timed(lambda: run(False),repeat=1 if n>=100 else 3);
+# }}}
+
+def commit(): # {{{
+  """ The current git commit, if this is a git checkout """
+  try:
+    return subprocess.Popen(['git','rev-parse','--short','HEAD'],cwd=where_am_i,stdout=subprocess.PIPE,stderr=subprocess.PIPE).communicate()[0].strip() or None;
+  except OSError:
+    return None;
+# }}}
+
+def compare(results, baseline_file): # {{{
+  """ Each result's best time against that of an earlier run, slowest first """
+  with open(baseline_file) as f:
+    baseline=json.load(f);
+  print 'Compared with %s (commit %s):' % (baseline_file,baseline.get('commit'));
+  rows=[];
+  for name in results:
+    if name in baseline['results']:
+      rows.append((results[name]['best']/baseline['results'][name]['best'],name));
+  for ratio,name in sorted(rows,reverse=True):
+    print '  %-36s %9.4f s  x%.2f%s' % (name,results[name]['best'],ratio,'  SLOWER' if ratio>1.2 else '');
+# }}}
+
+if __name__=='__main__':
+  state=None;
+  output_file=None;
+  njobs=1;
+  sizes=[10,100,1000];
+  scratch=None;
+  baseline_file=None;
+
+  for k in sys.argv[1:]:
+    if state is None:
+      if k in ['-o','-j','--sizes','--scratch','--compare']:
+        state=k;
+      else:
+        raise ValueError('What is this? : %s' % (k));
+    elif state=='-o':
+      output_file=k;
+      state=None;
+    elif state=='-j':
+      njobs=int(k);
+      state=None;
+    elif state=='--sizes':
+      sizes=[int(x) for x in k.split(',')];
+      state=None;
+    elif state=='--scratch':
+      scratch=k;
+      state=None;
+    elif state=='--compare':
+      baseline_file=k;
+      state=None;
+
+  info=OrderedDict([('commit',commit()),('date',time.strftime('%Y-%m-%d %H:%M:%S')),('python',platform.python_version()),('platform',platform.platform()),('njobs',njobs)]);
+  if output_file is None:
+    output_file='benchmark-%s.json' % (info['commit'] or 'unknown',);
+
+  keep=scratch is not None;
+  if scratch is None:
+    scratch=tempfile.mkdtemp(prefix='spectramosaic_bench');
+  elif not os.path.isdir(scratch):
+    os.makedirs(scratch);
+
+  results=OrderedDict();
+  try:
+    for bench in [bench_read_header,bench_merge_masks,bench_update_header_info]:
+      bench(scratch,results);
+      print '%s done' % (bench.__name__,);
+    try:
+      bench_prep(scratch,results,sizes,njobs);
+    except ImportError as e:
+      print 'Skipping the end-to-end runs: %s' % (e,); # no pydicom, for the structural series and the python masks
+  finally:
+    if not keep:
+      shutil.rmtree(scratch,True);
+
+  info['results']=results;
+  with open(output_file,'w') as f:
+    json.dump(info,f,indent=1);
+  for name in results:
+    print '%-40s %9.4f s' % (name,results[name]['best']);
+  print output_file;
+
+  if baseline_file is not None:
+    compare(results,baseline_file);
@@ -0,0 +1,157 @@
+#!/usr/bin/python
+"""
+Content-hash based record of build steps, used instead of comparing file times.
+
+Each step's record is kept next to its outputs, in a .buildcache folder, and holds a hash of its
+parameters and of the contents of its inputs (files, or whole folders). A step is up-to-date when
+its outputs all exist and the hashes still match. File sizes and mtimes are recorded too, but only
+to avoid re-reading inputs which clearly haven't changed: a copied or restored input is re-hashed,
+and found to be the same.
+
+No absolute paths go into a record: the key is of the parameters and the inputs' hashes (in order), and
+inputs and outputs are noted relative to the record's folder, so a tree may be moved, copied or restored
+elsewhere and still be found up-to-date. Parameters should likewise leave out where files are (see portable).
+"""
+
+import os;
+import json;
+import hashlib;
+
+_memo={}; # (path, stat signature) => content hash, for this process
+
+def _file_signature(path):
+  st=os.stat(path);
+  return '%d:%.6f' % (st.st_size,st.st_mtime);
+
+def _folder_files(path):
+  for root, subFolders, files in os.walk(path):
+    subFolders.sort();
+    for f in sorted(files):
+      yield os.path.join(root,f);
+
+def signature(path): # {{{
+  """ Cheap summary of a file's or folder's size and mtime(s); None if it doesn't exist """
+  if os.path.isdir(path):
+    h=hashlib.sha1();
+    for fn in _folder_files(path):
+      h.update('%s=%s\n' % (os.path.relpath(fn,path),_file_signature(fn)));
+    return 'dir:'+h.hexdigest();
+  elif os.path.exists(path):
+    return _file_signature(path);
+  return None;
+# }}}
+
+def content_hash(path): # {{{
+  """ sha1 of a file's contents, or of the names and contents of all files in a folder """
+  h=hashlib.sha1();
+  if os.path.isdir(path):
+    for fn in _folder_files(path):
+      h.update(os.path.relpath(fn,path)+'\0'+content_hash(fn)+'\n');
+  else:
+    with open(path,'rb') as f:
+      while True:
+        chunk=f.read(1<<20);
+        if not chunk:
+          break;
+        h.update(chunk);
+  return h.hexdigest();
+# }}}
+
+def portable(cmd): # {{{
+  """ A command line as a step parameter, with files (its inputs and outputs, checked in their own right) by name only """
+  return [os.path.basename(a) if os.path.sep in a else a for a in cmd];
+# }}}
+
+class BuildCache(object):
+  """
+  Records of build steps, and the count of hits and misses seen by this instance.
+
+  signatures, if given, is a dict of absolute path => signature of inputs shared by many steps (such as a
+  session's structural folder), worked out once beforehand rather than at every step.
+  """
+
+  def __init__(self, force=False, signatures=None):
+    self.force=force;
+    self.signatures=signatures or {};
+    self.hits=[];
+    self.misses=[];
+
+  def _folder(self, outputs):
+    return os.path.dirname(os.path.abspath(outputs[0]));
+
+  def record_path(self, step, outputs):
+    return os.path.join(self._folder(outputs),'.buildcache','%s.json' % (step,));
+
+  def _names(self, paths, folder):
+    return [os.path.relpath(os.path.abspath(path),folder) for path in paths];
+
+  def _load(self, step, outputs):
+    fn=self.record_path(step,outputs);
+    if not os.path.exists(fn):
+      return None;
+    try:
+      with open(fn) as f:
+        return json.load(f);
+    except ValueError:
+      return None; # damaged record; treat as absent
+
+  def _input_hashes(self, inputs, known, folder):
+    """ [(name, [signature, hash])] of inputs, in order, named relative to folder; re-using known hashes (by name) where the signature matches """
+    hashes=[];
+    for path,name in zip(inputs,self._names(inputs,folder)):
+      path=os.path.abspath(path);
+      sig=self.signatures[path] if path in self.signatures else signature(path);
+      if sig is None:
+        hashes.append((name,[None,None]));
+      elif name in known and known[name][0]==sig:
+        hashes.append((name,known[name]));
+      else:
+        if not (path,sig) in _memo:
+          _memo[(path,sig)]=content_hash(path);
+        hashes.append((name,[sig,_memo[(path,sig)]]));
+    return hashes;
+
+  def _key(self, hashes, params):
+    h=hashlib.sha1();
+    h.update(json.dumps(params,sort_keys=True));
+    for name,(sig,content) in hashes:
+      h.update('%s\n' % (content,));
+    return h.hexdigest();
+
+  def is_current(self, step, outputs, inputs, params=None):
+    """ True iff all outputs exist, and step was last recorded with the same inputs (by content) and params. Counts a hit or miss. """
+    rec=None if self.force else self._load(step,outputs);
+    ok=rec is not None and all(os.path.exists(fn) for fn in outputs);
+    if ok:
+      folder=self._folder(outputs);
+      hashes=self._input_hashes(inputs,rec.get('inputs',{}),folder);
+      ok=rec.get('key')==self._key(hashes,params) and set(rec.get('outputs',[]))==set(self._names(outputs,folder));
+      if ok and dict(hashes)!=rec['inputs']:
+        self._save(step,outputs,hashes,params); # same content, new signatures; save re-hashing next time
+    if ok:
+      self.hits.append(step);
+    else:
+      self.misses.append(step);
+    return ok;
+
+  def record(self, step, outputs, inputs, params=None):
+    """ Note that step has just produced outputs from inputs and params """
+    rec=self._load(step,outputs);
+    self._save(step,outputs,self._input_hashes(inputs,rec.get('inputs',{}) if rec else {},self._folder(outputs)),params);
+
+  def _save(self, step, outputs, hashes, params):
+    fn=self.record_path(step,outputs);
+    if not os.path.isdir(os.path.dirname(fn)):
+      try:
+        os.makedirs(os.path.dirname(fn));
+      except OSError:
+        if not os.path.isdir(os.path.dirname(fn)): # lost a race with another worker, otherwise a real problem
+          raise;
+    rec={'key':self._key(hashes,params),'params':params,'inputs':dict(hashes),'outputs':self._names(outputs,self._folder(outputs))};
+    tmp='%s.%d.tmp' % (fn,os.getpid());
+    with open(tmp,'w') as f:
+      json.dump(rec,f,indent=1,sort_keys=True);
+    os.rename(tmp,fn);
+
+  def summary(self):
+    return {'hits':list(self.hits),'misses':list(self.misses)};
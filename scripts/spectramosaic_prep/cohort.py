@@ -0,0 +1,156 @@
+#!/usr/bin/python
+"""
+Cohorts: many subjects, each with one or more sessions (a structural series and the P-files acquired with it),
+described by a manifest; and a journal of the voxels finished so far, so that an interrupted run may be resumed.
+
+A manifest maps subject => session => structural folder and P-files, as json (or yaml, if PyYAML is installed):
+
+    {"S01": {"baseline": {"structural": "S01/t1",   "pfiles": ["S01/baseline/P*.7"]},
+             "followup": {"structural": "S01/t1_2", "pfiles": ["S01/followup/P12345.7"]}},
+     "S02": ...}
+
+or as a csv (; or , separated), with a header row and one P-file (or pattern) per row:
+
+    subject;session;structural;pfile
+    S01;baseline;S01/t1;S01/baseline/P*.7
+
+Relative paths are taken from the manifest's folder; P-file patterns are expanded, sorted.
+
+Usage
+-----
+
+    cohort.py [manifest]
+
+  List the sessions of a manifest, and the number of P-files found for each.
+"""
+
+import os;
+import sys;
+import csv;
+import json;
+import glob;
+from collections import OrderedDict;
+
+from buildcache import signature;
+
+def _expand(base, pattern): # {{{
+  path=os.path.join(base,pattern);
+  found=sorted(glob.glob(path));
+  if len(found)==0:
+    raise IOError('Manifest entry matches no files: %s' % (path,));
+  return found;
+# }}}
+
+def _load(filename): # {{{
+  """ A manifest as rows of (subject, session, structural, pfile pattern) """
+  ext=os.path.splitext(filename)[1].lower();
+  if ext=='.csv':
+    with open(filename,'rb') as f:
+      text=f.read();
+    delimiter=';' if text.split('\n')[0].count(';')>0 else ',';
+    rows=[];
+    for row in csv.DictReader(text.splitlines(),delimiter=delimiter):
+      missing=[k for k in ['subject','session','structural','pfile'] if not row.get(k)];
+      if missing:
+        raise ValueError('%s: row without %s: %s' % (filename,', '.join(missing),row));
+      rows.append((row['subject'],row['session'],row['structural'],row['pfile']));
+    return rows;
+
+  if ext in ['.yaml','.yml']:
+    import yaml; # pip install PyYAML
+    with open(filename) as f:
+      tree=yaml.safe_load(f);
+  else:
+    with open(filename) as f:
+      tree=json.load(f,object_pairs_hook=OrderedDict);
+
+  rows=[];
+  for subject in tree:
+    for session in tree[subject]:
+      spec=tree[subject][session];
+      if not 'structural' in spec or not 'pfiles' in spec:
+        raise ValueError('%s: session %s of %s needs structural and pfiles' % (filename,session,subject));
+      pfiles=spec['pfiles'];
+      if isinstance(pfiles,basestring):
+        pfiles=[pfiles];
+      for pattern in pfiles:
+        rows.append((subject,session,spec['structural'],pattern));
+  return rows;
+# }}}
+
+def read_manifest(filename): # {{{
+  """ OrderedDict of (subject, session) => (structural folder, [P-files]), in the manifest's order """
+  base=os.path.dirname(os.path.abspath(filename));
+  sessions=OrderedDict();
+  for subject,session,structural,pattern in _load(filename):
+    structural=os.path.join(base,structural);
+    key=(str(subject),str(session));
+    if key in sessions and sessions[key][0]!=structural:
+      raise ValueError('%s: session %s of %s has two structural folders: %s, %s' % (filename,session,subject,sessions[key][0],structural));
+    sessions.setdefault(key,(structural,[]));
+    for fn in _expand(base,pattern):
+      if not fn in sessions[key][1]:
+        sessions[key][1].append(fn);
+  return sessions;
+# }}}
+
+def struct_spec(sessions, spec=None): # {{{
+  """ Sessions (as from read_manifest) as a dict of structural folder => P-files, as spectramosaic_prep_sessions takes them; added to spec, if given """
+  if spec is None:
+    spec=OrderedDict();
+  for structural,pfiles in sessions.values():
+    spec.setdefault(structural,[]);
+    spec[structural]+=[fn for fn in pfiles if not fn in spec[structural]];
+  return spec;
+# }}}
+
+class Journal(object):
+  """
+  The voxels finished so far, each with what it was made from: its P-file and structural folder (by size and
+  mtime; see buildcache.signature), and the settings of the run. Kept as lines of json, appended to as each
+  voxel is finished, so an interruption loses at most the line being written.
+  """
+
+  def __init__(self, filename):
+    self.filename=filename;
+    self.done={};
+    self._struct_signatures={};
+    if os.path.exists(filename):
+      with open(filename) as f:
+        for line in f:
+          try:
+            entry=json.loads(line);
+          except ValueError:
+            continue; # cut short by the interruption
+          self.done[entry['pfile']]=entry;
+
+  def entry(self, pfile_name, struct_folder, settings):
+    struct_folder=os.path.abspath(struct_folder);
+    if not struct_folder in self._struct_signatures:
+      self._struct_signatures[struct_folder]=signature(struct_folder);
+    return {
+      'pfile':os.path.abspath(pfile_name),
+      'signature':signature(pfile_name),
+      'structural':struct_folder,
+      'struct_signature':self._struct_signatures[struct_folder],
+      'settings':settings,
+      };
+
+  def is_done(self, pfile_name, struct_folder, settings):
+    """ True iff the voxel was finished, from the same P-file and structural, with the same settings """
+    return self.done.get(os.path.abspath(pfile_name))==json.loads(json.dumps(self.entry(pfile_name,struct_folder,settings)));
+
+  def add(self, pfile_name, struct_folder, settings):
+    entry=self.entry(pfile_name,struct_folder,settings);
+    with open(self.filename,'a') as f:
+      f.write(json.dumps(entry,sort_keys=True)+'\n');
+    self.done[entry['pfile']]=entry;
+
+if __name__=='__main__':
+  if len(sys.argv)!=2:
+    print 'Usage: cohort.py [manifest]';
+    sys.exit(1);
+  sessions=read_manifest(sys.argv[1]);
+  for (subject,session),(structural,pfiles) in sessions.items():
+    print '%-16s %-16s %4d  %s' % (subject,session,len(pfiles),structural);
+  print '%d subject(s), %d session(s), %d P-file(s)' % (len(set(s for s,x in sessions)),len(sessions),sum(len(p) for s,p in sessions.values()));
@@ -0,0 +1,190 @@
+#!/usr/bin/python
+"""
+Persistent index of the slices of structural DICOM folders, so that a folder is walked, and its files'
+headers read, once rather than for every voxel.
+
+For each folder, only the tags needed to place the slices are read (series, position, orientation, pixel
+spacing, rescaling), not the pixel data; the slices of each series are kept sorted along the slice normal,
+keyed by the folder's path and validated by its files' sizes and mtimes (see buildcache.signature). The
+pixel data is then read straight into one array, slice by slice, only when the volume is assembled.
+
+Usage
+-----
+
+    dicomindex.py [-d index.sqlite] [folder] ...
+
+  Index the folders (if they aren't already, or have changed), and list the series found in each.
+
+    -d [filename] : index to use (default: ~/.spectramosaic_dicom_index.sqlite)
+
+Requires pydicom (and numpy, to assemble volumes).
+"""
+
+import os;
+import sys;
+import json;
+import sqlite3;
+
+from buildcache import signature;
+
+default_index=os.path.expanduser('~/.spectramosaic_dicom_index.sqlite');
+
+tags=['SeriesInstanceUID','ImagePositionPatient','ImageOrientationPatient','PixelSpacing','SliceThickness','RescaleSlope','RescaleIntercept','Rows','Columns'];
+
+def _pydicom(): # {{{
+  try:
+    import dicom as pydicom; # pydicom < 1.0
+  except ImportError:
+    import pydicom;
+  return pydicom;
+# }}}
+
+def read_slice(fn, pydicom=None): # {{{
+  """ The placement of one DICOM image file, as a dict, without its pixel data; None if it isn't an image """
+  if pydicom is None:
+    pydicom=_pydicom();
+  try:
+    if pydicom.__name__=='dicom':
+      ds=pydicom.read_file(fn,stop_before_pixels=True); # (no specific_tags before 1.0)
+    else:
+      ds=pydicom.read_file(fn,stop_before_pixels=True,specific_tags=tags);
+  except Exception:
+    return None; # not DICOM
+  if not 'ImagePositionPatient' in ds or not 'ImageOrientationPatient' in ds or not 'Rows' in ds:
+    return None;
+  return {
+    'path':fn,
+    'series':str(getattr(ds,'SeriesInstanceUID','')),
+    'position':[float(x) for x in ds.ImagePositionPatient],
+    'orientation':[float(x) for x in ds.ImageOrientationPatient],
+    'spacing':[float(x) for x in getattr(ds,'PixelSpacing',[1,1])],
+    'thickness':float(getattr(ds,'SliceThickness',1) or 1),
+    'slope':float(getattr(ds,'RescaleSlope',1)),
+    'intercept':float(getattr(ds,'RescaleIntercept',0)),
+    'rows':int(ds.Rows),
+    'columns':int(ds.Columns),
+    };
+# }}}
+
+def _normal(s): # {{{
+  o=s['orientation'];
+  return [o[1]*o[5]-o[2]*o[4],o[2]*o[3]-o[0]*o[5],o[0]*o[4]-o[1]*o[3]]; # row cosines x column cosines
+# }}}
+
+def scan_folder(folder): # {{{
+  """ dict of series UID => slices (see read_slice) of the images in a folder, each series sorted along its slice normal """
+  pydicom=_pydicom();
+  series={};
+  for root, subFolders, files in os.walk(folder):
+    subFolders.sort();
+    for f in sorted(files):
+      s=read_slice(os.path.join(root,f),pydicom);
+      if s is not None:
+        series.setdefault(s['series'],[]).append(s);
+  for uid in series:
+    normal=_normal(series[uid][0]);
+    series[uid].sort(key=lambda s: sum(n*p for n,p in zip(normal,s['position'])));
+  return series;
+# }}}
+
+class DicomIndex(object):
+  """
+  Sorted slices of the series in DICOM folders, keyed by absolute path and validated by the folder's signature.
+  """
+
+  def __init__(self, filename=None):
+    if filename is None:
+      filename=default_index;
+    self.filename=filename;
+    self.db=sqlite3.connect(filename,timeout=60);
+    self.db.execute('CREATE TABLE IF NOT EXISTS folders (path TEXT PRIMARY KEY, signature TEXT, series TEXT)');
+    self.db.commit();
+    self._memo={}; # path => (signature, series), for this process
+
+  def close(self):
+    self.db.close();
+
+  def get(self, folder):
+    """ dict of series UID => sorted slices for a folder, scanning it only if it's new or has changed """
+    path=os.path.abspath(folder);
+    sig=signature(path);
+    if path in self._memo and self._memo[path][0]==sig:
+      return self._memo[path][1];
+    row=self.db.execute('SELECT series FROM folders WHERE path=? AND signature=?',(path,sig)).fetchone();
+    if row is not None:
+      series=json.loads(row[0]);
+    else:
+      series=scan_folder(path);
+      with self.db:
+        self.db.execute('INSERT OR REPLACE INTO folders VALUES (?,?,?)',(path,sig,json.dumps(series)));
+    self._memo[path]=(sig,series);
+    return series;
+
+def largest_series(folder, index=None): # {{{
+  """ The sorted slices of the series with the most images in a folder, from index (a DicomIndex) if given, otherwise scanned afresh """
+  series=index.get(folder) if index is not None else scan_folder(folder);
+  if len(series)==0:
+    raise IOError('No DICOM images found in %s' % (folder,));
+  return max([series[uid] for uid in sorted(series)],key=len);
+# }}}
+
+def series_affine(slices): # {{{
+  """ 4x4 LPS affine of a sorted series, from its first and last slices """
+  import numpy as np;
+  first=slices[0];
+  orientation=np.array(first['orientation'],dtype=float);
+  row_cos=orientation[:3];
+  col_cos=orientation[3:];
+  dr,dc=first['spacing']; # row spacing, column spacing
+  ipp=np.array(first['position'],dtype=float);
+  if len(slices)>1:
+    step=(np.array(slices[-1]['position'],dtype=float)-ipp)/(len(slices)-1);
+  else:
+    step=np.cross(row_cos,col_cos)*first['thickness'];
+  affine=np.eye(4);
+  affine[:3,0]=row_cos*dc; # first data axis runs along a row, ie across columns
+  affine[:3,1]=col_cos*dr;
+  affine[:3,2]=step;
+  affine[:3,3]=ipp;
+  return affine;
+# }}}
+
+def read_volume(slices, dtype='float32'): # {{{
+  """ A sorted series as (data[x,y,z], 4x4 LPS affine); the rescaled pixel data is read into one (Fortran-ordered, as NIfTI is) array """
+  import numpy as np;
+  pydicom=_pydicom();
+  data=np.empty((slices[0]['columns'],slices[0]['rows'],len(slices)),dtype=dtype,order='F');
+  for k,s in enumerate(slices):
+    pixels=pydicom.read_file(s['path']).pixel_array.T;
+    if s['slope']!=1 or s['intercept']!=0:
+      pixels=pixels*s['slope']+s['intercept'];
+    data[:,:,k]=pixels;
+  return data,series_affine(slices);
+# }}}
+
+if __name__=='__main__': # {{{
+  index_file=None;
+  folders=[];
+  state=None;
+  for k in sys.argv[1:]:
+    if state is None:
+      if k=='-d':
+        state=k;
+      else:
+        folders.append(k);
+    elif state=='-d':
+      index_file=k;
+      state=None;
+
+  if len(folders)==0:
+    print 'Usage: dicomindex.py [-d index.sqlite] [folder] ...';
+    sys.exit(1);
+  index=DicomIndex(index_file);
+  for folder in folders:
+    series=index.get(folder);
+    print folder;
+    for uid in sorted(series,key=lambda uid: -len(series[uid])):
+      s=series[uid][0];
+      print '  %-64s %4d x %dx%d' % (uid,len(series[uid]),s['columns'],s['rows']);
+  index.close();
+# }}}
@@ -0,0 +1,90 @@
+#!/usr/bin/python
+"""
+The rows of ..._header_info.csv, kept in SQLite keyed by (Patient, Voxel ID), so that adding or updating a
+voxel doesn't mean re-reading and rewriting the whole csv. The csv itself is written from the store, sorted,
+when asked for.
+
+Usage
+-----
+
+    headerstore.py [store] [csv file]
+
+  Write the csv from a store (by default, spectramosaic_prep keeps its store in the .working folder next
+  to the output root).
+
+"""
+
+import os;
+import sys;
+import csv;
+import sqlite3;
+
+columns=['Voxel ID','Patient','State','Time','Gender','Age','TE','location','GM','WM','CSF']; # tissue fractions last (see tissuefractions.py)
+
+def _text(value): # {{{
+  """ A value as the csv module would write it, as unicode for sqlite (header strings are raw bytes) """
+  if isinstance(value,float):
+    value=repr(value);
+  elif value is None:
+    value='';
+  elif not isinstance(value,basestring):
+    value=str(value);
+  if isinstance(value,str):
+    value=value.decode('latin-1');
+  return value;
+# }}}
+
+def sort_key(row): # {{{
+  return 'P:'+row['Patient']+',V:'+row['Voxel ID'];
+# }}}
+
+class HeaderStore(object):
+  """
+  Header info rows, by patient and voxel ID.
+  """
+
+  def __init__(self, filename, csv_file=None):
+    """ Open (or create) a store; a new store is seeded with the rows of csv_file, if it exists """
+    self.filename=filename;
+    self.db=sqlite3.connect(filename,timeout=60);
+    self.db.execute('CREATE TABLE IF NOT EXISTS rows (%s, PRIMARY KEY (patient, voxel))' % (', '.join(['patient TEXT','voxel TEXT']+['c%d TEXT' % (i,) for i in range(len(columns))]),));
+    known=set(r[1] for r in self.db.execute('PRAGMA table_info(rows)'));
+    for i in range(len(columns)):
+      if not 'c%d' % (i,) in known: # a store from before the column was added
+        self.db.execute("ALTER TABLE rows ADD COLUMN c%d TEXT DEFAULT ''" % (i,));
+    self.db.commit();
+    if csv_file is not None and os.path.exists(csv_file) and self.db.execute('SELECT COUNT(*) FROM rows').fetchone()[0]==0:
+      with open(csv_file,'rb') as f:
+        self.put(csv.DictReader(f,delimiter=';'));
+
+  def close(self):
+    self.db.close();
+
+  def put(self, rows):
+    """ Add or replace rows (dicts of column => value), in one transaction """
+    with self.db:
+      for row in rows:
+        values=[_text(row['Patient']),_text(row['Voxel ID'])]+[_text(row.get(c)) for c in columns];
+        self.db.execute('INSERT OR REPLACE INTO rows VALUES (%s)' % (','.join(['?']*len(values)),),values);
+
+  def rows(self):
+    """ All rows, sorted by patient and voxel ID """
+    rows=[dict(zip(columns,[v.encode('latin-1') for v in r])) for r in self.db.execute('SELECT %s FROM rows' % (', '.join(['c%d' % (i,) for i in range(len(columns))]),))];
+    return sorted(rows,key=sort_key);
+
+  def write_csv(self, csv_file):
+    """ Write the sorted csv, atomically """
+    tmp='%s.%d.tmp' % (csv_file,os.getpid());
+    with open(tmp,'wb') as f:
+      hwriter=csv.DictWriter(f,columns,delimiter=';');
+      hwriter.writeheader();
+      for row in self.rows():
+        hwriter.writerow(row);
+    os.rename(tmp,csv_file);
+    return csv_file;
+
+if __name__=='__main__':
+  if len(sys.argv)!=3:
+    print 'Usage: headerstore.py [store] [csv file]';
+    sys.exit(1);
+  print HeaderStore(sys.argv[1]).write_csv(sys.argv[2]);
@@ -0,0 +1,109 @@
+#!/usr/bin/python
+"""
+Minimal dependency-graph job scheduler, used to run independent prep steps on a process pool.
+
+Jobs are plain module-level functions (so that they can be pickled across to worker processes)
+with positional arguments and a list of jobs that must complete first.
+"""
+
+import sys;
+import traceback;
+from collections import OrderedDict;
+
+def _run_job(func, args): # {{{
+  """ Worker-side wrapper: python2's apply_async has no error callback, so exceptions are returned as values """
+  try:
+    return ('ok', func(*args));
+  except Exception:
+    return ('error', traceback.format_exc());
+# }}}
+
+class JobFailed(Exception):
+  pass;
+
+class JobGraph(object):
+  """
+  A set of named jobs, each of which may depend on any previously added jobs.
+  """
+
+  def __init__(self):
+    self.jobs=OrderedDict();
+    self.results={};
+
+  def add(self, name, func, args=(), deps=()):
+    if name in self.jobs:
+      raise ValueError('Duplicate job name: %s' % (name,));
+    deps=[d for d in deps if d is not None];
+    for d in deps:
+      if not d in self.jobs:
+        raise ValueError('Job %s depends on unknown job %s' % (name,d));
+    self.jobs[name]=(func,tuple(args),deps);
+    return name;
+
+  def run(self, njobs=1, on_done=None):
+    """ Run all jobs, honouring dependencies; njobs>1 uses a multiprocessing pool. Returns a dict of results by job name.
+
+    on_done, if given, is called (in this process) as on_done(name, result) as each job succeeds.
+    """
+    if njobs is None or njobs<=1:
+      # insertion order is always a valid topological order, as deps must exist when a job is added
+      for name in self.jobs:
+        func,args,deps=self.jobs[name];
+        self.results[name]=func(*args);
+        if on_done is not None:
+          on_done(name,self.results[name]);
+      return self.results;
+
+    import multiprocessing;
+    import Queue;
+
+    finished=Queue.Queue();
+    pending=OrderedDict(self.jobs);
+    running=set();
+    failures=[];
+
+    pool=multiprocessing.Pool(njobs);
+    try:
+      while pending or running:
+        if not failures:
+          for name in list(pending):
+            func,args,deps=pending[name];
+            if all(d in self.results for d in deps):
+              del pending[name];
+              running.add(name);
+              pool.apply_async(_run_job,(func,args),callback=lambda r,name=name: finished.put((name,r)));
+        else:
+          pending.clear(); # don't start anything new once something has gone wrong
+
+        if not running:
+          break;
+
+        # poll with a timeout, so that KeyboardInterrupt gets a look in
+        while True:
+          try:
+            name,(status,value)=finished.get(timeout=1);
+            break;
+          except Queue.Empty:
+            pass;
+        running.discard(name);
+        if status=='ok':
+          self.results[name]=value;
+          if on_done is not None:
+            on_done(name,value);
+        else:
+          sys.stderr.write('Job %s failed:\n%s\n' % (name,value));
+          failures.append(name);
+      pool.close();
+    except:
+      pool.terminate();
+      raise;
+    finally:
+      pool.join();
+
+    if failures:
+      raise JobFailed('%d job(s) failed: %s' % (len(failures),', '.join(failures)));
+
+    if pending:
+      raise JobFailed('Unable to schedule jobs: %s' % (', '.join(pending),));
+
+    return self.results;
@@ -0,0 +1,42 @@
+#!/usr/bin/python
+"""
+Stand-in for a MATLAB mask worker (see maskworkers.py), for testing without MATLAB.
+
+Reads the same commands from stdin as the matlab worker is sent, and for each gemask(...) call creates
+(empty) volume.nii and <shortname>_mask.nii files in the nominated output folder, as gemask.m would.
+
+If SPECTRAMOSAIC_STUB_EXIT_AFTER is set, the worker exits abruptly after that many jobs, so that
+worker restarts can be exercised.
+"""
+
+import os;
+import re;
+import sys;
+
+def parse_strings(text):
+  return [s.replace("''","'") for s in re.findall(r"'((?:[^']|'')*)'",text)];
+
+if __name__=='__main__':
+  exit_after=int(os.environ.get('SPECTRAMOSAIC_STUB_EXIT_AFTER','0'));
+  njobs=0;
+  for line in iter(sys.stdin.readline,''):
+    line=line.strip();
+    if line.startswith('exit'):
+      break;
+    m=re.search(r"gemask\((.*?)\); catch",line);
+    if m:
+      args=parse_strings(m.group(1));
+      njobs+=1;
+      if exit_after>0 and njobs>exit_after:
+        os._exit(1);
+      print 'stub gemask(%s)' % (', '.join(args),);
+      if 'output_folder' in args:
+        fn=args[0];
+        output_folder=args[args.index('output_folder')+1];
+        shortname=re.sub('\.7$','',os.path.basename(fn));
+        for out in ['volume.nii','%s_mask.nii' % (shortname,)]:
+          open(os.path.join(output_folder,out),'a').close();
+    m=re.search(r"disp\(('(?:[^']|'')*')\);\s*$",line);
+    if m:
+      print parse_strings(m.group(1))[0];
+    sys.stdout.flush();
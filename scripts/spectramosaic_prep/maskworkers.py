@@ -0,0 +1,198 @@
+#!/usr/bin/python
+"""
+Long-lived mask generation workers, so that MATLAB start-up is paid once per worker rather than once per voxel.
+
+Workers are one of:
+
+  engine : a MATLAB session through the MATLAB Engine API for Python (matlab.engine), if installed
+  matlab : a `matlab -nodisplay -nosplash -nojvm` process, driven a line at a time over stdin
+  stub   : mask_stub_worker.py, which speaks the same stdin protocol as the matlab worker but only
+           creates the expected output files; for testing without MATLAB
+
+Either way, addpath is done once, when the worker starts, and a worker which dies (or times out) is
+restarted and the job retried once. MaskWorkerPool is thread-safe; to share one between processes,
+use shared_pool().
+"""
+
+import os;
+import re;
+import sys;
+import threading;
+import subprocess;
+import Queue;
+from multiprocessing.managers import BaseManager;
+
+where_am_i=os.path.dirname(os.path.realpath(__file__));
+
+class WorkerDied(Exception):
+  pass;
+
+def matlab_string(s):
+  return "'%s'" % (str(s).replace("'","''"),);
+
+class StdinWorker(object):
+  """ A MATLAB (or stand-in) process, fed commands over stdin; each job ends by printing a sentinel line. """
+
+  def __init__(self, cmd, env=None, timeout=None):
+    self.timeout=timeout;
+    self.njobs=0;
+    self.proc=subprocess.Popen(cmd, stdout=subprocess.PIPE, stdin=subprocess.PIPE, stderr=subprocess.STDOUT, env=env, bufsize=1);
+    self.lines=Queue.Queue();
+    t=threading.Thread(target=self._read);
+    t.daemon=True;
+    t.start();
+    self.send("addpath(%s);" % (matlab_string(where_am_i),));
+
+  def _read(self):
+    for line in iter(self.proc.stdout.readline,''):
+      self.lines.put(line);
+    self.lines.put(None); # EOF: the process has gone
+
+  def send(self, command):
+    try:
+      self.proc.stdin.write(command+'\n');
+      self.proc.stdin.flush();
+    except (IOError,OSError):
+      raise WorkerDied('Mask worker (pid %d) is not accepting commands' % (self.proc.pid,));
+
+  def run(self, args):
+    """ Run gemask(args...), returning its output """
+    self.njobs+=1;
+    sentinel='@@spectramosaic done %d@@' % (self.njobs,);
+    self.send("try, gemask(%s); catch err, disp(err.message); end; disp(%s);" % (','.join(matlab_string(a) for a in args),matlab_string(sentinel)));
+    output=[];
+    while True:
+      try:
+        line=self.lines.get(timeout=self.timeout);
+      except Queue.Empty:
+        self.close();
+        raise WorkerDied('Mask worker (pid %d) timed out after %s s' % (self.proc.pid,self.timeout));
+      if line is None:
+        raise WorkerDied('Mask worker (pid %d) exited with %s' % (self.proc.pid,self.proc.wait()));
+      if line.strip().endswith(sentinel):
+        return ''.join(output);
+      output.append(line);
+
+  def close(self):
+    if self.proc.poll() is None:
+      try:
+        self.send('exit;');
+        self.proc.stdin.close();
+      except (WorkerDied,IOError,OSError):
+        pass;
+      if self.proc.poll() is None:
+        self.proc.kill();
+    self.proc.wait();
+
+class EngineWorker(object):
+  """ A MATLAB session through matlab.engine; each job runs in the background, so it can be timed out """
+
+  def __init__(self, timeout=None):
+    import matlab.engine;
+    self.timeout=timeout;
+    self.eng=matlab.engine.start_matlab('-nojvm -nodisplay');
+    self.eng.addpath(where_am_i,nargout=0);
+
+  def run(self, args):
+    import StringIO;
+    import matlab.engine;
+    out=StringIO.StringIO();
+    try:
+      future=self.eng.gemask(*[str(a) for a in args],nargout=0,stdout=out,stderr=out,background=True);
+      future.result(timeout=self.timeout);
+    except matlab.engine.TimeoutError:
+      self.close();
+      raise WorkerDied('Mask worker (MATLAB engine) timed out after %s s' % (self.timeout,));
+    except Exception as e:
+      if 'terminated' in str(e).lower(): # matlab.engine.EngineError, once the session has gone
+        raise WorkerDied(str(e));
+      out.write(str(e)+'\n');
+    return out.getvalue();
+
+  def close(self):
+    try:
+      self.eng.quit();
+    except Exception:
+      pass;
+
+def default_kind(): # {{{
+  try:
+    import matlab.engine;
+    return 'engine';
+  except ImportError:
+    pass;
+  for d in os.environ.get('PATH','').split(os.pathsep):
+    if os.access(os.path.join(d,'matlab'),os.X_OK):
+      return 'matlab';
+  raise Exception('Mask workers need MATLAB (or matlab.engine); the stub worker can stand in for testing.');
+# }}}
+
+class MaskWorkerPool(object):
+  """
+  A fixed number of warm mask generation workers.
+  """
+
+  def __init__(self, nworkers=1, kind=None, timeout=None):
+    if kind is None:
+      kind=default_kind();
+    if not kind in ['engine','matlab','stub']:
+      raise ValueError('Unknown kind of mask worker: %s' % (kind,));
+    self.kind=kind;
+    self.timeout=timeout;
+    self.restarts=0;
+    self.idle=Queue.Queue();
+    self.workers=[];
+    for i in range(nworkers):
+      self.idle.put(self._start());
+
+  def _start(self):
+    if self.kind=='engine':
+      w=EngineWorker(self.timeout);
+    else:
+      env=os.environ.copy();
+      env['DISPLAY']='';
+      if self.kind=='matlab':
+        cmd=['matlab','-nodisplay','-nosplash','-nojvm'];
+      else:
+        cmd=[sys.executable,'-u',os.path.join(where_am_i,'mask_stub_worker.py')];
+      w=StdinWorker(cmd,env=env,timeout=self.timeout);
+    self.workers.append(w);
+    return w;
+
+  def makemask(self, *args):
+    """ Run gemask(args...) on the next free worker; returns its output """
+    w=self.idle.get();
+    try:
+      if w is None:
+        w=self._start(); # its last restart failed
+      for attempt in [1,2]:
+        try:
+          return w.run(args);
+        except WorkerDied as e:
+          sys.stderr.write('%s; restarting it.\n' % (e,));
+          w.close();
+          self.workers.remove(w);
+          w=None;
+          self.restarts+=1;
+          w=self._start();
+          if attempt==2:
+            raise;
+    finally:
+      self.idle.put(w); # None, if it couldn't be restarted: the next job tries again, rather than getting a closed worker
+
+  def close(self):
+    for w in self.workers:
+      w.close();
+    self.workers=[];
+
+class MaskPoolManager(BaseManager):
+  pass;
+
+MaskPoolManager.register('MaskWorkerPool',MaskWorkerPool);
+
+def shared_pool(nworkers=1, kind=None, timeout=None): # {{{
+  """ Start a MaskWorkerPool in a manager process; returns (manager, proxy). The proxy may be passed to other processes. """
+  manager=MaskPoolManager();
+  manager.start();
+  return manager,manager.MaskWorkerPool(nworkers,kind,timeout);
+# }}}
@@ -6,11 +6,20 @@ import re;
 import numpy as np;
 import math as m;
 import sys;
+import glob;
+import hashlib;
+import threading;
+import Queue;
+import itertools;
+from collections import OrderedDict;
 
 from PIL import Image, ImageDraw, ImageFont;  # pip install Pillow
 import cv2; # pip install opencv-python
 import scipy.ndimage; # pip install scipy
 
+from stagetimer import stage;
+from voxelmask import box_axes;
+
 
 def merge_folder(p):
   grouped={'all':{'volume':None,'masks':[]}};
@@ -53,7 +62,7 @@ def merge_folder(p):
 
       structural=os.path.join(p,root,grouped[root]['volume']);
 
-      if 'tissuemasks' in grouped[root]:
+      if 'tissuemask' in grouped[root]:
         for tc in grouped[root]['tissuemask']:
           tissuemasks[tc]=os.path.join(p,root,grouped[root]['tissuemask'][tc]);
 
@@ -67,7 +76,359 @@ def merge_folder(p):
     print(tissuemasks);
     merge_masks(structural,masks,tissuemask=tissuemasks,output_folder=output_folder);
 
-def merge_masks(structural, masks, ofn_base=None, tissuemask=None, output_folder=None, mode=None):
+axkey=['sag','cor','ax'];
+all_modes=['spectramosaic', 'percentiles','solidfill','solidfill_nopercentile','box_only','gradfill','c1','c2','c3'];
+
+def _ramp(a,b,c,d):
+  return d-c*np.concatenate((np.zeros((a)), np.linspace(0,1,256-(a+b)), np.ones((b))));
+
+def mode_style(mode, zoomfactor): # {{{
+  """ Rendering settings for a mode: border colour, fill, intensity downweighting by mask value, and which outlines to draw """
+  style={'do_percentiles':True,'do_rectangle':True,'rec_linewidth':zoomfactor,'downweight':None,'gradient':None,'tissue':None};
+
+  if mode=='spectramosaic':
+    style.update(bc=[255,0,255],do_percentiles=False,rec_linewidth=5,downweight=_ramp(50,5,0.1,0.9));
+    style['fill']=[x/3 for x in style['bc']];
+  elif mode=='percentiles': # 0
+    style.update(bc=[255,128,0],fill=[0,0,0]);
+  elif mode in ['solidfill']: # 1
+    style.update(bc=[255,0,255],fill=[x/5 for x in [255,0,255]]);
+  elif mode=='solidfill_nopercentile':
+    style.update(bc=[255,128,0],rec_linewidth=7,do_percentiles=False,downweight=_ramp(50,5,0.1,0.9));
+    style['fill']=[x/3 for x in style['bc']];
+  elif mode in ['c1','c2','c3']: # tissue class segmentation
+    style.update(bc=[255,128,0],do_percentiles=False,downweight=_ramp(50,5,0.75,0.9),tissue=mode);
+    style['fill']={'c1':[0,0,255],'c2':[0,255,0],'c3':[255,0,0]}[mode];
+  elif mode=='box_only':
+    style.update(bc=[255,128,0],fill=[0,0,0],do_percentiles=False,rec_linewidth=(zoomfactor*2)-1);
+  elif mode=='gradfill':
+    gscale=0.5;
+    grad_r=gscale*np.concatenate(( np.zeros((5)), np.linspace(0,255,10), 255*np.ones((118)),         np.linspace(255,0,50),    np.zeros((73)) ))
+    grad_g=gscale*np.concatenate(( np.zeros((5)), np.zeros((10))       , np.linspace(0,128,118), np.linspace(128,154,50), 154*np.ones((73)) ))
+    grad_b=gscale*np.concatenate(( np.zeros((5)), np.zeros((10))       , np.zeros((118)),        np.linspace(0,128,50),   np.linspace(128,0,73) ))
+    style.update(do_rectangle=False,gradient=np.column_stack((grad_r,grad_g,grad_b)),downweight=1-0.3*np.concatenate((np.zeros((50)), np.linspace(0,1,256-(50+5)), np.ones((5)))));
+  else:
+    raise ValueError('Unknown rendering mode: %s' % (mode,));
+
+  if style['downweight'] is None:
+    style['downweight']=np.array([1.]*256);
+  return style;
+# }}}
+
+def equalise(image_slice): # {{{
+  """ Histogram-equalised (0-225) version of a structural slice """
+# http://opencvpython.blogspot.no/2013/03/histograms-2-histogram-equalization.html
+  bg=((255.*image_slice)/max(image_slice.flat)) #.astype('uint8');
+  hist,bins = np.histogram(bg.flatten(),256,[20,256])
+  cdf = hist.cumsum()
+  cdf_m = np.ma.masked_equal(cdf,0)
+  cdf_m = (cdf_m - cdf_m.min())*225/(cdf_m.max()-cdf_m.min())
+  cdf = np.ma.filled(cdf_m,0).astype('uint8')
+  return cdf[bg.astype('uint8')]
+# }}}
+
+def composite(image_normalised, mask_normalised, style, tissue_normalised=None): # {{{
+  """ RGB (HxWx3 float, 0-255) of a slice with its mask overlaid, in one array operation """
+  if style['gradient'] is not None:
+    mask_ui=mask_normalised.astype('uint8');
+    return np.clip(style['downweight'][mask_ui][...,None]*image_normalised[...,None]+style['gradient'][mask_ui],0,255);
+
+  use_mask=mask_normalised;
+  if style['tissue'] is not None:
+    use_mask=tissue_normalised*mask_normalised/255.;
+  use_mask_ui=use_mask.astype('uint8');
+  fill=np.array(style['fill'],dtype=float);
+  return np.clip(style['downweight'][use_mask_ui][...,None]*image_normalised[...,None]+(fill*use_mask[...,None])/255.0,0,255);
+# }}}
+
+def percentile_contours(mask_ui): # {{{
+  """ [(contours, hierarchy, colouring, linewidth)] of the 5/50/95% levels of a (0-255) mask """
+  contour_colouring={0.05:[1,0,0,1],.5:[1,.5,0,2],.95:[0,.6,0,3]}
+  levels=[];
+  for th in contour_colouring:
+    colouring=[int(255*x) for x in contour_colouring[th]];
+    lw=contour_colouring[th][3];
+    ret,threshC = cv2.threshold(mask_ui,int(th*255.0),255,0)
+# also has offset!
+    found=cv2.findContours(threshC,method=cv2.CHAIN_APPROX_TC89_KCOS,mode=cv2.RETR_EXTERNAL);
+    contours2,hierarchy2=found[-2:];
+    if len(contours2)==0:
+      continue;
+# http://stackoverflow.com/questions/8461612/using-hierarchy-in-findcontours-in-opencv
+    levels.append((contours2,hierarchy2[0],colouring,lw));
+  return levels;
+# }}}
+
+def nonzero_extent(img, chunk=16): # {{{
+  """ Bounding box (tuple of slices) of an image's non-zero voxels, reading it a slab of `chunk` slices at a time; None if it's all zero """
+  shape=img.shape[:3];
+  lo=[None]*3;
+  hi=[None]*3;
+  for k in range(0,shape[2],chunk):
+    slab=np.asarray(img.dataobj[:,:,k:k+chunk]);
+    for d,other in enumerate([(1,2),(0,2),(0,1)]):
+      nz=np.flatnonzero(slab.any(axis=other));
+      if len(nz)==0:
+        break;
+      first,last=nz[0],nz[-1];
+      if d==2:
+        first+=k; last+=k;
+      lo[d]=first if lo[d] is None else min(lo[d],first);
+      hi[d]=last+1 if hi[d] is None else max(hi[d],last+1);
+  if lo[0] is None:
+    return None;
+  return tuple(slice(a,b) for a,b in zip(lo,hi));
+# }}}
+
+def take_slice(img, index, axis): # {{{
+  """ np.take(img.get_data(), index, axis), reading only that slice from disk """
+  slicer=[slice(None)]*3;
+  slicer[axis]=index;
+  return np.asarray(img.dataobj[tuple(slicer)]);
+# }}}
+
+_slice_cache=OrderedDict(); # (structural, signature, zoomfactor, axis, index) => equalised, zoomed slice; most recent last
+slice_cache_size=64;
+
+def structural_slice(structural, img, axis, index, zoomfactor): # {{{
+  """ The equalised, zoomed slice of a structural volume (img, as loaded from the file structural).
+
+  Slices are kept in memory for the life of the process, and on disk in a .slicecache folder next to the
+  volume, so that all the voxels of a session (in any process, and in later runs) share them. Both are
+  keyed on the volume's size and mtime, so are dropped once the volume is rewritten.
+  """
+  st=os.stat(structural);
+  key=(os.path.abspath(structural),'%d:%.6f' % (st.st_size,st.st_mtime),zoomfactor,axis,index);
+  if key in _slice_cache:
+    _slice_cache[key]=_slice_cache.pop(key);
+    return _slice_cache[key];
+
+  folder=os.path.join(os.path.dirname(key[0]),'.slicecache');
+  tag=hashlib.sha1(repr(key[:3])).hexdigest()[:12];
+  fn=os.path.join(folder,'%s.%s.%d.%d.npy' % (os.path.basename(structural),tag,axis,index));
+  data=None;
+  if os.path.exists(fn):
+    try:
+      data=np.load(fn);
+    except (IOError,ValueError):
+      pass; # damaged; recompute
+  if data is None:
+    data=equalise(scipy.ndimage.zoom(take_slice(img,index,axis),zoomfactor,order=1));
+    try:
+      if not os.path.isdir(folder):
+        os.makedirs(folder);
+      for old in glob.glob(os.path.join(folder,'%s.*.npy' % (os.path.basename(structural),))):
+        if old.split('.')[-4]!=tag: # from an earlier version of the volume
+          os.remove(old);
+      tmp='%s.%d.tmp' % (fn,os.getpid());
+      with open(tmp,'wb') as f:
+        np.save(f,data);
+      os.rename(tmp,fn);
+    except (IOError,OSError):
+      pass; # another process got there first, or nowhere to write: the cache is only an optimisation
+
+  _slice_cache[key]=data;
+  while len(_slice_cache)>slice_cache_size:
+    _slice_cache.popitem(last=False);
+  return data;
+# }}}
+
+def read_masks(masks): # {{{
+  """ (extent, data) of the sum of a list of mask files, where extent is the bounding box (tuple of slices) of all their non-zero voxels, and data is the sum within it """
+  mask_imgs=[nib.load(mask) for mask in masks];
+  extents=[nonzero_extent(mim) for mim in mask_imgs];
+  extents=[e for e in extents if e is not None];
+  if len(extents)==0:
+    raise ValueError('Nothing to render: the mask(s) are empty: %s' % (', '.join(masks),));
+  mask_extent=tuple(slice(min(e[d].start for e in extents),max(e[d].stop for e in extents)) for d in range(3));
+  mask_merged=np.zeros([b.stop-b.start for b in mask_extent]);
+  for mim in mask_imgs:
+    mask_merged=mask_merged+np.asarray(mim.dataobj[mask_extent]);
+  return mask_extent,mask_merged;
+# }}}
+
+def mask_centre(mask_merged, mask_extent, shape): # {{{
+  """ Centre of mass of a mask (as from read_masks), in the volume; moved off the midline, where the slice is not very interesting """
+  com=[c+b.start for c,b in zip(scipy.ndimage.center_of_mass(mask_merged),mask_extent)];
+  if abs(com[0]-(shape[0]/2))<3: # midline! shift it a bit to get a more interesting slice
+    com[0]-=7;
+  return com;
+# }}}
+
+def mask_slice(mask_merged, mask_extent, shape, axis, index): # {{{
+  """ Full-size slice of a mask held within its extent """
+  data=np.zeros([shape[d] for d in range(3) if d!=axis]);
+  if mask_extent[axis].start<=index<mask_extent[axis].stop:
+    data[tuple(mask_extent[d] for d in range(3) if d!=axis)]=np.take(mask_merged,index-mask_extent[axis].start,axis=axis);
+  return data;
+# }}}
+
+backends=['pil','cv2'];
+render_chunk=8; # voxels composited together by render_voxels
+
+class ImageWriter(object):
+  """
+  PNG encoding and writing of rendered images (PIL images, or uint8 BGR arrays from the cv2 backend), on
+  nthreads background threads, so that encoding overlaps with rendering the next image; nthreads=0 writes
+  each image straight away. level is the zlib compression level (0-9; lower is faster, and larger), or
+  None for the library's default.
+  """
+
+  def __init__(self, nthreads=0, level=None):
+    self.level=level;
+    self.errors=[];
+    self.queue=Queue.Queue(maxsize=4*max(nthreads,1)); # bounds the images held in memory
+    self.threads=[];
+    for i in range(nthreads):
+      t=threading.Thread(target=self._run);
+      t.daemon=True;
+      t.start();
+      self.threads.append(t);
+
+  def _save(self, ofn, img):
+    if isinstance(img,np.ndarray):
+      cv2.imwrite(ofn,img,[] if self.level is None else [cv2.IMWRITE_PNG_COMPRESSION,self.level]);
+    elif self.level is None:
+      img.save(ofn);
+    else:
+      img.save(ofn,compress_level=self.level);
+
+  def _run(self):
+    while True:
+      item=self.queue.get();
+      if item is None:
+        return;
+      try:
+        self._save(*item);
+      except Exception as e:
+        self.errors.append('%s: %s' % (item[0],e));
+
+  def write(self, ofn, img):
+    if len(self.threads)==0:
+      self._save(ofn,img);
+    else:
+      self.queue.put((ofn,img));
+
+  def close(self):
+    """ Wait for all queued images to be written; raises IOError if any couldn't be """
+    for t in self.threads:
+      self.queue.put(None);
+    for t in self.threads:
+      t.join();
+    self.threads=[];
+    if self.errors:
+      raise IOError('Failed to write %d image(s): %s' % (len(self.errors),'; '.join(self.errors)));
+
+def write_rect(rect_fn, rect): # {{{
+  with open(rect_fn,'w') as rf:
+    rf.write('%.2f;%.2f;%.2f;%.2f;%.2f' % (rect[0][0],rect[0][1],rect[1][0],rect[1][1],rect[2]));
+# }}}
+
+def draw_percentiles(img, levels): # {{{
+  """ Draw percentile contours (from percentile_contours) onto an HxWx3 array, in place; colours are used as given, in the array's channel order (callers drawing onto BGR pass them reversed) """
+  for contours2,hierarchy2,colouring,lw in levels:
+    for ci in range(0,len(contours2)):
+      if hierarchy2[ci][3]==-1: # outer contour, explicit colouring
+        cv2.drawContours(img,contours2,ci,tuple(colouring[0:3]),lw);
+# }}}
+
+def decorate(rgb, style, rects, levels, zoomfactor, rect_fn, ofn, label='', backend='pil', writer=None): # {{{
+  """ Draw percentile contours (levels, from percentile_contours) and voxel outlines (rects, from cv2.minAreaRect) onto a composited slice, as its mode's style says, rotate it, and save it as ofn (through writer, an ImageWriter, if given).
+
+  The outline of each rectangle is also written to rect_fn. With backend='cv2', rgb must be an HxWx3 uint8
+  array in BGR order (see to_buffer), which is drawn on in place, and encoded directly; outlines are then
+  drawn by cv2.polylines rather than PIL, so differ slightly.
+  """
+  if writer is None:
+    writer=ImageWriter();
+  if backend=='cv2':
+    return decorate_buffer(rgb,style,rects,levels,zoomfactor,rect_fn,ofn,label,writer);
+
+  if style['do_percentiles']: # highlight percentiles {{{
+    print('%s : including percentiles' % (label,))
+    draw_percentiles(rgb,levels);
+  #  }}}
+
+  cim=Image.fromarray(rgb.astype('uint8'),'RGB');
+
+  if style['do_rectangle']: # {{{
+    print('%s : including "rectangular" voxel outline' % (label,))
+    rec_linewidth=style['rec_linewidth'];
+    # we wish to draw nice, non-blocky boxes around these things. use cv2 to find contours and generate bounding rectangles for plotting:
+    draw=ImageDraw.Draw(cim);
+    for rect in rects:
+      write_rect(rect_fn,rect);
+      ox=rect[0][0]
+      oy=rect[0][1]
+      shrinkage=(zoomfactor+rec_linewidth)/2
+      lx=rect[1][0]-shrinkage
+      ly=rect[1][1]-shrinkage
+      rot=-rect[2]*2.*m.pi/360;
+      rm=np.array([[m.cos(rot),-m.sin(rot)],[m.sin(rot),m.cos(rot)]])
+
+      x1=0-lx/2; x2=0+lx/2; y1=0-ly/2; y2=0+ly/2;
+      box=np.array([[x1,y1],[x1,y2],[x2,y2],[x2,y1],[x1,y1]]);
+      box=box.dot(rm)+[ox,oy];
+
+      pts=tuple(map(tuple, box))
+      draw.line(pts, fill=tuple(style['bc']), width=rec_linewidth)
+  # }}}
+
+  writer.write(ofn,cim.rotate(90,expand=True));
+# }}}
+
+def to_buffer(rgb, out=None): # {{{
+  """ A composited (float, RGB, ...xHxWx3) image as a uint8 BGR buffer, for the cv2 backend; out may be a buffer to re-use """
+  if out is None or out.shape!=rgb.shape:
+    out=np.empty(rgb.shape,dtype=np.uint8);
+  np.copyto(out,rgb[...,::-1],casting='unsafe'); # truncates, like astype
+  return out;
+# }}}
+
+def decorate_buffer(buf, style, rects, levels, zoomfactor, rect_fn, ofn, label='', writer=None): # {{{
+  """ decorate, for the cv2 backend: one drawing call per contour or box, straight onto the BGR buffer, which is then encoded as it is """
+  if writer is None:
+    writer=ImageWriter();
+  if style['do_percentiles']:
+    print('%s : including percentiles' % (label,))
+    draw_percentiles(buf,[(contours2,hierarchy2,colouring[2::-1],lw) for contours2,hierarchy2,colouring,lw in levels]);
+
+  if style['do_rectangle']:
+    print('%s : including "rectangular" voxel outline' % (label,))
+    rec_linewidth=style['rec_linewidth'];
+    shrinkage=(zoomfactor+rec_linewidth)/2;
+    boxes=[];
+    for rect in rects:
+      write_rect(rect_fn,rect);
+      box=cv2.boxPoints((rect[0],(rect[1][0]-shrinkage,rect[1][1]-shrinkage),rect[2]));
+      boxes.append(np.round(box*16).astype(np.int32)); # 4 bits of sub-pixel precision
+    if boxes:
+      cv2.polylines(buf,boxes,True,tuple(style['bc'][::-1]),rec_linewidth,cv2.LINE_8,4);
+
+  writer.write(ofn,np.ascontiguousarray(np.rot90(buf))); # a copy, so buf may be re-used straight away
+# }}}
+
+def mask_rects(mask_ui): # {{{
+  """ cv2.minAreaRect of each outline of a (0-255) mask slice """
+  ret,thresh=cv2.threshold(mask_ui,20,255,0);
+  contours=cv2.findContours(thresh, 1, 2)[-2];
+  return [cv2.minAreaRect(cn) for cn in contours];
+# }}}
+
+def mask_prefix(mask): # {{{
+  return re.sub('(\.7|_mask\.nii)$','',os.path.basename(mask))+'_mask_';
+# }}}
+
+def merge_masks(structural, masks, ofn_base=None, tissuemask=None, output_folder=None, mode=None, backend='pil', writer=None):
+  """ Render the (merged) masks over the structural, through the masks' centre of mass, in each of the given mode(s), or all modes.
+
+  backend is 'pil' or 'cv2' (see decorate). Images are written through writer, if given (see ImageWriter;
+  the caller then closes it), otherwise as they are drawn.
+
+  Each axis' slices are extracted, zoomed and equalised once, and shared by all modes. Only the three slices
+  through the centre of mass are read from the structural and tissue volumes, and the masks are merged
+  within their bounding box, so memory use is a few slices' worth rather than several whole volumes.
+  """
   dbg=False;
 
   if structural is None:
@@ -85,319 +446,275 @@ def merge_masks(structural, masks, ofn_base=None, tissuemask=None, output_folder
 
   zoomfactor=4;
 
-  base=nib.load(structural);
-  base_data=np.array(base.get_data());
+  base=nib.load(structural); # volumes are read through their dataobj proxies, a slab or slice at a time
+  shape=base.shape[:3];
   if dbg:
-    print(base_data.shape);
-
-  mask_merged=np.zeros(base_data.shape);
+    print(shape);
 
   if isinstance(masks,basestring):
     masks=[masks]; # only one mask specified, as a string.
 
   single=len(masks)==1;
 
-  for mask in masks:
-    if dbg:
-      print(mask);
-    mim=nib.load(mask);
-    mask_data=np.array(mim.get_data());
-    mask_merged=mask_merged+mask_data;
-    if dbg:
-      print(mask_data.shape);
-
-  if dbg:
-    print(base)
-    print(base.get_affine())
-    print(base.get_header())
+  # the merged mask is only held within the bounding box of all the masks
+  mask_extent,mask_merged=read_masks(masks);
 
   # mask_img=nib.Nifti1Image((100.0*mask_merged.astype('float')/(255.0*len(masks))),base.get_affine(),base.get_header())
-  # mask_scaled=np.clip(mask_merged.astype(float)/(2.55*len(masks)),0,1);
-  mask_scaled=np.clip(mask_merged.astype(float)/(2.55*len(masks)),0,100).astype('uint8');
+  mask_scaled=np.zeros(shape,dtype='uint8');
+  mask_scaled[mask_extent]=np.clip(mask_merged.astype(float)/(2.55*len(masks)),0,100).astype('uint8');
   nh=base.get_header();
   nh['cal_min']=5;
   nh['cal_max']=100;
 
-  if dbg:
-    print(nh);
-
   mask_img=nib.Nifti1Image(mask_scaled,base.get_affine(),nh)
   if ofn_base is not None:
     nib.save(mask_img,'%s_prob.nii' % ofn_base);
   else:
     nib.save(mask_img,os.path.join(output_folder,'merged_prob.nii'));
 
-  com=scipy.ndimage.center_of_mass(mask_merged);
-  
-  if dbg:
-    print(com);
-    print(mask_merged.shape)
+  if ofn_base is None:
+    if single:
+      prefix=mask_prefix(masks[0]);
+      print prefix;
+    else:
+      prefix='mask_';
+    ofn_base=os.path.join(output_folder,prefix);
 
-  if abs(com[0]-(mask_merged.shape[0]/2))<3: # midline! shift it a bit to get a more interesting slice
-    if dbg:
-      print('COM shift [0]');
-    com=[x for x in com]; com[0]-=7; 
+  com=mask_centre(mask_merged,mask_extent,shape);
 
+  if dbg:
+    print(com);
+    print(shape)
 
-  datasets={'base':base_data,'mask':mask_merged};
-  slices={};
-  slices_normalised={}
+  datasets={}; # tissue class volumes; the structural's slices come from structural_slice
   if tissuemask is not None and len(tissuemask)==3:
     for mc in ['c1','c2','c3']:
       tmfn=tissuemask['%svolume.nii' % (mc,)];
-      tm=nib.load(tmfn);
-      tm_data=np.array(tm.get_data());
-      datasets[mc]=tm_data;
-  axes=[0,1,2];
-  axkey=['sag','cor','ax'];
-  for ax in axes:
-    slicenum=int(np.floor(com[ax]));
-    for ds in datasets:
-      if dbg:
-        print(ds);
-        print(slicenum)
-      data=datasets[ds];
-      if ax==0:
-        slices[ds]=data[slicenum,:,:];
-      elif ax==1:
-        slices[ds]=data[:,slicenum,:];
-      elif ax==2:
-        slices[ds]=data[:,:,slicenum];
-
-    for ds in datasets:
-      if ds=='image':
-        slices[ds]=scipy.ndimage.zoom(slices[ds], zoomfactor, order=2) 
-      else:
-        slices[ds]=scipy.ndimage.zoom(slices[ds], zoomfactor, order=1) # higher-order interpolations introduce edge artifacts which give peculiar contours.
-      slices_normalised[ds]=slices[ds]*255.0/np.max(slices[ds].flat);
-
-    image_slice=slices['base'];
-    mask_slice=slices['mask'];
-
-    mask_normalised=mask_slice*255.0/np.max(mask_slice.flat);
-    # image_normalised=image_slice*255.0/np.max(image_slice.flat);
-
-# http://opencvpython.blogspot.no/2013/03/histograms-2-histogram-equalization.html
-    bg=((255.*image_slice)/max(image_slice.flat)) #.astype('uint8');
-    hist,bins = np.histogram(bg.flatten(),256,[20,256])
-    cdf = hist.cumsum()
-    cdf_normalized = cdf *hist.max()/ cdf.max() # this line not necessary.
-    cdf_m = np.ma.masked_equal(cdf,0)
-    cdf_m = (cdf_m - cdf_m.min())*225/(cdf_m.max()-cdf_m.min())
-    cdf = np.ma.filled(cdf_m,0).astype('uint8')
-    image_normalised = cdf[bg.astype('uint8')]
-
+      datasets[mc]=nib.load(tmfn);
 
-    mask_ui=mask_normalised.astype('uint8');
-
-    ret,thresh=cv2.threshold(mask_ui,20,255,0);
-    contours,hierarchy = cv2.findContours(thresh, 1, 2)
+  if mode is None:
+    modes=all_modes;
+  else:
+    modes=[mode];
+  styles=dict((x,mode_style(x,zoomfactor)) for x in modes);
 
-    # percentile contours {{{
+  if writer is None:
+    writer=ImageWriter();
+  label=re.sub('_mask_$','',os.path.basename(ofn_base)); # for the stage timings (see stagetimer.py)
 
-    if mode is None:
-      modes=['spectramosaic', 'percentiles','solidfill','solidfill_nopercentile','box_only','gradfill','c1','c2','c3'];
-    else:
-      modes=[mode];
-
-    for mode in modes:
-
-      do_percentiles=True;
-      do_rectangle=True;
-
-      use_mask=mask_normalised;
-      rec_linewidth=zoomfactor;
-
-      downweight=None;
-      if mode=='spectramosaic':
-        bc=[255,0,255];
-        do_rectangle=True;
-        do_percentiles=False;
-        rec_linewidth=5;
-        do_percentiles=False;
-        fill=[x/3 for x in bc];
-        a=50;b=5;c=0.1;d=0.9;
-        downweight=d-c*np.concatenate((np.zeros((a)), np.linspace(0,1,256-(a+b)), np.ones((b))));
-      if mode=='percentiles': # 0
-        bc=[255,128,0];
-        fill=[0,0,0];
-      elif mode in ['solidfill']: # 1
-        bc=[255,0,255];
-        fill=[x/5 for x in bc];
-      elif mode=='solidfill_nopercentile':
-        bc=[255,128,0];
-        rec_linewidth=7;
-        do_percentiles=False;
-        fill=[x/3 for x in bc];
-        a=50;b=5;c=0.1;d=0.9;
-        downweight=d-c*np.concatenate((np.zeros((a)), np.linspace(0,1,256-(a+b)), np.ones((b))));
-      elif mode in ['c1','c2','c3']: # tissue class segmentation
-        if not mode in slices_normalised:
-          continue; # skip tissue class seg.
-        bc=[255,128,0];
-        if mode=='c1':
-          fill=[0,0,255];
-        elif mode=='c2':
-          fill=[0,255,0];
-        elif mode=='c3':
-          fill=[255,0,0];
-        use_mask=slices_normalised[mode]*mask_normalised/255.;
-        do_percentiles=False;
-        a=50;b=5;c=0.75;d=0.9;
-        downweight=d-c*np.concatenate((np.zeros((a)), np.linspace(0,1,256-(a+b)), np.ones((b))));
-      use_mask_ui=use_mask.astype('uint8');
-
-      if mode=='box_only':
-        bc=[255,128,0];
-        fill=[0,0,0];
-        do_percentiles=False;
-        rec_linewidth=(zoomfactor*2)-1;
-
-
-      if mode=='gradfill':
-        do_rectangle=False;
-        gscale=0.5;
-        grad_r=gscale*np.concatenate(( np.zeros((5)), np.linspace(0,255,10), 255*np.ones((118)),         np.linspace(255,0,50),    np.zeros((73)) ))
-        grad_g=gscale*np.concatenate(( np.zeros((5)), np.zeros((10))       , np.linspace(0,128,118), np.linspace(128,154,50), 154*np.ones((73)) ))
-        grad_b=gscale*np.concatenate(( np.zeros((5)), np.zeros((10))       , np.zeros((118)),        np.linspace(0,128,50),   np.linspace(128,0,73) ))
-        a=50;b=5;
-        downweight=1-0.3*np.concatenate((np.zeros((a)), np.linspace(0,1,256-(a+b)), np.ones((b))));
-
-
-        r=np.clip(downweight[mask_ui]*image_normalised+grad_r[mask_ui],0,255);
-        g=np.clip(downweight[mask_ui]*image_normalised+grad_g[mask_ui],0,255);
-        b=np.clip(downweight[mask_ui]*image_normalised+grad_b[mask_ui],0,255);
-
-      else:
-        if downweight is None:
-          downweight=np.array([1.]*256);
-        r=np.clip(downweight[use_mask_ui]*image_normalised+fill[0]*use_mask/255.0,0,255);
-        g=np.clip(downweight[use_mask_ui]*image_normalised+fill[1]*use_mask/255.0,0,255);
-        b=np.clip(downweight[use_mask_ui]*image_normalised+fill[2]*use_mask/255.0,0,255);
-
-      if do_percentiles: # highlight percentiles {{{
-        print('%s : including percentiles' % (mode,))
-
-        contour_colouring={0.05:[1,0,0,1],.5:[1,.5,0,2],.95:[0,.6,0,3]}
-
-        for th in contour_colouring : # {{{
-
-          colouring=[int(255*x) for x in contour_colouring[th]];
-          lw=contour_colouring[th][3];
-
-          ascale=255.0;
-
-          ret,threshC = cv2.threshold(mask_ui,int(th*ascale),255,0)
-
-          print(np.max(mask_ui))
-          print(th*ascale)
-          print(ascale)
+  axes=[0,1,2];
+  for ax in axes:
+    # everything which doesn't depend on the mode is done once per axis {{{
+    with stage('render slices %s' % (axkey[ax],),label):
+      slicenum=int(np.floor(com[ax]));
+      slices={};
+      slices_normalised={};
+      for ds in ['mask']+list(datasets):
+        if ds=='mask':
+          data=mask_slice(mask_merged,mask_extent,shape,ax,slicenum);
+        else:
+          data=take_slice(datasets[ds],slicenum,ax);
+        slices[ds]=scipy.ndimage.zoom(data, zoomfactor, order=1) # higher-order interpolations introduce edge artifacts which give peculiar contours.
+        slices_normalised[ds]=slices[ds]*255.0/np.max(slices[ds].flat);
+
+      mask_normalised=slices_normalised['mask'];
+      image_normalised=structural_slice(structural,base,ax,slicenum,zoomfactor);
+
+      mask_ui=mask_normalised.astype('uint8');
+      rects=mask_rects(mask_ui);
+    levels=None; # percentile contours, if any mode wants them
+    buf=None; # uint8 image buffer, re-used by every mode, for the cv2 backend
+    # }}}
+
+    for this_mode in modes:
+      style=styles[this_mode];
+      if style['tissue'] is not None and not style['tissue'] in slices_normalised:
+        continue; # skip tissue class seg.
+
+      with stage('render %s %s' % (this_mode,axkey[ax]),label):
+        rgb=composite(image_normalised,mask_normalised,style,slices_normalised.get(style['tissue']));
+        if backend=='cv2':
+          rgb=buf=to_buffer(rgb,buf);
+        if style['do_percentiles'] and levels is None:
+          levels=percentile_contours(mask_ui);
+
+        ofn='%s%s_%s.png' % (ofn_base,this_mode,axkey[ax],);
+        decorate(rgb,style,rects,levels,zoomfactor,'%s%s_%s.csv' % (ofn_base,this_mode,axkey[ax],),ofn,this_mode,backend,writer);
+      print(ofn);
 
-# also has offset!
-          contours2,hierarchy2=cv2.findContours(threshC,method=cv2.CHAIN_APPROX_TC89_KCOS,mode=cv2.RETR_EXTERNAL);
+def render_voxels(structural, masks, output_folder=None, mode='spectramosaic', backend='pil', writer=None): # {{{
+  """ Render each of a list of single-voxel masks over the structural, as merge_masks(structural, mask, mode=mode) would for each in turn; returns {mask: [png filenames]}.
 
-          if len(contours2)==0:
-            continue;
+  The structural is opened once, and each mask is only held within its own bounding box. Voxels whose
+  slices through their centres of mass coincide share one structural slice, and are zoomed, normalised
+  and composited together, as one stacked array (of up to render_chunk voxels); only the outlines are found and drawn voxel by voxel.
+  backend is 'pil' or 'cv2' (see decorate); images are written through writer, as for merge_masks.
+  """
+  zoomfactor=4;
+  if writer is None:
+    writer=ImageWriter();
+  style=mode_style(mode,zoomfactor);
+  if style['tissue'] is not None:
+    raise ValueError('render_voxels does not do tissue class modes: %s' % (mode,));
+  if output_folder is None:
+    output_folder=os.path.dirname(structural);
 
-# http://stackoverflow.com/questions/8461612/using-hierarchy-in-findcontours-in-opencv
-          print('hierarchy:')
-          print(hierarchy2);
-          # hierarchy2=[x for x in hierarchy2.flat]; # this really shouldn't be needed...
-          hierarchy2=hierarchy2[0];
-
-# cv2.CV_RETR_EXTERNAL cv2.RETR_LIST, cv2.RETR_CCOMP
-# HAIN_APPROX_SIMPLE, CHAIN_APPROX_TC89_L1,CV_CHAIN_APPROX_TC89_KCOS
-          print('...')
-          for h in hierarchy2:
-            print(h)
-          print('...')
-          for ci in range(0,len(contours2)):
-            h=hierarchy2[ci];
-            print(h)
-            if h[3]==-1 and colouring is not None: # outer contour, explicit colouring
-                cv2.drawContours(r,contours2,ci,colouring[0],lw);
-                cv2.drawContours(g,contours2,ci,colouring[1],lw);
-                cv2.drawContours(b,contours2,ci,colouring[2],lw);
-            else:
-              if h[3]==-1:
-                cv2.drawContours(g,contours2,ci,0,lw);
-                print('outer')
-              else:
-                cv2.drawContours(g,contours2,ci,255,lw);
-                print('inner')
-              if cv2.arcLength(contours2[ci],True)>50:
-                cv2.drawContours(b,contours2,ci,0,lw);
-              else:
-                cv2.drawContours(b,contours2,ci,255,lw);
-
-          if colouring is None:
-            cv2.drawContours(r,contours2,-1,255,2,lw);
-
-        # }}} 
-
-      #  }}}
-
-      r=Image.fromarray(r.astype('uint8'));
-      g=Image.fromarray(g.astype('uint8'));
-      b=Image.fromarray(b.astype('uint8'));
-
-      if do_rectangle: # {{{
-        print('%s : including "rectangular" voxel outline' % (mode,))
-        # we wish to draw nice, non-blocky boxes around these things. use cv2 to find contours and generate bounding rectangles for plotting:
-        for cn in contours:  
-          print('Rectangle coords:')
-          rect=cv2.minAreaRect(cn);
-          print(rect)
-          rect_fn=('%s%s_%s.csv' % (ofn_base,mode,axkey[ax],));
-          print('Saving to %s' % (rect_fn,))
-          with open(rect_fn,'w') as rf:
-            rf.write('%.2f;%.2f;%.2f;%.2f;%.2f' % (rect[0][0],rect[0][1],rect[1][0],rect[1][1],rect[2]));
-          ox=rect[0][0]
-          oy=rect[0][1]
-          shrinkage=(zoomfactor+rec_linewidth)/2
-          lx=rect[1][0]-shrinkage
-          ly=rect[1][1]-shrinkage
-          rot=-rect[2]*2.*m.pi/360;
-          rm=np.array([[m.cos(rot),-m.sin(rot)],[m.sin(rot),m.cos(rot)]])
-
-
-          x1=0-lx/2; x2=0+lx/2; y1=0-ly/2; y2=0+ly/2;
-          box=np.array([[x1,y1],[x1,y2],[x2,y2],[x2,y1],[x1,y1]]);
-          rotbox=box.dot(rm);
-          shiftbox=rotbox+[ox,oy]
-          print(rm)
-          print(rotbox)
-          print(shiftbox)
-          box=shiftbox;
-
-          #box = cv2.boxPoints(rect)
-          pts=tuple(map(tuple, box))
-
-          draw=ImageDraw.Draw(r);
-          draw.line(pts, fill=bc[0], width=rec_linewidth)
-
-          draw=ImageDraw.Draw(g);
-          draw.line(pts, fill=bc[1], width=rec_linewidth)
-
-          draw=ImageDraw.Draw(b);
-          draw.line(pts, fill=bc[2], width=rec_linewidth)
-      # }}}
-
-      cim=Image.merge('RGB',(r,g,b));
-      cim=cim.rotate(90,expand=True);
-      
-      if ofn_base is None:
-        if single:
-          prefix=re.sub('(\.7|_mask\.nii)$','',os.path.basename(masks[0]))+'_mask_';
-          print prefix;
-        else:
-          prefix='mask_';
-        ofn_base=os.path.join(output_folder,prefix);
+  base=nib.load(structural);
+  shape=base.shape[:3];
 
-      ofn='%s%s_%s.png' % (ofn_base,mode,axkey[ax],);
+  voxels=[];
+  for mask in masks:
+    mask_extent,mask_data=read_masks([mask]);
+    voxels.append((mask,mask_extent,mask_data,mask_centre(mask_data,mask_extent,shape),os.path.join(output_folder,mask_prefix(mask))));
+
+  outputs=OrderedDict((mask,[]) for mask in masks);
+  # voxels sharing a slice are composited together, but no more than render_chunk at once, to bound memory
+  for ax in [0,1,2]:
+    groups=OrderedDict();
+    for v in voxels:
+      groups.setdefault(int(np.floor(v[3][ax])),[]).append(v);
+
+    for slicenum,voxel_group in groups.items():
+      for first in range(0,len(voxel_group),render_chunk):
+        group=voxel_group[first:first+render_chunk];
+        with stage('render %s %s' % (mode,axkey[ax]),' '.join(re.sub('_mask_$','',os.path.basename(v[4])) for v in group)):
+          image_normalised=structural_slice(structural,base,ax,slicenum,zoomfactor);
+          stack=np.array([mask_slice(mask_data,mask_extent,shape,ax,slicenum) for mask,mask_extent,mask_data,com,ofn_base in group]);
+          zoomed=scipy.ndimage.zoom(stack,(1,zoomfactor,zoomfactor),order=1);
+          mask_normalised=zoomed*255.0/zoomed.reshape(len(group),-1).max(axis=1)[:,None,None];
+          rgb=composite(image_normalised,mask_normalised,style);
+          if backend=='cv2':
+            rgb=to_buffer(rgb); # the whole chunk at once
+
+          for i,(mask,mask_extent,mask_data,com,ofn_base) in enumerate(group):
+            mask_ui=mask_normalised[i].astype('uint8');
+            levels=percentile_contours(mask_ui) if style['do_percentiles'] else None;
+            ofn='%s%s_%s.png' % (ofn_base,mode,axkey[ax],);
+            decorate(rgb[i] if backend=='cv2' else np.ascontiguousarray(rgb[i]),style,mask_rects(mask_ui),levels,zoomfactor,'%s%s_%s.csv' % (ofn_base,mode,axkey[ax],),ofn,mode,backend,writer);
+            print(ofn);
+            outputs[mask].append(ofn);
+  return outputs;
+# }}}
+
+def voxel_axes(header): # {{{
+  """ Unit axes (3x3, as rows) of a P-file's PRESS box: from its corner vectors, as voxelmask rasterizes it, or,
+  for versions without them, from ras_normal alone; the scanner's axes if neither is known """
+  centre,axes,half=box_axes(header);
+  normal=np.array(header.get('ras_normal',(0,0,0)),dtype=float);
+  if np.array_equal(axes,np.eye(3)) and np.linalg.norm(normal)>0:
+    normal/=np.linalg.norm(normal);
+    u=np.eye(3)[np.argmin(np.abs(normal))]; # the scanner axis furthest from the normal, made orthogonal to it
+    u-=np.dot(u,normal)*normal;
+    u/=np.linalg.norm(u);
+    axes=np.array([u,np.cross(normal,u),normal]);
+  return axes;
+# }}}
+
+def plane_axes(axes): # {{{
+  """ For each of the sag, cor and ax planes, a 3x3 array of (normal, first in-plane axis, second in-plane axis): those of
+  the box's axes (rows of axes) which are closest to each of the volume's, signed to point the same way, so that oblique
+  images are laid out as the axis-aligned ones are. axes are given (and returned) relative to the volume's axes. """
+  perm=max(itertools.permutations(range(3)),key=lambda p: sum(abs(axes[p[d],d]) for d in range(3)));
+  closest=np.array([axes[perm[d]]*(1 if axes[perm[d],d]>=0 else -1) for d in range(3)]); # closest[d] is nearest scanner axis d
+  return [closest[[ax]+[d for d in range(3) if d!=ax]] for ax in range(3)];
+# }}}
+
+_grid_cache=OrderedDict(); # (shape, affine, plane, axis, zoomfactor) => voxel offsets of an oblique plane's pixels; most recent last
+grid_cache_size=6;
+
+def oblique_grid(shape, affine, plane, axis, zoomfactor): # {{{
+  """ Voxel offsets (3xN1xN2) of the pixels of an oblique plane (see plane_axes) of a volume (shape, affine) from its first
+  pixel, and the voxel steps (3-vectors) along its rows and columns.
+
+  The image is the size of the axis-aligned slice of the volume across axis, zoomed by zoomfactor, with its pixels
+  spaced as scipy.ndimage.zoom spaces them, but along the plane's in-plane axes. Grids depend only on the geometry,
+  so are kept for the life of the process, and shared by all the voxels of a prescription.
+  """
+  key=(tuple(shape),affine.tostring(),plane.tostring(),axis,zoomfactor);
+  if key in _grid_cache:
+    _grid_cache[key]=_grid_cache.pop(key);
+    return _grid_cache[key];
+
+  others=[d for d in range(3) if d!=axis];
+  size=[int(round(shape[d]*zoomfactor)) for d in others];
+  spacing=np.sqrt((affine[:3,:3]**2).sum(axis=0)); # mm per voxel
+  inv=np.linalg.inv(affine[:3,:3]);
+  steps=[inv.dot(plane[i+1]*spacing[d]*(shape[d]-1.0)/(n-1)) for i,(d,n) in enumerate(zip(others,size))];
+  grid=steps[0][:,None,None]*np.arange(size[0])[None,:,None]+steps[1][:,None,None]*np.arange(size[1])[None,None,:];
+
+  _grid_cache[key]=(grid,steps);
+  while len(_grid_cache)>grid_cache_size:
+    _grid_cache.popitem(last=False);
+  return grid,steps;
+# }}}
+
+def oblique_slices(img, mask_data, mask_extent, com, plane, axis, zoomfactor): # {{{
+  """ (structural, mask) sampled on the oblique plane through com (in voxels) across axis (see oblique_grid), at output
+  resolution, by one map_coordinates call; only the block of the volume the plane passes through is read """
+  shape=img.shape[:3];
+  grid,steps=oblique_grid(shape,img.affine,plane,axis,zoomfactor);
+  others=[d for d in range(3) if d!=axis];
+  # the pixel which falls on com is where the axis-aligned slice has it
+  origin=np.array(com,dtype=float)-sum(step*com[d]*(n-1)/(shape[d]-1.0) for step,d,n in zip(steps,others,grid.shape[1:]));
+  coords=grid+origin[:,None,None];
+
+  lo=np.clip(np.floor(coords.reshape(3,-1).min(axis=1)).astype(int),0,shape);
+  hi=np.clip(np.ceil(coords.reshape(3,-1).max(axis=1)).astype(int)+1,0,shape);
+  stack=np.zeros((2,)+tuple(hi-lo),dtype=np.float32);
+  stack[0]=img.dataobj[tuple(slice(a,b) for a,b in zip(lo,hi))];
+  a=[max(lo[d],mask_extent[d].start) for d in range(3)];
+  b=[min(hi[d],mask_extent[d].stop) for d in range(3)];
+  if all(a[d]<b[d] for d in range(3)):
+    stack[1][tuple(slice(a[d]-lo[d],b[d]-lo[d]) for d in range(3))]=mask_data[tuple(slice(a[d]-mask_extent[d].start,b[d]-mask_extent[d].start) for d in range(3))];
+
+  channel=np.arange(2,dtype=float)[:,None,None]*np.ones(coords.shape[1:]);
+  sampled=scipy.ndimage.map_coordinates(stack,np.concatenate([channel[None]]+[(coords[d]-lo[d])[None,None].repeat(2,axis=1) for d in range(3)]),order=1,mode='constant',cval=0);
+  return sampled[0],sampled[1];
+# }}}
+
+def render_oblique(structural, masks, headers, output_folder=None, mode='spectramosaic', backend='pil', writer=None): # {{{
+  """ Render each of a list of single-voxel masks over the structural as render_voxels does, but cut along the planes of
+  its own PRESS box (from its P-file header, see voxel_axes) rather than the scanner's, and sampled directly at the
+  output resolution; returns {mask: [png filenames]}. The sag, cor and ax images are those across the box axes closest
+  to each of the scanner's, so are the same files, laid out the same way, as render_voxels writes.
+  """
+  zoomfactor=4;
+  if writer is None:
+    writer=ImageWriter();
+  style=mode_style(mode,zoomfactor);
+  if style['tissue'] is not None:
+    raise ValueError('render_oblique does not do tissue class modes: %s' % (mode,));
+  if output_folder is None:
+    output_folder=os.path.dirname(structural);
 
+  base=nib.load(structural);
+  shape=base.shape[:3];
+  # box axes are in RAS mm; planes are matched to the volume's own axes (which needn't be RAS), so are chosen in their terms
+  directions=base.affine[:3,:3]/np.sqrt((base.affine[:3,:3]**2).sum(axis=0)); # each voxel axis' direction, as columns
+
+  outputs=OrderedDict((mask,[]) for mask in masks);
+  for mask,header in zip(masks,headers):
+    mask_extent,mask_data=read_masks([mask]);
+    com=mask_centre(mask_data,mask_extent,shape);
+    ofn_base=os.path.join(output_folder,mask_prefix(mask));
+    planes=[p.dot(directions.T) for p in plane_axes(voxel_axes(header).dot(directions))];
+    for ax in [0,1,2]:
+      with stage('render %s %s' % (mode,axkey[ax]),re.sub('_mask_$','',os.path.basename(ofn_base))):
+        structural_plane,mask_plane=oblique_slices(base,mask_data,mask_extent,com,planes[ax],ax,zoomfactor);
+        image_normalised=equalise(structural_plane);
+        mask_normalised=mask_plane*255.0/max(mask_plane.max(),1e-6);
+        rgb=composite(image_normalised,mask_normalised,style);
+        if backend=='cv2':
+          rgb=to_buffer(rgb);
+
+        mask_ui=mask_normalised.astype('uint8');
+        levels=percentile_contours(mask_ui) if style['do_percentiles'] else None;
+        ofn='%s%s_%s.png' % (ofn_base,mode,axkey[ax],);
+        decorate(rgb if backend=='cv2' else np.ascontiguousarray(rgb),style,mask_rects(mask_ui),levels,zoomfactor,'%s%s_%s.csv' % (ofn_base,mode,axkey[ax],),ofn,mode,backend,writer);
       print(ofn);
-      cim.save(ofn);
+      outputs[mask].append(ofn);
+  return outputs;
+# }}}
 
 if __name__ == "__main__":
   if len(sys.argv)>1:
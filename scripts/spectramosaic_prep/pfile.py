@@ -4,8 +4,131 @@ import re;
 import os.path;
 import sys;
 import time;
+import mmap;
+import struct;
 from collections import OrderedDict;
 
+# P-file header layout tables {{{
+#
+# All offsets are in bytes. Fields are either absolute, or relative to one of the header sections
+# ('exam', 'series', 'image') whose offsets are themselves stored in the header (rev 14.0 and later).
+
+# 16-bit integers from the start of the rdb header; all indices are 1 less than matlab implementation!
+attrib_ref={
+  "npasses":32,
+  "nslices":34,
+  "nechoes":35,
+  "navs":36,
+  "nframes":37,
+  "point_size":41,
+  "MRS_struct.p.npoints":51,
+  "MRS_struct.p.nrows":52,
+  "rc_xres":53,
+  "rc_yres":54,
+  "start_recv":100,
+  "stop_recv":101
+}
+
+# float triplets (r,a,s), by index. Indices count from 9 floats *before* the image header; this
+# is how the original reader's buffer was laid out, and the indices were chosen against it.
+attribs_by_version={
+  11: { "ras_center":  24, "ras_normal": 101 },
+  14: { "ras_center":  40, "ras_normal": 117 },
+  15: { "ras_center":  40, "ras_normal": 117 },
+  16: { "ras_center":  52, "ras_normal": 129, "ras_topleft": 132, "ras_topright": 135, "ras_bottomright": 138 }, # this one hasn't been tested particularly well.
+  24: { "ras_center": 174, "ras_normal": 177, "ras_topleft": 180, "ras_topright": 183, "ras_bottomright": 186 },
+}
+
+# null-terminated strings: (section, offset, length)
+strings_by_version={
+  11: { "patient_name": ('exam',449, 25), "series_description": ('series',298,35), "series_protocol": ('series',384, 35) },
+  15: { "patient_name": ('exam',774, 25), "series_description": ('series',506,35), "series_protocol": ('series',592, 35) },
+  16: { "patient_name": ('exam',774, 25), "series_description": ('series',506,35), "series_protocol": ('series',592, 35) },
+  24: { "patient_name": ('exam',1524,25), "series_description": ('series',982,35), "series_protocol": ('series',1068,35) }
+}
+
+# integers: (section, offset, bits); negative bits for signed
+ints_by_version={
+  11: { "te": ('image',720,  16), "patient_age": ('exam',213,     16),"patient_sex": ('exam',217,     16), "exam_datetime": ('exam',220,     32) }, # UNTESTED!
+  15: { "te": ('image',720,  32), "patient_age": ('exam',292,     16),"patient_sex": ('exam',296,     16), "exam_datetime": ('exam',220,     32) },
+  16: { "te": ('image',768, -32), "patient_age": ('exam',292,     16),"patient_sex": ('exam',296,     16), "exam_datetime": ('exam',220,     32) }, # UNTESTED
+  24: { "te": ('image',1064, 32), "patient_age": ('exam',292+424, 16),"patient_sex": ('exam',296+424, 16), "exam_datetime": ('exam',220+364, 32) }, # UNTESTED
+}
+
+# other fixed-position rdb header fields: (byte offset, struct format), as used by Gannet's GERead
+# spectral_width is in Hz (stored in user0 by the spectroscopy PSDs); ps_mps_freq in units of 0.1 Hz
+rdb_fields={
+  "spectral_width": (216,'f'),
+  "ps_mps_freq": (424,'I')
+}
+
+# voxel dimensions, as floats 3:6 of the 9 at 368
+ras_size_offset=368+3*4;
+
+# the section offset table (rev 14.0 and later): off_data, off_per_pass, off_unlock_raw, off_data_acq_tab,
+# off_nex_tab, off_nex_abort_tab, off_tool, off_exam, off_series, off_image
+section_table_offset=1468;
+section_table_names=['data','per_pass','unlock_raw','data_acq_tab','nex_tab','nex_abort_tab','tool','exam','series','image'];
+
+int_formats={16:'H',-16:'h',32:'I',-32:'i'};
+
+# }}}
+
+_layouts={};
+
+def header_layout(ver, endian, sections): # {{{
+  """ Compile (and cache) the header layout of a version into a single struct, plus a list of (name,count) to unpack it into.
+
+  sections is a dict of section name => offset; fields in sections which aren't known are left out.
+  """
+  key=(ver,endian,tuple(sorted(sections.items())));
+  if key in _layouts:
+    return _layouts[key];
+
+  # (offset, format, name, count)
+  fields=[];
+  for k in attrib_ref:
+    fields.append((2*attrib_ref[k],'h',k,1));
+  for k in rdb_fields:
+    fields.append((rdb_fields[k][0],rdb_fields[k][1],k,1));
+  fields.append((ras_size_offset,'3f','ras_size',3));
+
+  def rel(section,offset):
+    if section in sections:
+      return sections[section]+offset;
+    return None;
+
+  for k,idx in attribs_by_version.get(ver,{}).items():
+    ofs=rel('image',4*(idx-9));
+    if ofs is not None:
+      fields.append((ofs,'3f',k,3));
+  for k,(section,offset,length) in strings_by_version.get(ver,{}).items():
+    ofs=rel(section,offset);
+    if ofs is not None:
+      fields.append((ofs,'%ds' % (length,),k,1));
+  for k,(section,offset,bits) in ints_by_version.get(ver,{}).items():
+    ofs=rel(section,offset);
+    if ofs is not None:
+      fields.append((ofs,int_formats[bits],k,1));
+
+  fields.sort();
+  fmt=[endian];
+  pos=0;
+  names=[];
+  for ofs,f,name,count in fields:
+    if ofs<pos:
+      raise ValueError('Overlapping P-file header fields at %d (%s)' % (ofs,name));
+    if ofs>pos:
+      fmt.append('%dx' % (ofs-pos,));
+    fmt.append(f);
+    pos=ofs+struct.calcsize(endian+f);
+    names.append((name,count));
+
+  layout=(struct.Struct(''.join(fmt)),names);
+  _layouts[key]=layout;
+  return layout;
+# }}}
+
 class pfile(object):
   """
   Rudimentary GE P-file header reading
@@ -13,7 +136,6 @@ class pfile(object):
 
   def __init__(self, header):
     self.header=header;
-    print header;
 
   def __getattribute__(self,name):
     x=['header'];
@@ -30,233 +152,146 @@ class pfile(object):
   def read_header(fn):
     """
     EXPERIMENTAL function to extract a handful of key header elements from some familiar versions of the p-file.
-    """
-    from array import array;
-    import struct;
-
-    dbg=False;
 
-    itypes={'h','i','l'}
-    intN={}
-    for t in itypes:
-      x=array(t);
-      intN[x.itemsize]=t;
+    The file is mapped rather than read, and all fields are decoded by a single struct per version (see header_layout).
+    """
 
     with open(fn,'rb') as f:
-      chunk=f.read(4);
-      if dbg:
-        print chunk;
-      endian='>'; # first try big-endian
-      version=struct.unpack('>f', chunk)[0]
-      if version==7.0:
-        hdr_size=39984 # LX
-      elif version==8.0:
-        hdr_size=60464  # Cardiac / MGD
-      elif version>5.0 and version<6.0:
-        hdr_size=39940 # Signa 5.5
-      else:
-        endian='<'; # it's little endian
-        version=struct.unpack('<f', chunk)[0]
-        if version==9.0: # 11.0 product release
-          hdr_size=61464;
-        elif version==11.0:
-          hdr_size=66072;
-        elif version>11.0 and version<100: # 14.0 and later
-          # 4-byte signed... l or i?
-          larr=array(intN[4]) 
-          f.seek(1468);
-          hdr_size=struct.unpack('<i', chunk)[0]
-          f.seek(1468);
-          larr.fromfile(f,10);
-          hdr_sizes=list(larr);
-          #chunk=f.read(4*10);
-        else:
-          print "Version %d unknown" % (version);
-          version=-1;
-      print "Version %d Header Size %d" % (version,hdr_size);
-      ver=int(version);
-
-      # ARC 20161012: ignoring endianness for now!! FIXME
-
-
-      f.seek(0);
-
-      #chunk=f.read(2*102);
-      #dat=struct.unpack('%sh' % (endian,), chunk);
-      #print dat;
-      iarr=array('h');
-      iarr.fromfile(f,102);
-      header_sizes=list(iarr);
-      if dbg:
-        print len(iarr);
-        print header_sizes;
-      #iarr.byteswap();
-      x={n:"%d" % (iarr[n],) for n in range(0,100)};
-      if dbg:
-        print x;
-
-      f.seek(0);
-      rarr=array('f');
-      rarr.fromfile(f,200);
-      x={n:"%-5.2f" % (rarr[n],) for n in range(0,110)};
-      if dbg:
-        print x;
-
-
-        print iarr[34];
-        print iarr[34];
-        print iarr[34];
-
-
-      # all indices are 1 less than matlab implementation!
-      attribs=OrderedDict();
-      attrib_ref={
-        "npasses":32,
-        "nslices":34,
-        "nechoes":35,
-        "navs":36,
-        "nframes":37,
-        "point_size":41,
-        "MRS_struct.p.npoints":51,
-        "MRS_struct.p.nrows":52,
-        "rc_xres":53,
-        "rc_yres":54,
-        "start_recv":100,
-        "stop_recv":101
-      }
-
-
-
-
-      attribs_by_version={
-        11: { "ras_center":  24, "ras_normal": 101, "readsize":104 },
-        14: { "ras_center":  40, "ras_normal": 117, "readsize":120 },
-        15: { "ras_center":  40, "ras_normal": 117, "readsize":120 },
-        16: { "ras_center":  52, "ras_normal": 129, "ras_topleft": 132, "ras_topright": 135, "ras_bottomright": 138, "readsize":140 }, # this one hasn't been tested particularly well.
-        24: { "ras_center": 174, "ras_normal": 177, "ras_topleft": 180, "ras_topright": 183, "ras_bottomright": 186,  "readsize":200 },
-      }
-
-      ofs_mrimgdata_hdr=hdr_sizes[9]
-      ofs_exam_data=hdr_sizes[7];
-      ofs_series_data=hdr_sizes[8];
-
-      strings_by_version={
-        11: { "patient_name": (ofs_exam_data+449, 25), "series_descriptioin": (ofs_series_data+298,35), "series_protocol": (ofs_series_data+384, 35) },
-        15: { "patient_name": (ofs_exam_data+774, 25), "series_description":  (ofs_series_data+506,35), "series_protocol": (ofs_series_data+592, 35) },
-        16: { "patient_name": (ofs_exam_data+774, 25), "series_description":  (ofs_series_data+506,35), "series_protocol": (ofs_series_data+592, 35) },
-        24: { "patient_name": (ofs_exam_data+1524,25), "series_description":  (ofs_series_data+982,35), "series_protocol": (ofs_series_data+1068,35) }
-      }
-
-      if ver in strings_by_version:
-        for k in strings_by_version[ver]:
-          f.seek(strings_by_version[ver][k][0]);
-          b=f.read(strings_by_version[ver][k][1]).split('\x00')[0];
-          attribs[k]=b;
+      buf=mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ);
+    try:
+      return pfile.decode_header(buf,fn);
+    finally:
+      buf.close();
+
+  @staticmethod
+  def decode_header(buf, fn):
+    """ Decode a header from a buffer (string or mmap) holding at least the start of a P-file """
+
+    sections={};
+    endian='>'; # first try big-endian
+    version=struct.unpack_from('>f', buf, 0)[0]
+    if version==7.0:
+      hdr_size=39984 # LX
+    elif version==8.0:
+      hdr_size=60464  # Cardiac / MGD
+    elif version>5.0 and version<6.0:
+      hdr_size=39940 # Signa 5.5
+    else:
+      endian='<'; # it's little endian
+      version=struct.unpack_from('<f', buf, 0)[0]
+      if version==9.0: # 11.0 product release
+        hdr_size=61464;
+      elif version==11.0:
+        hdr_size=66072;
+      elif version>11.0 and version<100: # 14.0 and later
+        offsets=struct.unpack_from('<10i', buf, section_table_offset);
+        sections=dict(zip(section_table_names,offsets));
+        hdr_size=sections['data'];
       else:
-        print 'Unfamiliar version, %f' % (ver,)
-
-      ints_by_version={
-        11: { "te":          (ofs_mrimgdata_hdr+720,  16), "patient_age": (ofs_exam_data+213,     16),"patient_sex": (ofs_exam_data+217,     16), "exam_datetime": (ofs_exam_data+220,     32) }, # UNTESTED!
-        15: { "te":          (ofs_mrimgdata_hdr+720,  32), "patient_age": (ofs_exam_data+292,     16),"patient_sex": (ofs_exam_data+296,     16), "exam_datetime": (ofs_exam_data+220,     32) },
-        16: { "te":          (ofs_mrimgdata_hdr+768, -32), "patient_age": (ofs_exam_data+292,     16),"patient_sex": (ofs_exam_data+296,     16), "exam_datetime": (ofs_exam_data+220,     32) }, # UNTESTED
-        24: { "te":          (ofs_mrimgdata_hdr+1064, 32), "patient_age": (ofs_exam_data+292+424, 16),"patient_sex": (ofs_exam_data+296+424, 16), "exam_datetime": (ofs_exam_data+220+364, 32) }, # UNTESTED
-
-      }
-
-      # generate a map of size-in-bytes to array typecode (spec at https://docs.python.org/3/library/array.html defines only minimum).
-      # there's probably a waaay better way of doing this.
-      typecodes={};
-      for k in ['b','h','i','l']: # ,'f','d']:
-        x=array(k);
-        typecodes[-8*x.itemsize]=k;         #   signed variant is lowercase
-        typecodes[ 8*x.itemsize]=k.upper();  # unsigned variant is uppercase
-
-      if dbg:
-        print typecodes;
-
-      if ver in ints_by_version:
-        for k in ints_by_version[ver]:
-          f.seek(ints_by_version[ver][k][0]);
-          iab=array(typecodes[ints_by_version[ver][k][1]]);
-          iab.fromfile(f,100);
-          if dbg:
-            print k;
-            if iab.itemsize>2:
-              print 'offset 2-bytes:';
-              f.seek(ints_by_version[ver][k][0]+2);
-              x=array(typecodes[ints_by_version[ver][k][1]]);
-              x.fromfile(f,100);
-              print x;
-              print 'not offset:'
-            print iab;
-          attribs[k]=iab[0];
+        print "Version %d unknown" % (version);
+        version=-1;
+        hdr_size=None;
+    ver=int(version);
+
+    if not ver in strings_by_version:
+      print 'Unfamiliar version, %f' % (ver,)
+    elif len(sections)==0:
+      print 'Header section offsets unknown for version %d; only reading fixed-position fields' % (ver,);
+
+    layout,names=header_layout(ver,endian,sections);
+    try:
+      values=layout.unpack_from(buf,0);
+    except struct.error:
+      raise IOError('P-file header truncated: %s' % (fn,));
+
+    attribs=OrderedDict();
+    attribs['version']=ver;
+    attribs['hdr_size']=hdr_size;
+    attribs['endian']=endian;
+    i=0;
+    for name,count in names:
+      if count==1:
+        attribs[name]=values[i];
       else:
-        print 'Unfamiliar version, %f' % (ver,)
-          # print string.from_bytes(b)
-
-          #carr=array('c');
-          #carr.fromfile(f,strings_by_version[ver][k][1]);
-          #print carr;
-
-      if 'exam_datetime' in attribs:
-        attribs['exam_datetime']=time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(attribs['exam_datetime']))
-
-      if 'patient_sex' in attribs:
-        if attribs['patient_sex']==2:
-          attribs['patient_sex']='F';
-        elif attribs['patient_sex']==1:
-          attribs['patient_sex']='M';
-
-      print '----'
-            # print string.from_bytes(b)
-
-            #carr=array('c');
-            #carr.fromfile(f,strings_by_version[ver][k][1]);
-            #print carr;
-
-      fattrib_ref={
-        "ras_center_r": attribs_by_version[ver]["ras_center"],
-        "ras_normal_r": attribs_by_version[ver]["ras_normal"]
-      }
-      fattrib_ref["ras_center_a"]=fattrib_ref["ras_center_r"]+1;
-      fattrib_ref["ras_center_s"]=fattrib_ref["ras_center_r"]+2;
-      fattrib_ref["ras_normal_a"]=fattrib_ref["ras_normal_r"]+1;
-      fattrib_ref["ras_normal_s"]=fattrib_ref["ras_normal_r"]+2;
-
-      f.seek(368);
-      rarr=array('f');
-      rarr.fromfile(f,9);
-      if dbg:
-        print rarr;
-      attribs["ras_size"]=rarr[3:6]
-      if dbg:
-        print attribs["ras_size"]
-
-      arr=array('f');
-      f.seek(ofs_mrimgdata_hdr);
-      rarr.fromfile(f,attribs_by_version[ver]["readsize"]);
-
-      for attrib in attrib_ref:
-        attribs[attrib]=iarr[attrib_ref[attrib]];
-        if dbg:
-          print "i %-20s (%03d) : %d" % (attrib,attrib_ref[attrib],attribs[attrib]);
-      attribs["nreceivers"]=1+attribs["stop_recv"]-attribs["start_recv"];
-
-      for attrib in fattrib_ref:
-        attribs[attrib]=rarr[fattrib_ref[attrib]];
-        if dbg:
-          print "r %-20s (%03d) : %-3.2f" % (attrib,fattrib_ref[attrib],attribs[attrib]);
-
-      attribs["ras_normal"]=(attribs["ras_normal_r"],attribs["ras_normal_a"],attribs["ras_normal_s"])
-      attribs["ras_center"]=(attribs["ras_center_r"],attribs["ras_center_a"],attribs["ras_center_s"])
-
-      if dbg:
-        print attribs;
-
-      attribs['fullpath']=fn;
-      attribs['shortname']=re.sub('\.7$','',os.path.basename(fn));
-
-      return attribs;
+        attribs[name]=values[i:i+count];
+      i+=count;
+
+    for k in strings_by_version.get(ver,{}):
+      if k in attribs:
+        attribs[k]=attribs[k].split('\x00')[0];
+
+    if 'exam_datetime' in attribs:
+      attribs['exam_datetime']=time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(attribs['exam_datetime']))
+
+    if 'patient_sex' in attribs:
+      if attribs['patient_sex']==2:
+        attribs['patient_sex']='F';
+      elif attribs['patient_sex']==1:
+        attribs['patient_sex']='M';
+
+    attribs["nreceivers"]=1+attribs["stop_recv"]-attribs["start_recv"];
+
+    for v in ['ras_center','ras_normal']:
+      if v in attribs:
+        attribs[v+'_r'],attribs[v+'_a'],attribs[v+'_s']=attribs[v];
+
+    attribs['fullpath']=fn;
+    attribs['shortname']=re.sub('\.7$','',os.path.basename(fn));
+
+    return attribs;
+
+  def raw_data(self, baseline=False):
+    """
+    The raw data, as a read-only numpy.memmap of (re,im) integer pairs, with shape (nreceivers, nechoes, nframes, npoints).
+
+    Nothing is read until it is used. Each echo of each receiver is preceded by a baseline frame, which is left out of
+    the (zero-copy) view unless baseline is True, in which case the frame axis has nframes+1 entries.
+    """
+    import numpy as np;
+
+    npoints=self.header['MRS_struct.p.npoints'];
+    nframes=self.nframes+1;
+    shape=(self.nreceivers,self.nechoes,nframes,npoints);
+    if not self.point_size in [2,4]:
+      raise ValueError('Unsupported P-file point size: %d' % (self.point_size,));
+    itype='%si%d' % (self.header.get('endian','<'),self.point_size);
+    dtype=np.dtype([('re',itype),('im',itype)]);
+
+    expected=self.hdr_size+int(np.prod(shape))*dtype.itemsize;
+    if os.path.getsize(self.fullpath)<expected:
+      raise IOError('P-file is shorter than its header implies (%d < %d bytes): %s' % (os.path.getsize(self.fullpath),expected,self.fullpath));
+
+    data=np.memmap(self.fullpath,dtype=dtype,mode='r',offset=self.hdr_size,shape=shape);
+    if baseline:
+      return data;
+    return data[:,:,1:,:];
+
+  @staticmethod
+  def as_complex(data, dtype='complex64'):
+    """ Convert (a chunk of) raw_data to complex values """
+    import numpy as np;
+    c=np.empty(data.shape,dtype=dtype);
+    c.real=data['re'];
+    c.imag=data['im'];
+    return c;
+
+  def iter_raw(self, by='frame', chunk=1, dtype='complex64'):
+    """
+    Generate the raw data in complex chunks, so that files needn't be held in memory whole.
+
+      by='frame'    : yields (echo, frame, data), data being (nreceivers, chunk, npoints) for frames frame:frame+chunk
+      by='receiver' : yields (receiver, data), data being (chunk, nechoes, nframes, npoints) for receivers receiver:receiver+chunk
+    """
+    data=self.raw_data();
+    if by=='frame':
+      for echo in range(data.shape[1]):
+        for frame in range(0,data.shape[2],chunk):
+          yield echo,frame,self.as_complex(data[:,echo,frame:frame+chunk,:],dtype);
+    elif by=='receiver':
+      for receiver in range(0,data.shape[0],chunk):
+        yield receiver,self.as_complex(data[receiver:receiver+chunk],dtype);
+    else:
+      raise ValueError('Unknown chunking: %s' % (by,));
 
   @classmethod
   def from_file(cls, filename):
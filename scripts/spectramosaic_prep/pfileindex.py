@@ -0,0 +1,200 @@
+#!/usr/bin/python
+"""
+Persistent index of P-file headers, so that archives need only be scanned once.
+
+Usage
+-----
+
+    pfileindex.py [-d index.sqlite] [-j N] [folder|pfile] ...
+
+  Folders are walked for P-files (P*.7), and any file whose path, size or mtime isn't already in the
+  index has its header read (in parallel with -j) and stored. The indexed headers are then listed.
+
+    -d [filename] : index to use (default: ~/.spectramosaic_pfile_index.sqlite)
+    -j [N]        : number of worker processes used to read headers (default 1)
+    -q [text]     : only list P-files whose patient name, shortname or series description contains this
+
+"""
+
+import os;
+import re;
+import sys;
+import json;
+import sqlite3;
+from collections import OrderedDict;
+from pfile import pfile;
+
+default_index=os.path.expanduser('~/.spectramosaic_pfile_index.sqlite');
+
+def is_pfile_name(fn):
+  return re.match('^P.*\.7$',os.path.basename(fn)) is not None;
+
+def find_pfiles(paths): # {{{
+  """ Expand a list of files and folders into the P-files in them """
+  for p in paths:
+    if os.path.isdir(p):
+      for root, subFolders, files in os.walk(p):
+        for f in sorted(files):
+          if is_pfile_name(f):
+            yield os.path.join(root,f);
+    elif os.path.isfile(p):
+      yield p;
+# }}}
+
+def _read_one(args): # {{{
+  """ Worker: read a header; errors are returned rather than raised, so that one bad file doesn't stop a scan """
+  fn,size,mtime=args;
+  try:
+    return (fn,size,mtime,pfile.read_header(fn),None);
+  except Exception as e:
+    return (fn,size,mtime,None,'%s: %s' % (e.__class__.__name__,e));
+# }}}
+
+def _decode(text): # {{{
+  header=json.loads(text,object_pairs_hook=OrderedDict);
+  for k in header:
+    if isinstance(header[k],list):
+      header[k]=tuple(header[k]); # vectors were tuples when read
+    elif isinstance(header[k],unicode):
+      header[k]=header[k].encode('latin-1'); # header strings are raw bytes
+  return header;
+# }}}
+
+class PfileIndex(object):
+  """
+  P-file headers, keyed by absolute path and validated by file size and mtime.
+  """
+
+  columns=['shortname','patient_name','te','exam_datetime','series_description','series_protocol'];
+
+  def __init__(self, filename=None):
+    if filename is None:
+      filename=default_index;
+    self.filename=filename;
+    self.db=sqlite3.connect(filename,timeout=60);
+    self.db.execute('CREATE TABLE IF NOT EXISTS headers (path TEXT PRIMARY KEY, size INTEGER, mtime REAL, %s, header TEXT)' % (', '.join(self.columns),));
+    self.db.execute('CREATE INDEX IF NOT EXISTS headers_patient ON headers (patient_name)');
+    self.db.commit();
+
+  def close(self):
+    self.db.close();
+
+  def _stat(self, fn):
+    st=os.stat(fn);
+    return os.path.abspath(fn),st.st_size,st.st_mtime;
+
+  def lookup(self, fn):
+    """ Header of fn if it's indexed and unchanged, otherwise None """
+    path,size,mtime=self._stat(fn);
+    row=self.db.execute('SELECT header FROM headers WHERE path=? AND size=? AND mtime=?',(path,size,mtime)).fetchone();
+    if row is None:
+      return None;
+    header=_decode(row[0]);
+    header['fullpath']=path; # (indexes made before headers were read by absolute path may hold a relative one)
+    return header;
+
+  def store(self, path, size, mtime, header):
+    values=[path,size,mtime]+[header.get(c).decode('latin-1') if isinstance(header.get(c),str) else header.get(c) for c in self.columns]+[json.dumps(header,encoding='latin-1')];
+    self.db.execute('INSERT OR REPLACE INTO headers VALUES (%s)' % (','.join(['?']*len(values)),),values);
+
+  def get(self, fn):
+    """ pfile object for fn, reading (and indexing) its header only if necessary """
+    header=self.lookup(fn);
+    if header is None:
+      path,size,mtime=self._stat(fn);
+      header=pfile.read_header(path); # so fullpath holds wherever it's looked up from
+      self.store(path,size,mtime,header);
+      self.db.commit();
+    return pfile(header);
+
+  def update(self, paths, njobs=1):
+    """ Bring the index up-to-date for the P-files in paths (files or folders). Returns (#read, #unchanged, errors). """
+    todo=[];
+    unchanged=0;
+    for fn in find_pfiles(paths):
+      path,size,mtime=self._stat(fn);
+      row=self.db.execute('SELECT 1 FROM headers WHERE path=? AND size=? AND mtime=?',(path,size,mtime)).fetchone();
+      if row is None:
+        todo.append((path,size,mtime));
+      else:
+        unchanged+=1;
+
+    if njobs>1 and len(todo)>1:
+      import multiprocessing;
+      pool=multiprocessing.Pool(njobs);
+      try:
+        results=pool.imap_unordered(_read_one,todo,chunksize=16);
+        errors=self._store_all(results);
+        pool.close();
+      except:
+        pool.terminate();
+        raise;
+      finally:
+        pool.join();
+    else:
+      errors=self._store_all(_read_one(t) for t in todo);
+
+    return len(todo)-len(errors),unchanged,errors;
+
+  def _store_all(self, results):
+    errors=[];
+    for path,size,mtime,header,err in results:
+      if err is None:
+        self.store(path,size,mtime,header);
+      else:
+        errors.append((path,err));
+    self.db.commit();
+    return errors;
+
+  def prune(self):
+    """ Forget any P-files which no longer exist """
+    gone=[p for (p,) in self.db.execute('SELECT path FROM headers') if not os.path.exists(p)];
+    self.db.executemany('DELETE FROM headers WHERE path=?',[(p,) for p in gone]);
+    self.db.commit();
+    return len(gone);
+
+  def select(self, paths=None, contains=None):
+    """ pfile objects from the index, optionally limited to those under paths, or matching text """
+    pfiles=[];
+    for path,text in self.db.execute('SELECT path, header FROM headers ORDER BY patient_name, shortname'):
+      if paths is not None and not any(path==p or path.startswith(os.path.join(p,'')) for p in [os.path.abspath(x) for x in paths]):
+        continue;
+      header=_decode(text);
+      if contains is not None and not any(contains in str(header.get(c,'')) for c in ['patient_name','shortname','series_description']):
+        continue;
+      pfiles.append(pfile(header));
+    return pfiles;
+
+if __name__=='__main__': # {{{
+  state=None;
+  index_file=None;
+  njobs=1;
+  contains=None;
+  paths=[];
+  for k in sys.argv[1:]:
+    if state is None:
+      if k in ['-d','-j','-q']:
+        state=k;
+      else:
+        paths.append(k);
+    elif state=='-d':
+      index_file=k;
+      state=None;
+    elif state=='-j':
+      njobs=int(k);
+      state=None;
+    elif state=='-q':
+      contains=k;
+      state=None;
+
+  index=PfileIndex(index_file);
+  if len(paths)>0:
+    nread,nunchanged,errors=index.update(paths,njobs=njobs);
+    for path,err in errors:
+      sys.stderr.write('%s : %s\n' % (path,err));
+    sys.stderr.write('%d header(s) read, %d unchanged, %d unreadable\n' % (nread,nunchanged,len(errors)));
+
+  for P in index.select(paths if len(paths)>0 else None, contains):
+    print '%-30s %-25s %6s  %-19s %s' % (P.fullpath, P.patient_name, P.te, P.exam_datetime, P.series_description);
+  index.close();
+# }}}
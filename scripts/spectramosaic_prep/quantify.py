@@ -0,0 +1,214 @@
+#!/usr/bin/python
+"""
+In-process spectral quantification, as an alternative to running Tarquin for each voxel.
+
+Like quick_quantify, this is quick-and-dirty: coil combination and averaging of the raw data, FFT,
+frequency referencing and zero-order phasing, then a linear-combination fit of a basis set plus a
+smooth baseline. Voxels with the same acquisition parameters are fitted together, as stacked arrays.
+
+The built-in basis is a set of simulated peaks for short-TE 1H brain PRESS (and a rudimentary one for
+MEGA-PRESS difference spectra); a measured basis can be used instead, as a csv file with a header row
+of metabolite names, the first column being ppm (see load_basis).
+"""
+
+import os;
+import sys;
+import numpy as np;
+from collections import OrderedDict;
+
+water_ppm=4.68;
+
+default_spectral_width=5000.0; # Hz
+default_frequency=127.8;       # MHz
+
+fit_range=(0.2,4.0);   # ppm
+output_range=(-1,5);   # ppm, as filtered from Tarquin's output by spectramosaic_prep
+
+# metabolite => list of (ppm, relative area); lipids and macromolecules get broader lines
+basis_peaks={
+  'press': OrderedDict([
+    ('NAA',   [(2.008,3.),(2.486,.5),(2.673,.5)]),
+    ('NAAG',  [(2.042,3.)]),
+    ('Cr',    [(3.027,3.),(3.913,2.)]),
+    ('Cho',   [(3.208,9.)]),
+    ('mI',    [(3.522,2.),(3.614,2.),(4.054,1.),(3.269,1.)]),
+    ('Glu',   [(2.35,2.),(2.08,2.),(3.75,1.)]),
+    ('Gln',   [(2.45,2.),(2.12,2.),(3.76,1.)]),
+    ('GABA',  [(3.01,2.),(2.28,2.),(1.89,2.)]),
+    ('Lac',   [(1.31,3.),(4.10,1.)]),
+    ('Lip09', [(0.89,3.)]),
+    ('Lip13', [(1.28,6.)]),
+    ('MM20',  [(2.0,3.)]),
+  ]),
+  'mega_press': OrderedDict([
+    ('GABA+', [(2.99,2.)]),
+    ('Glx',   [(3.75,2.)]),
+    ('NAA',   [(2.008,-3.)]),
+  ]),
+}
+broad=['Lip09','Lip13','MM20'];
+
+def pfile_parameters(P): # {{{
+  """ (npoints, spectral width in Hz, transmit frequency in MHz, is_mega) for a pfile; defaults where the header looks implausible """
+  sw=P.header.get('spectral_width');
+  if sw is None or not (100<sw<100000):
+    sw=default_spectral_width;
+  f0=P.header.get('ps_mps_freq');
+  if f0 is None or not (1e8<f0<1e10):
+    f0=default_frequency;
+  else:
+    f0=f0/1e7;
+  return (P.header['MRS_struct.p.npoints'], float(sw), float(f0), P.nechoes==2);
+# }}}
+
+def combine_fid(P): # {{{
+  """ Coil-combined, averaged FID of a pfile, reading one receiver at a time.
+
+  Receivers are weighted by their (complex conjugate) first point, so that they add in phase. MEGA
+  data (two echoes) are returned as the difference of the two. GE raw data have the opposite
+  frequency sense to the usual convention, so the result is conjugated.
+  """
+  acc=None;
+  norm=0.;
+  for receiver,chunk in P.iter_raw(by='receiver'):
+    avg=chunk[0].mean(axis=1); # (nechoes, npoints)
+    w=np.conj(avg[0,0]);
+    if acc is None:
+      acc=np.zeros(avg.shape,dtype='complex128');
+    acc+=w*avg;
+    norm+=abs(w);
+  if norm>0:
+    acc/=norm;
+  if acc.shape[0]==2:
+    return np.conj(acc[1]-acc[0]);
+  return np.conj(acc[0]);
+# }}}
+
+def ppm_axis(npoints, sw, f0): # {{{
+  freq=np.fft.fftshift(np.fft.fftfreq(npoints,1.0/sw));
+  return water_ppm-freq/f0;
+# }}}
+
+def to_spectra(fids, sw, lb=2.0): # {{{
+  """ Apodize (lb Hz exponential) and Fourier transform a stack of FIDs, (nvox, npoints) """
+  t=np.arange(fids.shape[-1])/sw;
+  return np.fft.fftshift(np.fft.fft(fids*np.exp(-np.pi*lb*t),axis=-1),axes=-1);
+# }}}
+
+def reference_and_phase(spectra, ppm, ref_peak=2.008, search=0.15): # {{{
+  """ Shift each spectrum so its largest peak near ref_peak (NAA) lands on it, then zero-order phase it to maximise the real part over the fit range """
+  n=spectra.shape[-1];
+  near=np.abs(ppm-ref_peak)<search;
+  idx=np.flatnonzero(near);
+  peak=idx[np.argmax(np.abs(spectra[:,near]),axis=1)];
+  target=np.argmin(np.abs(ppm-ref_peak));
+  shift=target-peak;
+  # circular shift of each row by its own amount, in one indexing operation
+  cols=(np.arange(n)[None,:]-shift[:,None])%n;
+  spectra=spectra[np.arange(spectra.shape[0])[:,None],cols];
+
+  inrange=np.logical_and(ppm>fit_range[0],ppm<fit_range[1]);
+  phi=-np.angle(spectra[:,inrange].sum(axis=1));
+  return spectra*np.exp(1j*phi)[:,None];
+# }}}
+
+def load_basis(fn, ppm): # {{{
+  """ Basis set from a csv file (header row of names; first column ppm, then one column per metabolite), interpolated onto ppm """
+  with open(fn) as f:
+    names=[x.strip() for x in f.readline().split(',')][1:];
+  data=np.loadtxt(fn,delimiter=',',skiprows=1);
+  order=np.argsort(data[:,0]);
+  basis=np.array([np.interp(ppm,data[order,0],data[order,i+1],left=0,right=0) for i in range(len(names))]);
+  return names,basis;
+# }}}
+
+def simulate_basis(ppm, f0, kind='press', lw=8.0): # {{{
+  """ Basis of real Lorentzian lines (lw Hz FWHM, allowing for to_spectra's apodization; 5 times that for lipids/macromolecules), (nbasis, npoints) """
+  names=list(basis_peaks[kind].keys());
+  basis=np.zeros((len(names),ppm.size));
+  for i,name in enumerate(names):
+    hw=0.5*lw*(5 if name in broad else 1)/f0; # half width in ppm
+    peaks=np.array(basis_peaks[kind][name]);
+    d=ppm[None,:]-peaks[:,0][:,None];
+    basis[i]=(peaks[:,1][:,None]*hw/(np.pi*(d**2+hw**2))).sum(axis=0);
+  return names,basis;
+# }}}
+
+def baseline_basis(ppm, spacing=0.5): # {{{
+  """ Smooth baseline functions: gaussians every `spacing` ppm over the fit range """
+  centres=np.arange(fit_range[0]-spacing,fit_range[1]+spacing*1.01,spacing);
+  return np.exp(-0.5*((ppm[None,:]-centres[:,None])/(0.7*spacing))**2);
+# }}}
+
+def fit_spectra(spectra, ppm, basis): # {{{
+  """ Linear-combination fit of stacked real spectra (nvox, npoints) to a basis (nbasis, npoints) plus a smooth baseline.
+
+  All voxels are solved together by least squares; metabolites which come out negative are dropped and
+  those voxels refitted, until all amplitudes are non-negative.
+
+  Returns (fit, baseline, amplitudes), fit including the baseline.
+  """
+  nb=basis.shape[0];
+  bl=baseline_basis(ppm);
+  X=np.vstack((basis,bl));
+  inrange=np.logical_and(ppm>fit_range[0],ppm<fit_range[1]);
+  A=X[:,inrange].T;
+  coef=np.linalg.lstsq(A,spectra[:,inrange].T,rcond=None)[0].T; # (nvox, nb+nbl)
+
+  for v in np.flatnonzero((coef[:,:nb]<0).any(axis=1)):
+    active=np.ones(X.shape[0],dtype=bool);
+    while True:
+      c=np.zeros(X.shape[0]);
+      c[active]=np.linalg.lstsq(A[:,active],spectra[v,inrange],rcond=None)[0];
+      neg=np.flatnonzero(c[:nb]<0);
+      if len(neg)==0:
+        break;
+      active[neg]=False;
+    coef[v]=c;
+
+  baseline=coef[:,nb:].dot(bl);
+  fit=coef[:,:nb].dot(basis)+baseline;
+  return fit,baseline,coef[:,:nb];
+# }}}
+
+def quantify_pfiles(pfiles, basis_file=None, lw=8.0): # {{{
+  """ Quantify a list of pfiles; returns, for each, (four-column array of ppm/raw/fit/baseline, OrderedDict of amplitudes).
+
+  pfiles with the same number of points, spectral width, frequency and sequence are fitted as one batch.
+  """
+  groups=OrderedDict();
+  for i,P in enumerate(pfiles):
+    groups.setdefault(pfile_parameters(P),[]).append(i);
+
+  results=[None]*len(pfiles);
+  for (npoints,sw,f0,is_mega),members in groups.items():
+    ppm=ppm_axis(npoints,sw,f0);
+    fids=np.array([combine_fid(pfiles[i]) for i in members]);
+    spectra=reference_and_phase(to_spectra(fids,sw),ppm).real;
+    if basis_file is not None:
+      names,basis=load_basis(basis_file,ppm);
+    else:
+      names,basis=simulate_basis(ppm,f0,'mega_press' if is_mega else 'press',lw=lw);
+    fit,baseline,amplitudes=fit_spectra(spectra,ppm,basis);
+
+    keep=np.logical_and(ppm<output_range[1],ppm>output_range[0]);
+    order=np.argsort(-ppm[keep]); # descending ppm, as in Tarquin's output
+    for j,i in enumerate(members):
+      data=np.column_stack((ppm[keep],spectra[j,keep],fit[j,keep],baseline[j,keep]))[order];
+      results[i]=(data,OrderedDict(zip(names,amplitudes[j])));
+  return results;
+# }}}
+
+def write_amplitudes(fn, amplitudes): # {{{
+  with open(fn,'w') as f:
+    f.write(','.join(amplitudes.keys())+'\n');
+    f.write(','.join(['%.5e' % (x,) for x in amplitudes.values()])+'\n');
+# }}}
+
+if __name__=='__main__':
+  from pfile import pfile;
+  pfiles=[pfile.from_file(fn) for fn in sys.argv[1:]];
+  for P,(data,amplitudes) in zip(pfiles,quantify_pfiles(pfiles)):
+    print P.shortname;
+    for k in amplitudes:
+      print '  %-8s : %.4g' % (k,amplitudes[k]);
@@ -9,6 +9,85 @@ Usage
 
     -o [foldername] : Root folder for output data
 
+  Optionally, independent voxels and sessions may be processed in parallel:
+
+    -j [N]          : Number of worker processes (default 1). Mask generation is still serialised within each
+                      working folder, as all voxels of a subject share one structural registration (volume.nii).
+
+  P-file headers may be taken from a persistent index (see pfileindex.py), rather than re-read on every run:
+
+    -x [filename]   : P-file header index; headers of new or changed P-files are read and added to it
+
+  Spectra are quantified by Tarquin, unless an in-process fit is requested (see quantify.py):
+
+    --quantify [tarquin|native] : quantification method (default tarquin)
+    --basis [filename]          : basis set for the native fit, as a csv of ppm and one column per metabolite
+
+  Spectra may also be exported as float32, already resampled for the viewer, and packed into one file for
+  the whole output root (spectra.f32, with a spectra.json manifest; see spectrumbin.py):
+
+    --binary        : write <voxel>.f32 alongside each voxel's csv, and the packed spectra.f32
+
+  The whole output may also be collected into a single uncompressed zip, laid out as the output folder,
+  to which each voxel is added as soon as it is finished (see studyarchive.py):
+
+    --archive [filename] : study archive to write (or update)
+
+  Voxel masks are made by gemask.m, unless the pure-python rasterizer is requested (see voxelmask.py; needs pydicom):
+
+    --mask-engine [matlab|python] : mask generation method (default matlab)
+
+  The python rasterizer assembles each session's structural volume (volume.nii) once, from an index of the
+  DICOM folder's slices, which is kept in the working folder (see dicomindex.py), or may be shared between runs:
+
+    --dicom-index [filename] : DICOM slice index; folders which are new or have changed are (re-)scanned and added to it
+
+  Mask images are drawn with PIL, or, faster, straight onto a uint8 buffer with cv2 (outlines differ slightly):
+
+    --render-backend [pil|cv2] : mask image drawing (default pil)
+    --png-level [0-9]          : PNG compression level of the mask images (lower is faster, but larger)
+    --writer-threads [N]       : encode and write mask images on N background threads, overlapping rendering
+
+  Mask images are sliced along the volume's axes, or along the planes of each voxel's own (possibly oblique)
+  PRESS box, as its P-file header gives them, sampled straight at the image resolution:
+
+    --render-plane [scanner|voxel] : slicing of the mask images (default scanner)
+
+  Tarquin's PDF report is rasterized (by ImageMagick convert, at 300 dpi) to a QA preview in the working folder,
+  as each spectrum is quantified; this is slow, so may be left until everything else is done, or skipped:
+
+    --previews [now|later|off] : when to convert the PDF reports (default now)
+
+  External tools (tarquin, convert, matlab) write their output to a log per voxel and tool in the working
+  folder (eg. <voxel>.tarquin.log). How many of each may run at once, and for how long, may be limited:
+
+    --tool-limit [tool=N]      : at most N instances of tool at once, eg. --tool-limit tarquin=8 --tool-limit matlab=2
+    --tool-timeout [tool=S]    : kill tool if it runs for longer than S seconds (failing the step)
+
+  Each stage of each voxel (header, mask, render, tarquin, convert, export, ...) is timed, and a table of wall
+  and CPU time, peak memory and bytes read/written by stage is printed at the end (see stagetimer.py):
+
+    --profile [foldername]     : also write every stage's figures to stages.json and stages.csv there
+    --profile-stage [stage]    : run a stage (eg. render, or 'render spectramosaic ax') under cProfile, writing .prof files to the --profile folder
+
+  Mask generation normally starts MATLAB (or the compiled version) afresh for every voxel. Instead, a fixed
+  number of MATLAB workers can be kept running for the whole run (see maskworkers.py):
+
+    --mask-workers [N]                 : number of warm mask generation workers
+    --mask-worker [engine|matlab|stub] : how to run them (default: matlab.engine if installed, else matlab)
+
+  --tool-timeout matlab=S applies to each mask a worker makes, too: a worker which takes longer is killed,
+  and restarted, and the mask tried once more.
+
+  Steps are skipped when a record of their inputs' contents and parameters (kept in .buildcache folders
+  next to their outputs) shows nothing relevant has changed; this can be overridden:
+
+    --force         : redo every step
+
+  The plan may be checked first, without processing (or even writing) anything:
+
+    --dry-run, --list : print the voxel tree and header info rows which would be produced, reading only the P-file headers
+
 
   Input data may be specified either as a folder to be scanned for input data (for ONE session):
 
@@ -31,10 +110,19 @@ Usage
     python spectramosaic_prep.py -o /scratch/spectramosaic /data/spectra/alex/5809/2 /data/spectra/alex/P*7 
 
 
-  FUTURE: This may be extended to allow processing of multi-session/longitudinal data from a single subject, in which case the usage would most likely follow the pattern:
+  Several sessions (eg. of longitudinal data) may be given one after another, in the same way:
 
     [struct_sess1] [pfile_sess1_1] [pfile_sess2_2] ... [struct_sess2] [pfile_sess2_1] [pfile_sess2_2]
 
+  ..OR, for a whole cohort, as a manifest of subject => session => structural folder and P-files, in json,
+  yaml or csv (see cohort.py). All sessions are then scheduled together, as one set of jobs:
+
+    --manifest [filename] : sessions to process (may be given more than once, and mixed with the above)
+
+  Each voxel is noted in the working folder as it is finished, so an interrupted run may be picked up again:
+
+    --resume        : leave out the voxels already finished, from the same inputs and with the same options
+
 
 
 Output
@@ -56,8 +144,11 @@ Output
 
   This file contains data for fall subjects/voxels.
 
-  Voxel ID;Patient;State;Time;Gender;Age;TE;location
-  voxel_xxx;patient_xxx;something;something;something;something;something;somewhere
+  Voxel ID;Patient;State;Time;Gender;Age;TE;location;GM;WM;CSF
+  voxel_xxx;patient_xxx;something;something;something;something;something;somewhere;0.xx;0.xx;0.xx
+
+  GM, WM and CSF are the fractions of the voxel in each tissue class, from the structural's segmentations
+  (c1/c2/c3volume.nii, if the mask step made them; see tissuefractions.py), and are otherwise left empty.
 
 Per-voxel files
 ---------------
@@ -79,11 +170,20 @@ Per-voxel files
 
 import sys;
 import os;
-from collections import defaultdict;
+import re;
+import csv;
+from collections import defaultdict, OrderedDict;
 import shutil;
+import zlib;
+import hashlib;
 import subprocess;
 from pfile import *;
-from mergemasks import *;
+from jobgraph import *;
+from pfileindex import PfileIndex;
+from buildcache import BuildCache, portable, signature;
+from toolrunner import ToolRunner, shared_runner, parse_setting;
+import stagetimer;
+from stagetimer import stage;
 
 # Various little helper functions {{{
 def is_uptodate(fns,refs):
@@ -124,11 +224,30 @@ def sanitize_string(string,spaces_ok=True):
 
 # }}}
 
-def run_run_makemask(*args): # {{{
-  """ Invoke the matlab-based mask generation script; through matlab if possible, or via pre-compiled version """
+def run_run_makemask(*args, **kw): # {{{
+  """ Invoke the matlab-based mask generation script; through matlab if possible, or via pre-compiled version
+
+  If a MaskWorkerPool (or a proxy for one) is given as pool=..., the job is sent to one of its warm workers instead.
+  Otherwise, MATLAB is run through a ToolRunner (runner=..., see toolrunner.py), as tool 'matlab'. Its output
+  goes to log_file=... (by default makemask.log in the output folder).
+  """
 
   where_am_i=os.path.dirname(os.path.realpath(__file__));
 
+  log_file=kw.get('log_file');
+  if log_file is None:
+    log_file=os.path.join(args[-1],'makemask.log');
+
+  pool=kw.get('pool');
+  if pool is not None:
+    with open(log_file,'wb') as log:
+      log.write(pool.makemask(*(list(args)+['native_mask'])));
+    return;
+
+  runner=kw.get('runner');
+  if runner is None:
+    runner=ToolRunner();
+
   run_makemask=os.path.join(where_am_i,'build','distrib','run_makemask.sh');
 
   if not is_uptodate(run_makemask,os.path.join(where_am_i,'gemask.m')):
@@ -152,10 +271,8 @@ def run_run_makemask(*args): # {{{
       "exit;"
       ];
 
-    p = subprocess.Popen(['matlab','-nodisplay','-nosplash','-nojvm'], stdout=subprocess.PIPE, stdin=subprocess.PIPE, stderr=subprocess.PIPE, env=env_noX); #cwd=self.uniquedir)
-    output,err=p.communicate('\n'.join(cmds));
-    print output;
-    print err;
+    status=runner.run('matlab',['matlab','-nodisplay','-nosplash','-nojvm'],log_file,input='\n'.join(cmds),env=env_noX);
+    print 'matlab exited with %d; log in %s' % (status,log_file);
 
   #}}}
   else:
@@ -173,66 +290,83 @@ def run_run_makemask(*args): # {{{
     else:
       # FIXME need to check for compatible architecture, rather than just blindly assuming we're running on linux.
       bits=[run_makemask,MCR_folder]+list(args)+['native_mask'];
-      subprocess.call(bits);
+      status=runner.run('matlab',bits,log_file);
       print bits;
+      print 'exited with %d; log in %s' % (status,log_file);
 
     print 'matlab command: %s; runtime: %s' % (matlab, MCR_folder);
     # }}}
 
 # }}}
 
-def update_header_info(output_root, pfiles): # {{{
+def header_row(pfile): # {{{
+  """ A voxel's row of ..._header_info.csv, as a dict of column => value """
+  return {
+    'Voxel ID' : pfile.shortname,
+    'Patient'  : sanitize_string(pfile.patient_name,spaces_ok=False), # needs to EXACTLY match output folder name
+    'State'    : pfile.series_protocol,
+    'Time'     : pfile.exam_datetime,
+    'Gender'   : pfile.patient_sex,
+    'Age'      : pfile.patient_age,
+    'TE'       : pfile.te/1000,
+    'location' : pfile.series_description
+  };
+# }}}
+
+def update_header_info(output_root, pfiles, index=None, write_csv=True, struct_folders=None): # {{{
   """ Update the ..._header_info.csv file to incorporate entries from additional pfiles 
 
   Existing rows are retained, or updated if they match the input.
+  pfiles may be pfile objects, or filenames to be looked up in a PfileIndex. Each row has the voxel's tissue
+  fractions, if they were worked out (see prep_tissue) and its structural folder is in struct_folders (a dict of
+  absolute P-file path => structural folder).
 
+  Rows are kept in a HeaderStore in the working folder (seeded from an existing csv), so only the new rows
+  are written; the csv itself is rewritten from the store only if write_csv. Returns the csv filename.
   """
 
-  import csv;
+  from headerstore import HeaderStore;
+  import tissuefractions;
   output_file_name=os.path.join(output_root,'something_header_info.csv');
+  scratch_folder=os.path.join(output_root,'')[:-1]+'.working';
+  if not os.path.isdir(scratch_folder):
+    os.makedirs(scratch_folder);
 
-  horder=['Voxel ID','Patient','State','Time','Gender','Age','TE','location'];
-
-  all_rows=[];
-
-  if os.path.exists(output_file_name):
-    with open(output_file_name,'rb') as csvfile:
-      hreader=csv.DictReader(csvfile,delimiter=';');
-      for row in hreader:
-        all_rows.append(row);
-
-
+  rows=[];
   for pfile in pfiles:
-    row={
-      'Voxel ID' : pfile.shortname,
-      'Patient'  : sanitize_string(pfile.patient_name,spaces_ok=False), # needs to EXACTLY match output folder name
-      'State'    : pfile.series_protocol,
-      'Time'     : pfile.exam_datetime,
-      'Gender'   : pfile.patient_sex,
-      'Age'      : pfile.patient_age,
-      'TE'       : pfile.te/1000,
-      'location' : pfile.series_description
-    };
-    all_rows.append(row);
-
-  # filter to keep only the most recent
-  row_dict={};
-  for row in all_rows:
-    key='P:'+row['Patient']+',V:'+row['Voxel ID'];
-    row_dict[key]=row;
-
-  # write out, sorted by patient/ID
-  with open(output_file_name,'wb') as csvfile:
-    hwriter=csv.DictWriter(csvfile,horder,delimiter=';');
-    hwriter.writeheader();
-    for key in sorted(row_dict):
-      hwriter.writerow(row_dict[key]);
-  print output_file_name;
+    if isinstance(pfile,basestring):
+      pfile=index.get(pfile);
+    row=header_row(pfile);
+    struct_folder=None;
+    if struct_folders:
+      struct_folder=struct_folders.get(os.path.abspath(pfile.fullpath));
+    if struct_folder is not None:
+      voxel_folder,voxel_working_folder=voxel_folders(output_root,pfile,struct_folder);
+      row.update(tissuefractions.read_fractions(os.path.join(voxel_working_folder,'%s_mask.nii' % (pfile.shortname,))));
+    rows.append(row);
+
+  store=HeaderStore(os.path.join(scratch_folder,'header_info.sqlite'),output_file_name);
+  try:
+    store.put(rows);
+    if write_csv:
+      store.write_csv(output_file_name);
+      print output_file_name;
+  finally:
+    store.close();
+  return output_file_name;
 # }}}
 
-def quick_quantify(P,output_folder): # {{{
-  """ Quick-and-dirty spectral quantification. Might be okay for short TE, humanoid, brain, proton, PRESS data. This needs improvement. """
+def quick_quantify(P,output_folder,cache=None,previews='now',runner=None): # {{{
+  """ Quick-and-dirty spectral quantification. Might be okay for short TE, humanoid, brain, proton, PRESS data. This needs improvement.
+
+  Given a BuildCache, Tarquin and convert are re-run only if the P-file or their command lines have changed;
+  otherwise Tarquin is run only if its output doesn't exist. The PDF report is converted to a preview image
+  (see convert_preview) only if previews=='now'. Tools are run through runner (a ToolRunner), with their
+  output logged to <voxel>.<tool>.log in output_folder.
+  """
   tarquin=which('tarquin');
+  if runner is None:
+    runner=ToolRunner();
 
   basefn=os.path.join(output_folder,P.shortname);
   P.describe()
@@ -290,160 +424,721 @@ def quick_quantify(P,output_folder): # {{{
       '--input',P.fullpath
     ]
 
-    if not os.path.exists(basefn+'.fit.csv'):
-      subprocess.call(cmd);
+    if cache is None:
+      if not os.path.exists(basefn+'.fit.csv'):
+        run_tool(runner,'tarquin',cmd,basefn);
+    elif not cache.is_current('tarquin_'+P.shortname,[basefn+'.fit.csv'],[P.fullpath],{'cmd':portable(cmd)}):
+      run_tool(runner,'tarquin',cmd,basefn);
+      cache.record('tarquin_'+P.shortname,[basefn+'.fit.csv'],[P.fullpath],{'cmd':portable(cmd)});
 
-    convert=which('convert');
-
-    if os.path.exists(basefn+'.pdf') and convert is not None:
-      subprocess.call([convert,'-density','300',basefn+'.pdf','-trim','+repage','-resize','800x600','-background','#FFFFFF','-flatten',basefn+'.png']);
+    if previews=='now':
+      convert_preview(P,output_folder,cache,runner);
 
 
   #lcmodel=which('lcmodel');
 
   # }}}
 
-def spectramosaic_prep(output_root, struct_folder, pfile_names): # {{{
-  """Do the things."""
+def convert_preview(P,output_folder,cache=None,runner=None): # {{{
+  """ Rasterize Tarquin's PDF report (if there is one) to a PNG preview """
+  basefn=os.path.join(output_folder,P.shortname);
+  convert=which('convert');
+  if runner is None:
+    runner=ToolRunner();
+
+  if os.path.exists(basefn+'.pdf') and convert is not None:
+    convert_cmd=[convert,'-density','300',basefn+'.pdf','-trim','+repage','-resize','800x600','-background','#FFFFFF','-flatten',basefn+'.png'];
+    if cache is None or not cache.is_current('convert_'+P.shortname,[basefn+'.png'],[basefn+'.pdf'],{'cmd':portable(convert_cmd)}):
+      run_tool(runner,'convert',convert_cmd,basefn);
+      if cache is not None:
+        cache.record('convert_'+P.shortname,[basefn+'.png'],[basefn+'.pdf'],{'cmd':portable(convert_cmd)});
+# }}}
 
-  if not os.path.exists(struct_folder):
-    raise IOError('Specified structural folder does not exist: %s' % (struct_folder,));
+def run_tool(runner, tool, cmd, basefn): # {{{
+  """ Run a tool for a voxel, logging to <basefn>.<tool>.log """
+  log_file='%s.%s.log' % (basefn,tool);
+  with stage(tool,os.path.basename(basefn)):
+    status=runner.run(tool,cmd,log_file);
+  print '%s exited with %d; log in %s' % (tool,status,log_file);
+  return status;
+# }}}
 
-  if not os.path.isdir(struct_folder):
-    raise IOError('Specified structural folder is not actually a folder: %s' % (struct_folder,));
+def job_summary(cache): # {{{
+  """ A job's result: its cache hits and misses, and the stages it timed (see stagetimer.py) """
+  summary=cache.summary();
+  summary['stages']=stagetimer.collect();
+  return summary;
+# }}}
 
-  # create a working area, separate but related to the output_root
-  scratch_folder=os.path.join(output_root,'')[:-1]+'.working';
-  print os.path.join(output_root,'')[:-1];
-  print scratch_folder;
-  if not os.path.exists(scratch_folder):
-    os.makedirs(scratch_folder);
+def session_subfolder(struct_folder): # {{{
+  """ Working subfolder of a session, by its structural folder's name and a hash of its path (names may repeat across subjects' folders) """
+  path=os.path.abspath(struct_folder);
+  return '%s.%s' % (sanitize_string(os.path.basename(os.path.normpath(path)),spaces_ok=False),hashlib.sha1(path).hexdigest()[:8]);
+# }}}
 
-  pfiles=[];
-  for fn in pfile_names:
-    P=pfile.from_file(fn);
-    pfiles.append(P);
-    print sanitize_string(P.series_description);
-    subject_subfolder=sanitize_string(P.patient_name,spaces_ok=False);
-    spect_subfolder=P.shortname;
+def voxel_folders(output_root, P, struct_folder=None): # {{{
+  """ Output and working folders for a voxel; the working folder is shared by all voxels of a subject or, given
+  struct_folder, by all voxels of the subject's session with that structural (volume.nii, masks and mask images)
+  """
+  scratch_folder=os.path.join(output_root,'')[:-1]+'.working';
+  subject_subfolder=sanitize_string(P.patient_name,spaces_ok=False);
+  voxel_folder=os.path.join(output_root,subject_subfolder,P.shortname);
+  # working folder separated by session, but not by voxel (saves having to re-register structural to template for each voxel)
+  voxel_working_folder=os.path.join(scratch_folder,subject_subfolder);
+  if struct_folder is not None:
+    voxel_working_folder=os.path.join(voxel_working_folder,session_subfolder(struct_folder));
+  return voxel_folder,voxel_working_folder;
+# }}}
 
-    voxel_folder=os.path.join(output_root,subject_subfolder,spect_subfolder);
-    if not os.path.isdir(voxel_folder):
-      os.makedirs(voxel_folder);
+def prep_volume(output_root, struct_folder, working_folders, force=False, dicom_index=None, signatures=None): # {{{
+  """ Job: assemble a session's structural series once, and write it as the volume.nii of each of its working folders, for
+  mask_engine='python'; the series' slices are taken from dicom_index (a DicomIndex filename; see dicomindex.py), if given.
+  signatures are of the session's structural (see plan_session). Returns cache hits/misses
+  """
+  cache=BuildCache(force=force,signatures=signatures);
+  params={'engine':'python'};
+  todo=[];
+  for voxel_working_folder in working_folders:
+    expected_volume_nii=os.path.join(voxel_working_folder,'volume.nii');
+    if cache.is_current('volume',[expected_volume_nii],[struct_folder],params):
+      print 'Structural volume %s is up-to-date.' % (expected_volume_nii,);
+    else:
+      todo.append(voxel_working_folder);
+  if len(todo)>0:
+    import voxelmask;
+    from dicomindex import DicomIndex;
+    index=DicomIndex(dicom_index) if dicom_index is not None else None;
+    try:
+      with stage('volume',os.path.basename(os.path.normpath(struct_folder))):
+        for volume_nii in voxelmask.write_volume(struct_folder,todo,index):
+          print volume_nii;
+    finally:
+      if index is not None:
+        index.close();
+    for voxel_working_folder in todo:
+      cache.record('volume',[os.path.join(voxel_working_folder,'volume.nii')],[struct_folder],params);
+  return job_summary(cache);
+# }}}
 
-    # working folder separated by session, but not by voxel (saves having to re-register structural to template for each voxel)
-    voxel_working_folder=os.path.join(scratch_folder,subject_subfolder);
-    if not os.path.isdir(voxel_working_folder):
-      os.makedirs(voxel_working_folder);
+def prep_mask(output_root, struct_folder, header, force=False, mask_pool=None, mask_engine='matlab', runner=None, signatures=None): # {{{
+  """ Job: generate the voxel mask (and, for mask_engine='matlab', the shared volume.nii) in the working folder; returns cache hits/misses
 
-    # populate with dummy data, for now:
+  mask_engine is 'matlab' (gemask.m, see run_run_makemask) or 'python' (see voxelmask.py; volume.nii is then
+  written beforehand, once for the session, by prep_volume). signatures are of the session's structural, worked
+  out once for all its voxels (see plan_session).
+  """
+  cache=BuildCache(force=force,signatures=signatures);
+  P=pfile(header);
+  fn=P.fullpath;
+  voxel_folder,voxel_working_folder=voxel_folders(output_root,P,struct_folder);
+
+  expected_mask_nii=os.path.join(voxel_working_folder,'%s_mask.nii' % (P.shortname));
+  expected_volume_nii=os.path.join(voxel_working_folder,'volume.nii');
+
+  outputs=[expected_volume_nii,expected_mask_nii];
+  inputs=[fn,struct_folder];
+  params={'makemask':portable([fn,struct_folder,'output_folder',voxel_working_folder]),'engine':mask_engine};
+  if cache.is_current('mask_'+P.shortname,outputs,inputs,params):
+    print 'Mask nifti %s is up-to-date.' % (expected_mask_nii)
+  else:
+    print 'Mask nifti %s required.' % (expected_mask_nii)
+    with stage('mask %s' % (mask_engine,),P.shortname):
+      if mask_engine=='python':
+        import voxelmask;
+        import nibabel as nib;
+        voxelmask.make_mask(P.header,struct_folder,voxel_working_folder,volume=nib.load(expected_volume_nii),save_volume=False);
+      else:
+        run_run_makemask(fn,struct_folder,'output_folder',voxel_working_folder,pool=mask_pool,runner=runner,log_file=os.path.join(voxel_working_folder,'%s.makemask.log' % (P.shortname)));
+    cache.record('mask_'+P.shortname,outputs,inputs,params);
+  return job_summary(cache);
+# }}}
 
-    import shutil;
-    import numpy as np;
+def prep_renders(output_root, struct_folder, headers, force=False, backend='pil', png_level=None, writer_threads=0, render_plane='scanner'): # {{{
+  """ Job: render the mask images of a batch of voxels sharing a working folder (see mergemasks.render_voxels), and copy them to the voxels' output folders; returns cache hits/misses
 
-    if False:
-      # is this thing actually used? Nope.
-      from PIL import Image;
-      i=Image.open('./extra/test_data/subj1.png');
-      r=i.rotate(180);
-      r.save(os.path.join(voxel_folder,'%s.7.png' % (P.shortname)));
+  render_plane is 'scanner', for slices along the volume's axes, or 'voxel', for slices along each voxel's own
+  PRESS box, from its header (see mergemasks.render_oblique).
+  """
+  import mergemasks; # the imaging stack (nibabel, scipy, PIL, cv2); only needed here
+  cache=BuildCache(force=force);
+  params={'mode':'spectramosaic'};
+  if backend!='pil':
+    params['backend']=backend; # existing records stand for pil
+  if png_level is not None:
+    params['png_level']=png_level;
+  if render_plane!='scanner':
+    params['plane']=render_plane;
+
+  todo=OrderedDict();
+  copies=[];
+  for header in headers:
+    P=pfile(header);
+    voxel_folder,voxel_working_folder=voxel_folders(output_root,P,struct_folder);
 
     expected_mask_nii=os.path.join(voxel_working_folder,'%s_mask.nii' % (P.shortname));
     expected_volume_nii=os.path.join(voxel_working_folder,'volume.nii');
 
-
-    if is_uptodate([expected_volume_nii,expected_mask_nii],[fn,struct_folder]):
-      print 'Mask nifti %s is up-to-date.' % (expected_mask_nii)
-    else:
-      print 'Mask nifti %s required.' % (expected_mask_nii)
-      run_run_makemask(fn,struct_folder,'output_folder',voxel_working_folder);
-
     expected_mask_images={};
     for orientation in ['sag','ax','cor']:
       expected_mask_images[os.path.join(voxel_working_folder,'%s_mask_spectramosaic_%s.png' % (P.shortname,orientation))]=os.path.join(voxel_folder,'%s_mask_spectramosaic_%s.png' % (P.shortname,orientation));
+    copies+=expected_mask_images.items();
 
-    if is_uptodate(expected_mask_images.keys(),[expected_mask_nii,expected_volume_nii]):
-      print 'Mask images are up-to-date.';
+    outputs=sorted(expected_mask_images.keys());
+    inputs=[expected_mask_nii,expected_volume_nii];
+    if cache.is_current('render_'+P.shortname,outputs,inputs,params):
+      print 'Mask images of %s are up-to-date.' % (P.shortname,);
     else:
       print 'Mask images are required.';
-      print ", ".join(expected_mask_images.keys());
-      merge_masks(expected_volume_nii,expected_mask_nii,mode='spectramosaic');
+      print ", ".join(outputs);
+      todo.setdefault(expected_volume_nii,[]).append((P,expected_mask_nii,outputs,inputs));
 
-    for expected_mask_image in expected_mask_images:
-      if os.path.exists(expected_mask_image):
-        print '%s => %s' % (expected_mask_image, expected_mask_images[expected_mask_image]);
-        shutil.copyfile(expected_mask_image, expected_mask_images[expected_mask_image]);
+  writer=mergemasks.ImageWriter(writer_threads,png_level);
+  try:
+    for expected_volume_nii in todo:
+      if render_plane=='voxel':
+        mergemasks.render_oblique(expected_volume_nii,[expected_mask_nii for P,expected_mask_nii,outputs,inputs in todo[expected_volume_nii]],[P.header for P,expected_mask_nii,outputs,inputs in todo[expected_volume_nii]],mode='spectramosaic',backend=backend,writer=writer);
       else:
-        shutil.copyfile('./extra/test_data/subj1.png',expected_mask_images[expected_mask_image]);
+        mergemasks.render_voxels(expected_volume_nii,[expected_mask_nii for P,expected_mask_nii,outputs,inputs in todo[expected_volume_nii]],mode='spectramosaic',backend=backend,writer=writer);
+  finally:
+    with stage('write images',' '.join(P.shortname for expected_volume_nii in todo for P,expected_mask_nii,outputs,inputs in todo[expected_volume_nii])):
+      writer.close(); # whatever the writer threads have still to do
+  for expected_volume_nii in todo:
+    for P,expected_mask_nii,outputs,inputs in todo[expected_volume_nii]:
+      cache.record('render_'+P.shortname,outputs,inputs,params);
+
+  for expected_mask_image,output_image in copies:
+    if os.path.exists(expected_mask_image):
+      print '%s => %s' % (expected_mask_image, output_image);
+      shutil.copyfile(expected_mask_image, output_image);
+    else:
+      raise IOError('Mask image %s was not rendered (see the mask generation output in %s)' % (expected_mask_image,os.path.dirname(expected_mask_image)));
+  return job_summary(cache);
+# }}}
+
+def prep_tissue(output_root, struct_folder, headers, force=False): # {{{
+  """ Job: the grey matter, white matter and CSF fractions of a batch of voxels sharing a working folder, from its
+  c1/c2/c3 segmentations, if it has them (see tissuefractions.py), all at once; returns cache hits/misses """
+  import tissuefractions;
+  cache=BuildCache(force=force);
+  voxel_folder,voxel_working_folder=voxel_folders(output_root,pfile(headers[0]),struct_folder);
+  segmentations=tissuefractions.segmentations(voxel_working_folder);
+  if segmentations is None:
+    print 'No tissue segmentations in %s; leaving out tissue fractions.' % (voxel_working_folder,);
+    return job_summary(cache);
+
+  todo=[];
+  for header in headers:
+    P=pfile(header);
+    expected_mask_nii=os.path.join(voxel_working_folder,'%s_mask.nii' % (P.shortname));
+    outputs=[tissuefractions.fractions_file(expected_mask_nii)];
+    inputs=[expected_mask_nii]+segmentations;
+    if cache.is_current('tissue_'+P.shortname,outputs,inputs):
+      print 'Tissue fractions of %s are up-to-date.' % (P.shortname,);
+    else:
+      todo.append((P,expected_mask_nii,outputs,inputs));
+
+  if len(todo)>0:
+    with stage('tissue fractions',' '.join(P.shortname for P,expected_mask_nii,outputs,inputs in todo)):
+      print tissuefractions.write_fractions([expected_mask_nii for P,expected_mask_nii,outputs,inputs in todo],segmentations);
+    for P,expected_mask_nii,outputs,inputs in todo:
+      cache.record('tissue_'+P.shortname,outputs,inputs);
+  return job_summary(cache);
+# }}}
 
-    quick_quantify(P,voxel_working_folder);
+def prep_spectrum(output_root, header, force=False, binary=False, previews='now', runner=None): # {{{
+  """ Job: quantify the spectrum and export the four-column csv (and, if binary, the .f32); returns cache hits/misses """
+  import numpy as np;
 
-    tarquin_output=os.path.join(voxel_working_folder,'%s.fit.csv' % (P.shortname));
+  cache=BuildCache(force=force);
+  P=pfile(header);
+  voxel_folder,voxel_working_folder=voxel_folders(output_root,P);
 
-    if os.path.exists(tarquin_output):
-      imported_data=np.loadtxt(tarquin_output,skiprows=2,delimiter=',');
-      filtered_data=imported_data[:,0:4];
-      filtered_data=filtered_data[np.logical_and(filtered_data[:,0]<5,filtered_data[:,0]>-1),:];
-      print filtered_data;
-    else:
-      print 'WARNING: Generating dummy output.';
-      ppm=np.linspace(4.2,0.2,1000);
+  quick_quantify(P,voxel_working_folder,cache=cache,previews=previews,runner=runner);
+
+  tarquin_output=os.path.join(voxel_working_folder,'%s.fit.csv' % (P.shortname));
 
-      sh=10*np.random.rand(4);
+  if os.path.exists(tarquin_output):
+    imported_data=np.loadtxt(tarquin_output,skiprows=2,delimiter=',');
+    filtered_data=imported_data[:,0:4];
+    filtered_data=filtered_data[np.logical_and(filtered_data[:,0]<5,filtered_data[:,0]>-1),:];
+    print filtered_data;
+  else:
+    print 'WARNING: Generating dummy output.';
+    ppm=np.linspace(4.2,0.2,1000);
+
+    rng=np.random.RandomState(zlib.crc32(P.shortname) & 0xffffffff); # the same dummy for the same voxel, every time
+    sh=10*rng.rand(4);
 
-      raw     =100*np.sin(ppm+sh[1])+50*np.cos(3*ppm+sh[0])+20*np.sin(7*ppm+sh[2])+10*np.random.ranf(ppm.size);
-      fit     =  5*np.sin(ppm+sh[1])+45*np.cos(3*ppm+sh[0]);
-      baseline= 95*np.sin(ppm+sh[1])+ 5*np.cos(3*ppm+sh[0]);
+    raw     =100*np.sin(ppm+sh[1])+50*np.cos(3*ppm+sh[0])+20*np.sin(7*ppm+sh[2])+10*rng.random_sample(ppm.size);
+    fit     =  5*np.sin(ppm+sh[1])+45*np.cos(3*ppm+sh[0]);
+    baseline= 95*np.sin(ppm+sh[1])+ 5*np.cos(3*ppm+sh[0]);
 
-      filtered_data=np.column_stack((ppm,raw,fit,baseline));
+    filtered_data=np.column_stack((ppm,raw,fit,baseline));
 
+  export_spectrum(voxel_folder,P,filtered_data,binary=binary);
+  return job_summary(cache);
+# }}}
+
+def prep_preview(output_root, header, force=False, runner=None): # {{{
+  """ Job: convert a spectrum's Tarquin report to a preview image, when that was left until later (see quick_quantify); returns cache hits/misses """
+  cache=BuildCache(force=force);
+  P=pfile(header);
+  voxel_folder,voxel_working_folder=voxel_folders(output_root,P);
+  convert_preview(P,voxel_working_folder,cache=cache,runner=runner);
+  return job_summary(cache);
+# }}}
+
+def prep_spectra_native(output_root, headers, basis_file=None, force=False, binary=False): # {{{
+  """ Job: quantify a batch of spectra in-process (see quantify.py), and export the four-column csvs; returns cache hits/misses """
+  import quantify;
+
+  cache=BuildCache(force=force);
+  basis_name=os.path.basename(basis_file) if basis_file is not None else None; # (its contents are an input)
+  todo=[];
+  for header in headers:
+    P=pfile(header);
+    voxel_folder,voxel_working_folder=voxel_folders(output_root,P);
+    outputs=[os.path.join(voxel_working_folder,'%s.native.csv' % (P.shortname)),os.path.join(voxel_folder,'%s.csv' % (P.shortname))];
+    if binary:
+      outputs.append(os.path.join(voxel_folder,'%s.f32' % (P.shortname)));
+    inputs=[P.fullpath]+([basis_file] if basis_file is not None else []);
+    if not cache.is_current('native_'+P.shortname,outputs,inputs,{'basis_file':basis_name,'binary':binary}):
+      todo.append((P,outputs,inputs));
+
+  if len(todo)>0:
+    pfiles=[P for P,outputs,inputs in todo];
+    with stage('quantify native',' '.join(P.shortname for P in pfiles)):
+      quantified=quantify.quantify_pfiles(pfiles,basis_file=basis_file);
+    for (P,outputs,inputs),(filtered_data,amplitudes) in zip(todo,quantified):
+      voxel_folder,voxel_working_folder=voxel_folders(output_root,P);
+      quantify.write_amplitudes(outputs[0],amplitudes);
+      export_spectrum(voxel_folder,P,filtered_data,binary=binary);
+      cache.record('native_'+P.shortname,outputs,inputs,{'basis_file':basis_name,'binary':binary});
+  return job_summary(cache);
+# }}}
+
+def export_spectrum(voxel_folder, P, filtered_data, binary=False): # {{{
+  """ Write a voxel's spectrum, as ppm/raw/fit/baseline columns; if binary, also as <shortname>.f32 (see spectrumbin.py) """
+  import numpy as np;
+
+  #column 1: ppm, x-axis coordinates
+  #column 2: raw data output, y-axis coordinates
+  #column 3: model fit, y-axis coordinates
+  #column 4: baseline, y-axis coordinates
+  with stage('export',P.shortname):
     np.savetxt(os.path.join(voxel_folder,'%s.csv' % (P.shortname)),filtered_data,fmt='%.5e',delimiter=',');
+    f32=os.path.join(voxel_folder,'%s.f32' % (P.shortname));
+    if binary:
+      import spectrumbin;
+      spectrumbin.write_voxel(f32,filtered_data);
+    elif os.path.exists(f32):
+      os.remove(f32); # out of date, now; it would otherwise be packed by a later binary run
+# }}}
+
+def plan_session(jobs, output_root, struct_folder, pfile_names, index=None, quantifier='tarquin', basis_file=None, force=False, mask_pool=None, mask_engine='matlab', binary=False, render_backend='pil', png_level=None, writer_threads=0, render_plane='scanner', previews='now', runner=None, dicom_index=None): # {{{
+  """ Add the jobs for one structural folder and its spectra to a JobGraph; returns the pfiles.
+
+  Dependencies:
+    - each session (subject and structural) has its own working folder (see voxel_folders), and mask
+      generation rewrites its shared volume.nii, so mask jobs sharing a working folder run one at a time,
+      and only once any renders of an earlier plan there are done.
+      With mask_engine='python', volume.nii is instead written once for the session (see prep_volume),
+      after which its masks may be made in any order.
+    - rendering reads volume.nii, so waits for all of this session's masks in that working folder; all
+      those voxels are then rendered together, as one job. Likewise their tissue fractions, which read the
+      working folder's segmentations (c1/c2/c3volume.nii), if gemask made them.
+    - quantification and csv export only need the P-file, so may start straight away; with
+      quantifier='native', all of a session's spectra are fitted together, as one job.
+  """
+
+  if not os.path.exists(struct_folder):
+    raise IOError('Specified structural folder does not exist: %s' % (struct_folder,));
+
+  if not os.path.isdir(struct_folder):
+    raise IOError('Specified structural folder is not actually a folder: %s' % (struct_folder,));
+
+  # create a working area, separate but related to the output_root
+  scratch_folder=os.path.join(output_root,'')[:-1]+'.working';
+  print os.path.join(output_root,'')[:-1];
+  print scratch_folder;
+  if not os.path.exists(scratch_folder):
+    os.makedirs(scratch_folder);
+
+  if not hasattr(jobs,'working_folders'):
+    jobs.working_folders={}; # working folder => {'last_mask':..., 'renders':[...]}
+  if not hasattr(jobs,'voxels'):
+    jobs.voxels=OrderedDict(); # P-file => (pfile, names of the jobs which produce its output folder)
+
+  # the structural folder is an input of every mask; walked once here, rather than for each of them (see buildcache.py)
+  signatures={os.path.abspath(struct_folder):signature(struct_folder)};
+
+  pfiles=[];
+  session_masks=defaultdict(list);
+  session_folders=[];
+  for fn in pfile_names:
+    with stage('header',re.sub('\.7$','',os.path.basename(fn))):
+      if index is not None:
+        P=index.get(fn);
+      else:
+        P=pfile.from_file(fn);
+    pfiles.append(P);
+    print sanitize_string(P.series_description);
+
+    voxel_folder,voxel_working_folder=voxel_folders(output_root,P,struct_folder);
+    if not os.path.isdir(voxel_folder):
+      os.makedirs(voxel_folder);
+    if not os.path.isdir(voxel_working_folder):
+      os.makedirs(voxel_working_folder);
+    if not voxel_working_folder in session_folders:
+      session_folders.append(voxel_working_folder);
+
+  volume=None;
+  if mask_engine=='python':
+    deps=[];
+    for voxel_working_folder in session_folders:
+      wf=jobs.working_folders.setdefault(voxel_working_folder,{'last_mask':None,'renders':[]});
+      deps+=[wf['last_mask']]+wf['renders'];
+    volume=jobs.add('volume:%s' % (struct_folder,), prep_volume, (output_root,struct_folder,session_folders,force,dicom_index,signatures), deps);
+
+  for fn,P in zip(pfile_names,pfiles):
+    voxel_folder,voxel_working_folder=voxel_folders(output_root,P,struct_folder);
+    wf=jobs.working_folders.setdefault(voxel_working_folder,{'last_mask':None,'renders':[]});
+    if volume is not None:
+      deps=[volume];
+    elif wf['last_mask'] is None or not wf['last_mask'] in session_masks[voxel_working_folder]:
+      deps=[wf['last_mask']]+wf['renders']; # first mask of this session in this working folder
+    else:
+      deps=[wf['last_mask']];
+    wf['last_mask']=jobs.add('mask:%s' % (fn,), prep_mask, (output_root,struct_folder,P.header,force,mask_pool,mask_engine,runner,signatures), deps);
+    session_masks[voxel_working_folder].append(wf['last_mask']);
+
+    jobs.voxels[P.fullpath]=(P,[]);
+    if quantifier=='tarquin':
+      jobs.voxels[P.fullpath][1].append(jobs.add('spectrum:%s' % (fn,), prep_spectrum, (output_root,P.header,force,binary,previews,runner)));
+
+  if quantifier=='native':
+    spectra=jobs.add('spectra:%s' % (struct_folder,), prep_spectra_native, (output_root,[P.header for P in pfiles],basis_file,force,binary));
+    for P in pfiles:
+      jobs.voxels[P.fullpath][1].append(spectra);
+  elif quantifier!='tarquin':
+    raise ValueError('Unknown quantifier: %s' % (quantifier,));
+
+  session_voxels=OrderedDict();
+  for P in pfiles:
+    voxel_folder,voxel_working_folder=voxel_folders(output_root,P,struct_folder);
+    session_voxels.setdefault(voxel_working_folder,[]).append(P);
+  for voxel_working_folder in session_voxels:
+    render=jobs.add('render:%s:%s' % (struct_folder,voxel_working_folder), prep_renders, (output_root,struct_folder,[P.header for P in session_voxels[voxel_working_folder]],force,render_backend,png_level,writer_threads,render_plane), session_masks[voxel_working_folder]);
+    tissue=jobs.add('tissue:%s:%s' % (struct_folder,voxel_working_folder), prep_tissue, (output_root,struct_folder,[P.header for P in session_voxels[voxel_working_folder]],force), session_masks[voxel_working_folder]);
+    jobs.working_folders[voxel_working_folder]['renders']+=[render,tissue]; # (both read what the next session's masks rewrite)
+    for P in session_voxels[voxel_working_folder]:
+      jobs.voxels[P.fullpath][1].extend([render,tissue]);
+
+  return pfiles;
+# }}}
+
+def voxels_done(jobs, callbacks): # {{{
+  """ A JobGraph on_done callback which calls each of callbacks with a voxel's pfile once all its jobs are done """
+  waiting=OrderedDict((fn,set(names)) for fn,(P,names) in getattr(jobs,'voxels',{}).items()); # (no voxels planned, no voxels attribute)
+  def on_done(name, result):
+    for fn in list(waiting):
+      waiting[fn].discard(name);
+      if len(waiting[fn])==0:
+        del waiting[fn];
+        for callback in callbacks:
+          callback(jobs.voxels[fn][0]);
+  return on_done;
+# }}}
+
+def archive_voxel(output_root, study): # {{{
+  """ A voxels_done callback which adds a voxel's output folder to a StudyArchive """
+  def callback(P):
+    voxel_folder,voxel_working_folder=voxel_folders(output_root,P);
+    study.add_voxel(voxel_folder,os.path.basename(os.path.dirname(voxel_folder)),os.path.basename(voxel_folder));
+  return callback;
+# }}}
 
+# plan_session options which change what a voxel's output is; a voxel finished with others is done again on resuming
+output_options=['quantifier','basis_file','mask_engine','binary','render_backend','png_level','render_plane'];
 
 
+def spectramosaic_prep_sessions(output_root, struct_spec, njobs=1, index=None, mask_workers=0, mask_worker_kind=None, archive=None, tool_limits=None, tool_timeouts=None, profile=None, profile_stages=(), resume=False, **options): # {{{
+  """Do the things, for a dict of structural folder => list of pfiles; njobs>1 runs independent steps in parallel.
 
-      #column 1: ppm, x-axis coordinates
-      #column 2: raw data output, y-axis coordinates
-      #column 3: model fit, y-axis coordinates
-      #column 4: baseline, y-axis coordinates
+  index, if given, is a PfileIndex to take headers from; mask_workers>0 starts that many warm mask generation
+  workers (see maskworkers.py) for the duration; archive, if given, is a study archive (see studyarchive.py)
+  to add each voxel to as it is finished; tool_limits and tool_timeouts are dicts of tool name => the most
+  instances to run at once, and the seconds one may run for (see toolrunner.py; that of 'matlab' also
+  holds for each mask made by a mask worker); profile, if given, is a folder
+  to write the stage timings to (as stages.json and stages.csv), and any cProfile stats of the stages named in
+  profile_stages (see stagetimer.py); other options are passed on to plan_session.
 
+  Each voxel is noted in a journal in the working folder as it is finished (see cohort.py); with resume, voxels
+  already finished from the same P-file, structural and output_options are left out altogether (their header
+  info rows are already kept in the working folder; see update_header_info).
+  """
 
+  if profile_stages and profile is None:
+    raise ValueError('Profiling stages needs a folder to write the profiles to (--profile).');
+  if profile is not None:
+    if not os.path.isdir(profile):
+      os.makedirs(profile);
+    stagetimer.configure(profile_stages,profile); # before the job pool starts
+
+  manager=None;
+  if mask_workers>0:
+    import maskworkers;
+    mask_timeout=(tool_timeouts or {}).get('matlab'); # as for matlab run afresh for each mask
+    if njobs>1:
+      manager,options['mask_pool']=maskworkers.shared_pool(mask_workers,mask_worker_kind,mask_timeout);
+    else:
+      options['mask_pool']=maskworkers.MaskWorkerPool(mask_workers,mask_worker_kind,mask_timeout);
 
+  runner_manager=None;
+  if njobs>1 and tool_limits:
+    runner_manager,options['runner']=shared_runner(tool_limits,tool_timeouts);
+  else:
+    options['runner']=ToolRunner(tool_limits,tool_timeouts);
 
-  update_header_info(output_root,pfiles);
+  import cohort;
+  scratch_folder=os.path.join(output_root,'')[:-1]+'.working';
+  if not os.path.isdir(scratch_folder):
+    os.makedirs(scratch_folder);
+  journal=cohort.Journal(os.path.join(scratch_folder,'finished.jsonl'));
+  options.setdefault('dicom_index',os.path.join(scratch_folder,'dicom_index.sqlite'));
+  settings=dict((k,options[k]) for k in output_options if k in options);
 
+  jobs=JobGraph();
+  pfiles=[];
+  struct_folders={};
+  resumed=0;
+  for struct_folder in struct_spec:
+    pfile_names=struct_spec[struct_folder];
+    if resume and not options.get('force'):
+      pfile_names=[fn for fn in pfile_names if not journal.is_done(fn,struct_folder,settings)];
+      resumed+=len(struct_spec[struct_folder])-len(pfile_names);
+      if len(pfile_names)==0:
+        continue;
+    pfiles+=plan_session(jobs, output_root, struct_folder, pfile_names, index=index, **options);
+    for fn in pfile_names:
+      struct_folders[os.path.abspath(fn)]=struct_folder;
+  if resume:
+    print 'Resuming: %d voxel(s) already done, %d to do' % (resumed,len(pfiles));
+  stages=stagetimer.collect(); # the header reads; taken now, or the job pool's processes would inherit them too
+  if njobs>1 and len(pfiles)>0:
+    import mergemasks; # once, here, rather than afresh in each of the job pool's processes
+
+  callbacks=[lambda P: journal.add(P.fullpath,struct_folders[os.path.abspath(P.fullpath)],settings)];
+  study=None;
+  if archive is not None:
+    import studyarchive;
+    study=studyarchive.StudyArchive(archive);
+    callbacks.insert(0,archive_voxel(output_root,study));
+  on_done=voxels_done(jobs,callbacks);
+
+  try:
+    results=jobs.run(njobs,on_done=on_done);
+
+    if options.get('previews')=='later' and options.get('quantifier','tarquin')=='tarquin':
+      # PDF reports left unconverted by quick_quantify; done now, so as not to hold up the output proper
+      previews=JobGraph();
+      for P in pfiles:
+        previews.add('preview:%s' % (P.fullpath,), prep_preview, (output_root,P.header,options.get('force',False),options['runner']));
+      results.update(previews.run(njobs));
+  except BaseException: # (including KeyboardInterrupt: an interrupted run keeps its archive, too)
+    if study is not None:
+      study.close(); # keep the voxels which were finished
+    raise;
+  finally:
+    if 'mask_pool' in options:
+      options['mask_pool'].close();
+    if manager is not None:
+      manager.shutdown();
+    if runner_manager is not None:
+      runner_manager.shutdown();
+
+  hits=[];
+  misses=[];
+  for name in results:
+    if isinstance(results[name],dict):
+      hits+=results[name]['hits'];
+      misses+=results[name]['misses'];
+      stages+=results[name].get('stages',[]);
+  print 'Build cache: %d step(s) up-to-date, %d (re)built' % (len(hits),len(misses));
+  for step in misses:
+    print '  rebuilt: %s' % (step,);
+
+  # only once everything is done, and only from this process, so there's no contention for the file
+  with stage('header info'):
+    header_info=update_header_info(output_root,pfiles,struct_folders=struct_folders);
+  import spectrumbin;
+  if options.get('binary'):
+    with stage('pack spectra'):
+      print spectrumbin.pack_study(output_root);
+  else:
+    for fn in spectrumbin.remove_pack(output_root):
+      print 'Removed %s (out of date without --binary)' % (fn,); # the viewer would load it instead of the csvs
+
+  if study is not None:
+    with stage('archive'):
+      study.add_file(header_info,os.path.basename(header_info));
+      if options.get('binary'):
+        for fn in [spectrumbin.manifest_name,spectrumbin.packed_name]:
+          study.add_file(os.path.join(output_root,fn),fn);
+      study.close();
+    print archive;
+
+  stages+=stagetimer.collect(); # this process' own, and those of any jobs it ran itself
+  print stagetimer.summary(stages);
+  if profile is not None:
+    stagetimer.write_report(stages,os.path.join(profile,'stages.json'),os.path.join(profile,'stages.csv'));
+    print os.path.join(profile,'stages.json');
+# }}}
+
+def spectramosaic_prep(output_root, struct_folder, pfile_names, **options): # {{{
+  """Do the things."""
+  spectramosaic_prep_sessions(output_root, {struct_folder:pfile_names}, **options);
+# }}}
+
+def dry_run(output_root, struct_spec, index=None, out=sys.stdout): # {{{
+  """ Print the voxel tree and header info rows which spectramosaic_prep_sessions would produce, reading only
+  the P-file headers (from index, if given); nothing is written, and the imaging stack isn't loaded.
+  """
+  from headerstore import columns, sort_key;
+  tree=OrderedDict(); # patient folder => [(voxel, P-file, structural folder)]
+  rows=[];
+  for struct_folder in struct_spec:
+    for fn in struct_spec[struct_folder]:
+      if index is not None:
+        P=index.get(fn);
+      else:
+        P=pfile.from_file(fn);
+      voxel_folder,voxel_working_folder=voxel_folders(output_root,P);
+      tree.setdefault(os.path.basename(os.path.dirname(voxel_folder)),[]).append((P.shortname,fn,struct_folder));
+      rows.append(header_row(P));
+
+  out.write(' / %s\n' % (output_root,));
+  for patient in tree:
+    out.write(' |-- %s\n' % (patient,));
+    for voxel,fn,struct_folder in tree[patient]:
+      out.write(' |     |-- %-16s <= %s, %s\n' % (voxel,fn,struct_folder));
+  out.write('\n');
+  hwriter=csv.DictWriter(out,columns,delimiter=';');
+  hwriter.writeheader();
+  for row in sorted(rows,key=sort_key):
+    hwriter.writerow(row);
 # }}}
 
 if __name__=='__main__': # command-line operation? {{{
 
   state=None;
   output_root=None;
+  njobs=1;
+  index=None;
+  options={};
+  dry=False;
   this_struct=None;
-  struct_spec=defaultdict(list);
+  struct_spec=OrderedDict(); # structural folder => pfiles, in the order given
 
   for k in sys.argv[1:]:
     print k;
     if state is None:
       if k=='-o':
         state='-o';
+      elif k=='-j':
+        state='-j';
+      elif k in ['-x','--quantify','--basis','--mask-workers','--mask-worker','--mask-engine','--dicom-index','--render-backend','--render-plane','--png-level','--writer-threads','--previews','--tool-limit','--tool-timeout','--profile','--profile-stage','--archive','--manifest']:
+        state=k;
+      elif k=='--force':
+        options['force']=True;
+      elif k=='--binary':
+        options['binary']=True;
+      elif k=='--resume':
+        options['resume']=True;
+      elif k in ['--dry-run','--list']:
+        dry=True;
       elif os.path.isdir(k):
         this_struct=k;
       elif os.path.isfile(k):
         if this_struct is None:
           raise ValueError('You must specify a structural dicom folder, before specifying individual spectra (parameter: %s).' % (k,));
         else:
-          struct_spec[this_struct].append(k);
+          struct_spec.setdefault(this_struct,[]).append(k);
       else:
         raise ValueError('What is this? : %s' % (k));
     elif state=='-o':
-      if not os.path.isdir(k):
-        try:
-          os.makedirs(k);
-        except OSError as exc:
-          print '-o option expects a valid path, which %s is not' % (k,);
-          raise;
       output_root=k;
       state=None;
+    elif state=='-j':
+      njobs=int(k);
+      state=None;
+    elif state=='-x':
+      index=PfileIndex(k);
+      state=None;
+    elif state=='--quantify':
+      if not k in ['tarquin','native']:
+        raise ValueError('--quantify expects tarquin or native, not %s' % (k,));
+      options['quantifier']=k;
+      state=None;
+    elif state=='--basis':
+      options['basis_file']=k;
+      state=None;
+    elif state=='--archive':
+      options['archive']=k;
+      state=None;
+    elif state=='--manifest':
+      import cohort;
+      cohort.struct_spec(cohort.read_manifest(k),struct_spec);
+      state=None;
+    elif state=='--mask-workers':
+      options['mask_workers']=int(k);
+      state=None;
+    elif state=='--mask-worker':
+      options['mask_worker_kind']=k;
+      state=None;
+    elif state=='--mask-engine':
+      if not k in ['matlab','python']:
+        raise ValueError('--mask-engine expects matlab or python, not %s' % (k,));
+      options['mask_engine']=k;
+      state=None;
+    elif state=='--dicom-index':
+      options['dicom_index']=k;
+      state=None;
+    elif state=='--render-backend':
+      options['render_backend']=k;
+      state=None;
+    elif state=='--render-plane':
+      if not k in ['scanner','voxel']:
+        raise ValueError('--render-plane expects scanner or voxel, not %s' % (k,));
+      options['render_plane']=k;
+      state=None;
+    elif state=='--png-level':
+      if not k in [str(x) for x in range(10)]:
+        raise ValueError('--png-level expects 0-9, not %s' % (k,));
+      options['png_level']=int(k);
+      state=None;
+    elif state=='--writer-threads':
+      options['writer_threads']=int(k);
+      state=None;
+    elif state=='--previews':
+      if not k in ['now','later','off']:
+        raise ValueError('--previews expects now, later or off, not %s' % (k,));
+      options['previews']=k;
+      state=None;
+    elif state=='--tool-limit':
+      tool,limit=parse_setting(k,int);
+      options.setdefault('tool_limits',{})[tool]=limit;
+      state=None;
+    elif state=='--tool-timeout':
+      tool,timeout=parse_setting(k,float);
+      options.setdefault('tool_timeouts',{})[tool]=timeout;
+      state=None;
+    elif state=='--profile':
+      options['profile']=k;
+      state=None;
+    elif state=='--profile-stage':
+      options['profile_stages']=options.get('profile_stages',())+(k,);
+      state=None;
     else:
       raise Exception('However did I get here?');
 
@@ -453,6 +1148,22 @@ if __name__=='__main__': # command-line operation? {{{
   elif len(struct_spec)==0:
     raise ValueError('This would go better if you specified some data to process.');
 
+  if dry:
+    dry_run(output_root, struct_spec, index=index);
+    sys.exit(0);
+
+  if 'render_backend' in options:
+    from mergemasks import backends; # (loads the imaging stack, which a dry run doesn't need)
+    if not options['render_backend'] in backends:
+      raise ValueError('--render-backend expects %s, not %s' % (' or '.join(backends),options['render_backend']));
+
+  if not os.path.isdir(output_root):
+    try:
+      os.makedirs(output_root);
+    except OSError as exc:
+      print '-o option expects a valid path, which %s is not' % (output_root,);
+      raise;
+
   print 'Ready to go, like this:'
   print '';
   print ' / %s' % (output_root,);
@@ -461,7 +1172,6 @@ if __name__=='__main__': # command-line operation? {{{
     for spec in struct_spec[sub]:
       print ' |     |-- %s' % (spec)
 
-  for sub in struct_spec:
-    spectramosaic_prep(output_root, sub, struct_spec[sub]);
+  spectramosaic_prep_sessions(output_root, struct_spec, njobs=njobs, index=index, **options);
 
 # }}}
@@ -0,0 +1,138 @@
+#!/usr/bin/python
+"""
+Binary spectrum export, as an alternative to the viewer parsing and resampling each voxel's csv.
+
+A voxel's four columns (ppm, raw, fit, baseline) are transformed exactly as the viewer's preprocessLoadedData
+would: raw and fit taken relative to the baseline, then every column resized to the viewer's spectrum_length
+samples (bin-averaged if longer, linearly interpolated if shorter). They are written, one column after another,
+as little-endian float32, to <shortname>.f32 in the voxel folder.
+
+pack_study gathers the .f32 files of every voxel under an output root into a single spectra.f32 there, with a
+spectra.json manifest giving each voxel's patient, voxel ID and offset (in values), so that a whole study can
+be loaded with one read. The viewer reads them in preference to the csvs, so remove_pack takes them away again
+when a study is next prepared without them.
+"""
+
+import os;
+import sys;
+import json;
+import numpy as np;
+
+spectrum_length=1024; # as in data_handler.js
+baseline_col=3;
+columns=['ppm','raw','fit','baseline'];
+dtype='<f4';
+
+manifest_name='spectra.json';
+packed_name='spectra.f32';
+
+def downsample(a, n): # {{{
+  """ Bin-average a to n samples, with the same bin boundaries as data_handler.js's downsampleArray """
+  ratio=len(a)/float(n);
+  diff=0.;
+  pos=0;
+  starts=np.zeros(n,dtype=int);
+  steps=np.zeros(n,dtype=int);
+  for i in range(n):
+    step=min(int(np.floor(ratio)),len(a)-pos);
+    if diff>1:
+      step+=1;
+    diff+=ratio-step;
+    starts[i]=pos;
+    steps[i]=step;
+    pos+=step;
+  cs=np.concatenate(([0.],np.cumsum(a)));
+  sums=cs[starts+steps]-cs[starts];
+  return np.where(steps>0,sums/np.maximum(steps,1),np.nan);
+# }}}
+
+def upsample(a, n): # {{{
+  """ Linearly interpolate a to n samples, placing the original samples as data_handler.js's upsampleArray does """
+  placed=np.floor(np.arange(len(a))*(n-1.)/(len(a)-1)+0.5); # Math.round
+  return np.interp(np.arange(n),placed,a);
+# }}}
+
+def resize(a, n=spectrum_length): # {{{
+  a=np.asarray(a,dtype=float);
+  if len(a)>n:
+    return downsample(a,n);
+  if len(a)<n:
+    return upsample(a,n);
+  return a;
+# }}}
+
+def preprocess(data, n=spectrum_length): # {{{
+  """ (ncols, n) float32 array of a four-column spectrum, as the viewer would hold it """
+  data=np.asarray(data,dtype=float);
+  out=np.zeros((data.shape[1],n),dtype=dtype);
+  for col in range(data.shape[1]):
+    c=data[:,col];
+    if col!=0 and col!=baseline_col:
+      c=c-data[:,baseline_col];
+    out[col]=resize(c,n);
+  return out;
+# }}}
+
+def write_voxel(fn, data): # {{{
+  """ Write a four-column spectrum to fn, preprocessed, as float32 """
+  preprocess(data).tofile(fn);
+# }}}
+
+def study_voxels(output_root): # {{{
+  """ [(patient, voxel ID, .f32 filename)] of every voxel under an output root, sorted """
+  found=[];
+  for patient in sorted(os.listdir(output_root)):
+    if not os.path.isdir(os.path.join(output_root,patient)) or patient.startswith('.'):
+      continue;
+    for voxel in sorted(os.listdir(os.path.join(output_root,patient))):
+      fn=os.path.join(output_root,patient,voxel,'%s.f32' % (voxel,));
+      if os.path.isfile(fn):
+        found.append((patient,voxel,fn));
+  return found;
+# }}}
+
+def pack_study(output_root): # {{{
+  """ Write spectra.f32 and spectra.json for all voxels under output_root; returns the manifest filename """
+  entries=[];
+  offset=0;
+  packed_fn=os.path.join(output_root,packed_name);
+  with open(packed_fn+'.tmp','wb') as f:
+    for patient,voxel,fn in study_voxels(output_root):
+      data=np.fromfile(fn,dtype=dtype);
+      ncols=len(data)//spectrum_length;
+      f.write(data.tostring());
+      entries.append({'patient':patient,'voxel':voxel,'offset':offset,'columns':ncols});
+      offset+=len(data);
+  os.rename(packed_fn+'.tmp',packed_fn);
+
+  manifest={
+    'data'      : packed_name,
+    'dtype'     : dtype,
+    'length'    : spectrum_length,
+    'columns'   : columns,
+    'baseline_subtracted' : True,
+    'voxels'    : entries,
+  };
+  manifest_fn=os.path.join(output_root,manifest_name);
+  with open(manifest_fn,'w') as f:
+    json.dump(manifest,f,indent=1,sort_keys=True);
+  return manifest_fn;
+# }}}
+
+def remove_pack(output_root): # {{{
+  """ Remove any spectra.f32 and spectra.json under output_root (left by an earlier run); returns the filenames removed """
+  removed=[];
+  for fn in [manifest_name,packed_name]:
+    fn=os.path.join(output_root,fn);
+    if os.path.exists(fn):
+      os.remove(fn);
+      removed.append(fn);
+  return removed;
+# }}}
+
+if __name__=='__main__':
+  if len(sys.argv)<2:
+    print 'Usage: spectrumbin.py [output root] ...';
+    sys.exit(1);
+  for output_root in sys.argv[1:]:
+    print pack_study(output_root);
@@ -0,0 +1,157 @@
+#!/usr/bin/python
+"""
+Where the time goes in a prep run: wall and CPU time, peak memory, and bytes read and written, for each stage
+(header reading, mask generation, rendering, Tarquin, ...) of each voxel.
+
+Stages are timed with `with stage(name, voxel):`, and recorded in a list belonging to the process; a job run in
+a pool hands its records back with its result (see collect()). CPU time and bytes read and written include
+those of any tools the stage ran (and waited for). peak_rss is the largest resident set size reached by the
+process, or by the largest of its tools, by the end of the stage. Byte counts are of all reads and writes
+(cached or not), from /proc/self/io, so are only available on Linux.
+
+Chosen stages may also be run under cProfile (see configure()); profiled stages shouldn't be nested.
+
+Usage
+-----
+
+    stagetimer.py [report.json]
+
+  Print the summary table of a report written by write_report.
+"""
+
+import os;
+import re;
+import sys;
+import csv;
+import json;
+import time;
+import resource;
+from contextlib import contextmanager;
+
+fields=['stage','voxel','pid','start','wall','cpu','peak_rss','read_bytes','write_bytes'];
+
+_records=[];
+_profile_stages=set();
+_profile_folder=None;
+
+def configure(profile_stages=(), profile_folder='.'): # {{{
+  """ Run the named stages (or kinds of stage, eg. 'render' for 'render spectramosaic ax') under cProfile, dumping
+  their stats to <stage>.<voxel>.<pid>.prof files in profile_folder.
+
+  This is a setting of the process, so must be made before a job pool is started, for the pool's processes to inherit it.
+  """
+  global _profile_folder;
+  _profile_stages.clear();
+  _profile_stages.update(profile_stages);
+  _profile_folder=profile_folder;
+# }}}
+
+def _usage(): # {{{
+  """ (CPU seconds, peak RSS in bytes) of this process and its finished tools """
+  own=resource.getrusage(resource.RUSAGE_SELF);
+  tools=resource.getrusage(resource.RUSAGE_CHILDREN);
+  rss=max(own.ru_maxrss,tools.ru_maxrss);
+  if sys.platform!='darwin':
+    rss*=1024; # kilobytes, everywhere but on macs
+  return own.ru_utime+own.ru_stime+tools.ru_utime+tools.ru_stime,rss;
+# }}}
+
+def _io(): # {{{
+  """ (bytes read, bytes written) by this process and its finished tools, or Nones where this isn't known """
+  try:
+    with open('/proc/self/io') as f:
+      io=dict((k.strip(),v.strip()) for k,v in (line.split(':') for line in f));
+    return int(io['rchar']),int(io['wchar']);
+  except (IOError,KeyError,ValueError):
+    return None,None;
+# }}}
+
+def _safe(name):
+  return re.sub('[^A-Za-z0-9]+','_',name).strip('_');
+
+@contextmanager
+def stage(name, voxel=''): # {{{
+  """ Time the enclosed block as stage name, of voxel (a voxel's short name, or several, space separated) """
+  profiler=None;
+  if name in _profile_stages or name.split(' ')[0] in _profile_stages:
+    import cProfile;
+    profiler=cProfile.Profile();
+
+  start=time.time();
+  cpu,rss=_usage();
+  read,written=_io();
+  if profiler is not None:
+    profiler.enable();
+  try:
+    yield;
+  finally:
+    if profiler is not None:
+      profiler.disable();
+      profiler.dump_stats(os.path.join(_profile_folder,'%s.%s.%d.prof' % (_safe(name),_safe(voxel) or 'all',os.getpid())));
+    end_cpu,end_rss=_usage();
+    end_read,end_written=_io();
+    _records.append({
+      'stage':name,
+      'voxel':voxel,
+      'pid':os.getpid(),
+      'start':start,
+      'wall':time.time()-start,
+      'cpu':end_cpu-cpu,
+      'peak_rss':end_rss,
+      'read_bytes':end_read-read if read is not None else None,
+      'write_bytes':end_written-written if written is not None else None,
+      });
+# }}}
+
+def collect(): # {{{
+  """ Take this process' stage records so far """
+  records=list(_records);
+  del _records[:];
+  return records;
+# }}}
+
+def summary(records): # {{{
+  """ A table of time, memory and I/O by stage, as a string """
+  stages={};
+  order=[];
+  for r in sorted(records,key=lambda r: r['start']):
+    kind=r['stage'];
+    if not kind in stages:
+      stages[kind]={'n':0,'wall':0.0,'cpu':0.0,'peak_rss':0,'read_bytes':0,'write_bytes':0};
+      order.append(kind);
+    s=stages[kind];
+    s['n']+=1;
+    s['wall']+=r['wall'];
+    s['cpu']+=r['cpu'];
+    s['peak_rss']=max(s['peak_rss'],r['peak_rss']);
+    for k in ['read_bytes','write_bytes']:
+      if r[k] is not None:
+        s[k]+=r[k];
+
+  MB=1024.0*1024.0;
+  lines=['%-28s %5s %9s %9s %9s %9s %9s' % ('stage','n','wall (s)','cpu (s)','peak MB','read MB','write MB')];
+  for kind in order:
+    s=stages[kind];
+    lines.append('%-28s %5d %9.2f %9.2f %9.1f %9.1f %9.1f' % (kind,s['n'],s['wall'],s['cpu'],s['peak_rss']/MB,s['read_bytes']/MB,s['write_bytes']/MB));
+  return '\n'.join(lines);
+# }}}
+
+def write_report(records, json_file, csv_file=None): # {{{
+  """ Write the stage records as json (a list of objects) and, optionally, csv (one row per record) """
+  records=sorted(records,key=lambda r: r['start']);
+  with open(json_file,'w') as f:
+    json.dump(records,f,indent=1,sort_keys=True);
+  if csv_file is not None:
+    with open(csv_file,'wb') as f:
+      writer=csv.DictWriter(f,fields,delimiter=';');
+      writer.writeheader();
+      for r in records:
+        writer.writerow(r);
+# }}}
+
+if __name__=='__main__':
+  if len(sys.argv)!=2:
+    print 'Usage: stagetimer.py [report.json]';
+    sys.exit(1);
+  with open(sys.argv[1]) as f:
+    print summary(json.load(f));
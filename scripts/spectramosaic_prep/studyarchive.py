@@ -0,0 +1,76 @@
+#!/usr/bin/python
+"""
+A whole study's output in one file: an uncompressed zip, laid out exactly as the output folder is
+(<patient>/<voxel>/<files>, plus the header info csv and any packed spectra at the top), so that it may be
+copied as one file, read a voxel at a time through the zip's central index, or simply unpacked.
+
+Voxels are added as they are finished; re-adding a voxel (or any other file) supersedes the earlier copy,
+and superseded copies are dropped when the archive is closed.
+"""
+
+import os;
+import sys;
+import zipfile;
+import warnings;
+
+class StudyArchive(object):
+  """
+  An uncompressed zip of a study's output, open for appending.
+  """
+
+  def __init__(self, filename):
+    self.filename=filename;
+    self.zip=zipfile.ZipFile(filename,'a' if os.path.exists(filename) else 'w',zipfile.ZIP_STORED,allowZip64=True);
+    self.stale=0;
+
+  def add_file(self, fn, arcname):
+    if arcname in self.zip.NameToInfo:
+      self.stale+=1;
+    with warnings.catch_warnings():
+      warnings.simplefilter('ignore'); # zipfile warns of duplicate names; the newest copy is the one read
+      self.zip.write(fn,arcname);
+
+  def add_voxel(self, voxel_folder, patient, voxel):
+    """ Add (or replace) all the files of a voxel's output folder """
+    for f in sorted(os.listdir(voxel_folder)):
+      if os.path.isfile(os.path.join(voxel_folder,f)):
+        self.add_file(os.path.join(voxel_folder,f),'%s/%s/%s' % (patient,voxel,f));
+
+  def close(self):
+    self.zip.close();
+    if self.stale>0:
+      compact(self.filename);
+
+def compact(filename): # {{{
+  """ Rewrite an archive keeping only the newest copy of each file """
+  tmp='%s.%d.tmp' % (filename,os.getpid());
+  with zipfile.ZipFile(filename,'r') as src:
+    with zipfile.ZipFile(tmp,'w',zipfile.ZIP_STORED,allowZip64=True) as dst:
+      for name in sorted(set(src.namelist())):
+        dst.writestr(src.getinfo(name),src.read(name)); # getinfo gives the last entry of that name
+  os.rename(tmp,filename);
+# }}}
+
+def voxel_names(filename): # {{{
+  """ [(patient, voxel)] in an archive, from its index alone """
+  with zipfile.ZipFile(filename,'r') as z:
+    return sorted(set(tuple(name.split('/')[:2]) for name in z.namelist() if name.count('/')==2));
+# }}}
+
+def read_voxel(filename, patient, voxel): # {{{
+  """ {filename: contents} of one voxel, without reading the rest of the archive """
+  prefix='%s/%s/' % (patient,voxel);
+  with zipfile.ZipFile(filename,'r') as z:
+    return dict((name[len(prefix):],z.read(name)) for name in set(z.namelist()) if name.startswith(prefix));
+# }}}
+
+if __name__=='__main__':
+  if len(sys.argv)<2:
+    print 'Usage: studyarchive.py [archive] [patient voxel]';
+    sys.exit(1);
+  if len(sys.argv)>=4:
+    for name,data in sorted(read_voxel(sys.argv[1],sys.argv[2],sys.argv[3]).items()):
+      print '%-40s %d' % (name,len(data));
+  else:
+    for patient,voxel in voxel_names(sys.argv[1]):
+      print '%s/%s' % (patient,voxel);
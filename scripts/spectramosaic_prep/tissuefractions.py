@@ -0,0 +1,113 @@
+#!/usr/bin/python
+"""
+Grey matter, white matter and CSF fractions of spectroscopy voxels, from the tissue class segmentations of the
+structural (c1volume.nii, c2volume.nii and c3volume.nii, as SPM writes them next to volume.nii).
+
+Each fraction is the mean of a class' probability over the voxel, weighted by the mask's coverage of each
+structural voxel (masks are scaled 0-255 by coverage; see voxelmask.py). The fractions are of the whole voxel,
+so sum to less than 1 where it takes in anything other than brain and CSF.
+
+All the voxels of a working folder are done together: one class at a time, the bounding box of all the
+masks is read from its segmentation, the structural voxels each mask covers are gathered from it, and the
+fractions of all of them are found by one weighted sum over those. Memory so goes with the spread of the
+voxels (at most one class volume at a time), not with their number.
+
+Usage
+-----
+
+    tissuefractions.py [working folder] ...
+
+  Print the fractions of each voxel mask (<voxel>_mask.nii) in the folders.
+"""
+
+import os;
+import re;
+import sys;
+import glob;
+import json;
+import numpy as np;
+
+tissue_classes=[('GM','c1'),('WM','c2'),('CSF','c3')]; # column name, segmentation prefix
+columns=[name for name,prefix in tissue_classes];
+
+def segmentations(folder): # {{{
+  """ The c1/c2/c3 segmentations of a working folder's volume.nii, in the order of tissue_classes; None if any is missing """
+  fns=[os.path.join(folder,'%svolume.nii' % (prefix,)) for name,prefix in tissue_classes];
+  if not all(os.path.exists(fn) for fn in fns):
+    return None;
+  return fns;
+# }}}
+
+def tissue_fractions(masks, segmentation_files): # {{{
+  """ [{column: fraction}] of each of a list of mask files (on the grid of the segmentations), in the same order; {} for an empty mask """
+  import nibabel as nib;
+  seg_imgs=[nib.load(fn) for fn in segmentation_files];
+  shape=seg_imgs[0].shape[:3];
+
+  indices=[]; # flat indices of each mask's non-zero voxels
+  weights=[]; # and its coverage there
+  for fn in masks:
+    img=nib.load(fn);
+    if img.shape[:3]!=shape:
+      raise ValueError('Mask %s is %s, but the segmentations are %s' % (fn,img.shape[:3],shape));
+    data=np.asarray(img.dataobj).reshape(-1);
+    nz=np.flatnonzero(data);
+    indices.append(nz);
+    weights.append(data[nz].astype(np.float32));
+  found=[i for i in range(len(masks)) if len(indices[i])>0];
+  if len(found)==0:
+    return [{} for fn in masks];
+
+  # one class at a time: the bounding box of all the masks' voxels is read, and only those voxels kept
+  flat=np.concatenate([indices[i] for i in found]);
+  ijk=np.unravel_index(flat,shape);
+  box=tuple(slice(c.min(),c.max()+1) for c in ijk);
+  local=np.ravel_multi_index(tuple(c-b.start for c,b in zip(ijk,box)),tuple(b.stop-b.start for b in box));
+  weighted=np.array([np.asarray(img.dataobj[box]).reshape(-1)[local] for img in seg_imgs],dtype=np.float32)*np.concatenate([weights[i] for i in found]);
+
+  starts=np.cumsum([0]+[len(indices[i]) for i in found[:-1]]);
+  sums=np.add.reduceat(weighted,starts,axis=1); # classes x voxels, in one reduction
+  totals=[weights[i].sum() for i in found];
+  fractions=[{} for fn in masks];
+  for k,i in enumerate(found):
+    fractions[i]=dict((c,round(float(sums[j,k]/totals[k]),4)) for j,c in enumerate(columns));
+  return fractions;
+# }}}
+
+def fractions_file(mask): # {{{
+  """ Where a mask's fractions are kept, next to it """
+  return re.sub('_mask\.nii$','',mask)+'_tissue.json';
+# }}}
+
+def write_fractions(masks, segmentation_files): # {{{
+  """ Work out the fractions of a list of masks, and write each to its fractions_file; returns the filenames """
+  fns=[];
+  for mask,fractions in zip(masks,tissue_fractions(masks,segmentation_files)):
+    fns.append(fractions_file(mask));
+    with open(fns[-1],'w') as f:
+      json.dump(fractions,f,sort_keys=True);
+  return fns;
+# }}}
+
+def read_fractions(mask): # {{{
+  """ {column: fraction} of a mask, as written by write_fractions; {} if there are none """
+  fn=fractions_file(mask);
+  if not os.path.exists(fn):
+    return {};
+  with open(fn) as f:
+    return json.load(f);
+# }}}
+
+if __name__=='__main__':
+  if len(sys.argv)<2:
+    print 'Usage: tissuefractions.py [working folder] ...';
+    sys.exit(1);
+  print ';'.join(['mask']+columns);
+  for folder in sys.argv[1:]:
+    seg=segmentations(folder);
+    if seg is None:
+      sys.stderr.write('%s: no c1/c2/c3volume.nii\n' % (folder,));
+      continue;
+    masks=sorted(glob.glob(os.path.join(folder,'*_mask.nii')));
+    for mask,fractions in zip(masks,tissue_fractions(masks,seg)):
+      print ';'.join([os.path.basename(mask)]+[str(fractions.get(c,'')) for c in columns]);
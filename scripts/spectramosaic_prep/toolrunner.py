@@ -0,0 +1,102 @@
+#!/usr/bin/python
+"""
+Runs the external tools of the prep steps (Tarquin, convert, MATLAB), with no more than a set number of
+each running at once, a time limit per tool, and their output going to a log file (one per voxel and tool)
+rather than to the console.
+
+Limits and time limits are given per tool name, e.g. {'tarquin':8,'matlab':2}; a tool without a limit is
+bounded only by the number of jobs. The tools themselves are run by whichever process asks for them; for
+the limits to hold across the processes of a job pool, make the runner with shared_runner(), after which
+it may be passed to the pool's jobs like any other argument.
+"""
+
+import os;
+import time;
+import signal;
+import threading;
+import subprocess;
+
+class ToolTimeout(Exception):
+  pass;
+
+class ToolRunner(object):
+  """
+  Per-tool concurrency limits and time limits for running external tools.
+  """
+
+  def __init__(self, limits=None, timeouts=None, semaphore=threading.BoundedSemaphore):
+    self.limits=dict(limits or {});
+    self.timeouts=dict(timeouts or {});
+    self.slots=dict((tool,semaphore(n)) for tool,n in self.limits.items());
+
+  def run(self, tool, cmd, log_file, input=None, env=None):
+    """ Run cmd as an instance of tool, once one may start, with its stdout and stderr written to log_file; returns its exit status
+
+    input, if given, is written to its stdin. Raises ToolTimeout (having killed it) if it outlasts the tool's time limit.
+    """
+    slot=self.slots.get(tool);
+    if slot is not None:
+      slot.acquire();
+    try:
+      return self._run(tool,cmd,log_file,input,env);
+    finally:
+      if slot is not None:
+        slot.release();
+
+  def _run(self, tool, cmd, log_file, input, env):
+    timeout=self.timeouts.get(tool);
+    timed_out=[];
+    with open(log_file,'wb') as log:
+      log.write('$ %s\n' % (' '.join(cmd),));
+      log.flush();
+      start=time.time();
+      p=subprocess.Popen(cmd,stdin=subprocess.PIPE if input is not None else None,stdout=log,stderr=subprocess.STDOUT,env=env,preexec_fn=os.setsid); # its own process group, so wrappers' children are killed with it
+      timer=None;
+      if timeout is not None:
+        timer=threading.Timer(timeout,_kill,(p,timed_out));
+        timer.daemon=True;
+        timer.start();
+      try:
+        if input is not None:
+          try:
+            p.stdin.write(input);
+            p.stdin.close();
+          except IOError:
+            pass; # it has already gone; the log will say why
+        status=p.wait();
+      finally:
+        if timer is not None:
+          timer.cancel();
+        if p.poll() is None: # interrupted
+          _kill(p,[]);
+          p.wait();
+      log.write('# exit status %d after %.1f s\n' % (status,time.time()-start));
+    if timed_out and status!=-signal.SIGKILL:
+      del timed_out[:]; # it finished by itself, just as the time limit came up
+    if timed_out:
+      raise ToolTimeout('%s killed after %s s; see %s' % (tool,timeout,log_file));
+    return status;
+
+def _kill(p, timed_out): # {{{
+  """ Kill a tool's whole process group: wrapper scripts and launchers, and whatever they started """
+  timed_out.append(True); # (not polled for here, which would race with wait(); see _run)
+  try:
+    os.killpg(p.pid,signal.SIGKILL);
+  except OSError:
+    pass; # finished in the meantime
+# }}}
+
+def shared_runner(limits=None, timeouts=None): # {{{
+  """ A ToolRunner whose limits hold across processes, their semaphores being kept by a manager process; returns (manager, runner) """
+  import multiprocessing;
+  manager=multiprocessing.Manager();
+  return manager,ToolRunner(limits,timeouts,semaphore=manager.BoundedSemaphore);
+# }}}
+
+def parse_setting(setting, convert=int): # {{{
+  """ 'tool=value' (as given on the command line) => (tool, convert(value)) """
+  if setting.count('=')!=1:
+    raise ValueError('Expected tool=value, not %s' % (setting,));
+  tool,value=setting.split('=');
+  return tool,convert(value);
+# }}}
@@ -0,0 +1,125 @@
+#!/usr/bin/python
+"""
+Pure-python replacement for the MATLAB gemask step: rasterize a P-file's PRESS box into the structural voxel grid.
+
+Writes, into the output folder, volume.nii (the structural DICOM series, reoriented to the closest canonical
+RAS orientation) and <shortname>_mask.nii (on the same grid, scaled 0-255 by the fraction of each voxel covered
+by the PRESS box, which is what merge_masks expects).
+
+Box geometry comes from the P-file header: ras_center, ras_size, and - where the version provides them - the
+top-left/top-right/bottom-right corner vectors, which give the box's in-plane axes (otherwise the box is taken
+to be aligned with the scanner axes). The header's R/A/S coordinates are taken to be RAS, as for NIfTI; DICOM
+patient coordinates are LPS.
+
+The DICOM folder's slices are found, and sorted, by dicomindex.py. Requires pydicom and nibabel.
+"""
+
+import os;
+import sys;
+import numpy as np;
+
+lps_to_ras=np.diag([-1.,-1.,1.,1.]);
+
+def load_dicom_series(folder, index=None): # {{{
+  """ The largest image series in a DICOM folder, as (data[x,y,z], 4x4 LPS affine); its slices are taken from index (a DicomIndex), if given """
+  import dicomindex;
+  return dicomindex.read_volume(dicomindex.largest_series(folder,index));
+# }}}
+
+def box_axes(header): # {{{
+  """ (centre, 3x3 array of unit axes as rows, half-lengths) of a P-file's PRESS box, in RAS mm """
+  centre=np.array(header['ras_center'],dtype=float);
+  size=np.abs(np.array(header['ras_size'],dtype=float));
+  if all(k in header for k in ['ras_topleft','ras_topright','ras_bottomright']):
+    tl,tr,br=[np.array(header[k],dtype=float) for k in ['ras_topleft','ras_topright','ras_bottomright']];
+    u=tr-tl;
+    v=br-tr;
+    if np.linalg.norm(u)>0 and np.linalg.norm(v)>0:
+      u/=np.linalg.norm(u);
+      v-=np.dot(v,u)*u;
+      v/=np.linalg.norm(v);
+      axes=np.array([u,v,np.cross(u,v)]);
+      # ras_size is given along the scanner axes; give each box axis the size of the scanner axis it's closest to
+      half=0.5*size[np.argmax(np.abs(axes),axis=1)];
+      return centre,axes,half;
+  return centre,np.eye(3),0.5*size;
+# }}}
+
+def rasterize_box(shape, affine, centre, axes, half, supersample=4): # {{{
+  """ Fraction (0-1) of each voxel of a grid (shape, RAS affine) inside a box, estimated on supersample^3 points per voxel.
+
+  Only the voxels within the box's bounding box are evaluated, all at once.
+  """
+  coverage=np.zeros(shape,dtype=np.float32);
+
+  # box corners -> voxel index bounding box
+  signs=np.array([[i,j,k] for i in [-1,1] for j in [-1,1] for k in [-1,1]],dtype=float);
+  corners=centre+(signs*half).dot(axes);
+  inv=np.linalg.inv(affine);
+  ijk=corners.dot(inv[:3,:3].T)+inv[:3,3];
+  lo=np.clip(np.floor(ijk.min(axis=0)).astype(int),0,np.array(shape));
+  hi=np.clip(np.ceil(ijk.max(axis=0)).astype(int)+1,0,np.array(shape));
+  if np.any(hi<=lo):
+    return coverage;
+
+  # sub-voxel sample offsets, centred within each voxel
+  o=(np.arange(supersample)+0.5)/supersample-0.5;
+  sub=np.stack(np.meshgrid(o,o,o,indexing='ij'),axis=-1).reshape(-1,3);
+
+  grid=np.stack(np.meshgrid(*[np.arange(lo[d],hi[d]) for d in range(3)],indexing='ij'),axis=-1);
+  pts=grid[...,None,:]+sub; # (nx,ny,nz,nsub,3) in voxel index space
+  world=pts.dot(affine[:3,:3].T)+affine[:3,3];
+  local=(world-centre).dot(axes.T);
+  inside=np.all(np.abs(local)<=half,axis=-1);
+  coverage[lo[0]:hi[0],lo[1]:hi[1],lo[2]:hi[2]]=inside.mean(axis=-1);
+  return coverage;
+# }}}
+
+def structural_volume(struct_folder, index=None): # {{{
+  """ The structural DICOM series as a canonically-oriented (RAS) nibabel image (see load_dicom_series) """
+  import nibabel as nib;
+  data,affine=load_dicom_series(struct_folder,index);
+  img=nib.Nifti1Image(data,lps_to_ras.dot(affine));
+  return nib.as_closest_canonical(img);
+# }}}
+
+def make_mask(header, struct_folder, output_folder, volume=None, supersample=4, save_volume=True): # {{{
+  """ Write volume.nii and <shortname>_mask.nii for a P-file header into output_folder; returns their filenames.
+
+  volume may be given (a nibabel image, as from structural_volume) to avoid re-reading the DICOM folder;
+  without save_volume, volume.nii is taken to be there already (see write_volume), and only the mask is written.
+  """
+  import nibabel as nib;
+  if volume is None:
+    volume=structural_volume(struct_folder);
+  centre,axes,half=box_axes(header);
+  coverage=rasterize_box(volume.shape[:3],volume.affine,centre,axes,half,supersample=supersample);
+
+  volume_fn=os.path.join(output_folder,'volume.nii');
+  mask_fn=os.path.join(output_folder,'%s_mask.nii' % (header['shortname'],));
+  if save_volume:
+    nib.save(volume,volume_fn);
+  nib.save(nib.Nifti1Image(np.round(255*coverage).astype(np.uint8),volume.affine),mask_fn);
+  return volume_fn,mask_fn;
+# }}}
+
+def write_volume(struct_folder, output_folders, index=None): # {{{
+  """ Assemble the structural series once, and write it as volume.nii into each of output_folders; returns their filenames """
+  import shutil;
+  import nibabel as nib;
+  volume_fns=[os.path.join(folder,'volume.nii') for folder in output_folders];
+  if len(volume_fns)>0:
+    nib.save(structural_volume(struct_folder,index),volume_fns[0]);
+    for fn in volume_fns[1:]:
+      shutil.copyfile(volume_fns[0],fn);
+  return volume_fns;
+# }}}
+
+if __name__=='__main__':
+  if len(sys.argv)<4:
+    print 'Usage: voxelmask.py [structural dicom folder] [output folder] [pfile] ...';
+    sys.exit(1);
+  from pfile import pfile;
+  volume=structural_volume(sys.argv[1]);
+  for fn in sys.argv[3:]:
+    print make_mask(pfile.read_header(fn),sys.argv[1],sys.argv[2],volume=volume);